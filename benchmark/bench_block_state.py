@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Block オブジェクトのリスト(従来)と BlockStates(配列)のメモリ・速度比較
+
+    python3 -m benchmark.bench_block_state [piece_length]
+"""
+import sys
+import time
+import tracemalloc
+
+import src.global_value as gv
+from src.domain.entity.piece.block import State
+from src.domain.entity.piece.block_state import BlockStates
+
+MB = 1024 ** 2
+SIZES = [128, 256, 512, 1024, 2048]
+
+
+class Block:
+    """
+    BlockStates より前の、ブロックごとのオブジェクト (比較用)
+    """
+    def __init__(self, state: State = State.FREE, block_size: int = gv.CHUNK_SIZE,
+                 data: bytes = b'', last_seen: float = 0):
+        self.state: State = state
+        self.block_size = block_size
+        self.data: bytes = data
+        self.last_seen: float = last_seen
+
+
+def piece_sizes_of(length: int, piece_length: int):
+    number_of_pieces = -(-length // piece_length)
+    sizes = [piece_length] * number_of_pieces
+    sizes[-1] = length - (number_of_pieces - 1) * piece_length
+    return sizes
+
+
+def build_blocks(piece_sizes):
+    pieces = []
+    for piece_size in piece_sizes:
+        blocks = [Block() for _ in range(-(-piece_size // gv.CHUNK_SIZE))]
+        pieces.append(blocks)
+    return pieces
+
+
+def scan_blocks(pieces):
+    block_num = 0
+    for blocks in pieces:
+        for block in blocks:
+            if block.state == State.FULL:
+                block_num += 1
+    return block_num
+
+
+def scan_states(block_states):
+    return block_states.count(State.FULL)
+
+
+def measure(build, scan, piece_sizes):
+    tracemalloc.start()
+    started = time.perf_counter()
+    obj = build(piece_sizes)
+    build_time = time.perf_counter() - started
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    scan(obj)
+    scan_time = time.perf_counter() - started
+    return memory, build_time, scan_time
+
+
+def main():
+    piece_length = int(sys.argv[1]) if len(sys.argv) > 1 else 256 * 1024
+
+    print(f"{'size':>6} {'impl':>12} {'memory[MB]':>11} {'build[s]':>9} {'scan[ms]':>9}")
+    for size in SIZES:
+        piece_sizes = piece_sizes_of(size * MB, piece_length)
+        for name, build, scan in (
+                ('Block', build_blocks, scan_blocks),
+                ('BlockStates', lambda s: BlockStates(s, gv.CHUNK_SIZE), scan_states),
+        ):
+            memory, build_time, scan_time = measure(build, scan, piece_sizes)
+            print(f"{size:>4}MB {name:>12} {memory / MB:>11.2f} {build_time:>9.3f} {scan_time * 1000:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+CacheManager の索引のコスト
+追加(flush でのロックとログへの追記を含む)・起動時のログの読み込み・予算を超えた時の追い出し
+
+    python3 -m benchmark.bench_cache [エントリ数 ...]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from src.application.cache_manager import CacheManager
+from src.domain.entity.layout import TorrentLayout
+
+ENTRY_COUNTS = [10000, 100000]
+PIECE_LENGTH = 256 * 1024
+PIECES_PER_TORRENT = 1000
+FLUSH_PIECES = 64  # 何piece追加するごとに flush するか (1秒ごとの保存の間に完了するpiece数の目安)
+
+
+def fill(cache: CacheManager, number_of_entries: int) -> float:
+    started = time.perf_counter()
+    for piece in range(number_of_entries):
+        info_hash = f'{piece // PIECES_PER_TORRENT:040x}'
+        if piece % PIECES_PER_TORRENT == 0:
+            layout = TorrentLayout([([info_hash], PIECES_PER_TORRENT * PIECE_LENGTH)], PIECE_LENGTH)
+            cache.register(info_hash, info_hash, 'single', layout)
+        cache.add(info_hash, piece % PIECES_PER_TORRENT, PIECE_LENGTH)
+        if piece % FLUSH_PIECES == FLUSH_PIECES - 1:
+            cache.flush()
+    cache.flush()
+    return (time.perf_counter() - started) / number_of_entries
+
+
+def main():
+    entry_counts = [int(n) for n in sys.argv[1:]] or ENTRY_COUNTS
+
+    print(f"{'entries':>8} {'add[us]':>8} {'load[ms]':>9} {'index[MB]':>10} {'evict[ms]':>10}")
+    for number_of_entries in entry_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            cache = CacheManager(directory)
+            add_time = fill(cache, number_of_entries)
+
+            started = time.perf_counter()
+            loaded = CacheManager(directory)
+            load_time = time.perf_counter() - started
+            assert loaded.total_bytes == cache.total_bytes
+
+            # torrentのファイルは無いので索引から外すだけの時間 (消す量は予算の1割)
+            loaded.budget = loaded.total_bytes - 1
+            started = time.perf_counter()
+            loaded.evict()
+            evict_time = time.perf_counter() - started
+
+            print(f"{number_of_entries:>8} {add_time * 1e6:>8.1f} {load_time * 1000:>9.1f} "
+                  f"{os.path.getsize(loaded.path) / 1024 ** 2:>10.1f} {evict_time * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
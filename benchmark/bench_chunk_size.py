@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+chunkの大きさごとのダウンロード性能 (パケットごとの処理コストの曲線) と chunk_size='auto' の選択
+
+bench_download と同じ条件の模擬リンクで、大きさだけを変えて1回ずつダウンロードする。
+--mtu を指定すると、それを超えるchunkは断片化され、断片ごとのロスで失われやすくなる。
+
+    python3 -m benchmark.bench_chunk_size --sizes 64 --mtu 9000 --overhead 60 --loss 0.0005
+    python3 -m benchmark.bench_chunk_size --engine asyncio --bandwidth 1000 --latency 1   # CPUが律速の場合
+"""
+import sys
+
+from benchmark.bench_download import parse_args, measure
+from benchmark.dummy_torrent import MB
+
+CHUNK_SIZES = ['1024', '2048', '4096', '8192', '16384', '32768', 'auto']
+
+
+def main():
+    args = sys.argv[1:]
+    base = parse_args(args)
+    print(f"engine={base.engine} cc={base.cc} bandwidth={base.bandwidth}MB/s latency={base.latency}ms "
+          f"loss={base.loss} mtu={base.mtu} overhead={base.overhead}")
+    print(f"{'size':>6} {'chunk':>6} {'selected':>9} {'time[s]':>8} {'Mbps':>8} {'cpu[s]':>8} {'interests':>10} "
+          f"{'lost':>6} {'cpu/pkt[us]':>12}")
+    for size_mb in base.sizes:
+        for chunk_size in CHUNK_SIZES:
+            result = measure(size_mb, parse_args(args + ['--chunk-size', chunk_size]))
+            packets = -(-size_mb * MB // result['chunk_size'])
+            print(f"{size_mb:>4}MB {chunk_size:>6} {result['chunk_size']:>9} {result['elapsed']:>8.2f} "
+                  f"{result['throughput']:>8.1f} {result['cpu']:>8.2f} {result['interests']:>10} {result['lost']:>6} "
+                  f"{result['cpu'] / packets * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+輻輳制御アルゴリズムを同じ模擬リンク上で比較する
+
+ボトルネック帯域・往復遅延・バッファ長・ランダムロスを持つリンクを仮想時間で
+離散イベントシミュレーションし、各 CongestionControl を on_send / on_data / on_timeout
+だけで駆動する。
+
+    python3 -m benchmark.bench_congestion_control [seconds]
+"""
+import heapq
+import random
+import sys
+
+from src.application.congestion_controls import CONGESTION_CONTROLS, create_congestion_control
+from src.application.rtt_estimator import RttEstimator
+
+LINKS = [
+    # name, bandwidth[packet/s], rtt[s], buffer[packet], loss
+    ('lan', 20000, 0.002, 200, 0.0),
+    ('wan', 5000, 0.05, 100, 0.0),
+    ('lossy', 5000, 0.05, 100, 0.01),
+    ('bufferbloat', 5000, 0.02, 2000, 0.0),
+]
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def simulate(name, bandwidth, rtt, buffer, loss, duration, seed=0):
+    rand = random.Random(seed)
+    clock = VirtualClock()
+    cc = create_congestion_control(name, RttEstimator(max_rto=4), clock=clock)
+
+    events = []  # (time, seq)
+    pending = {}  # seq -> (送信時刻, deadline)
+    timeouts = []  # (deadline, seq)
+    last_departure = 0.0
+    seq = 0
+    delivered = 0
+    num_of_timeouts = 0
+    rtt_sum = 0.0
+
+    while clock.now < duration:
+        # ウィンドウが空いている分だけ送信
+        while len(pending) < cc.window:
+            departure = max(clock.now, last_departure) + 1 / bandwidth
+            queued = (departure - clock.now) * bandwidth
+            deadline = clock.now + cc.rtt.rto
+            pending[seq] = (clock.now, deadline)
+            heapq.heappush(timeouts, (deadline, seq))
+            if queued <= buffer and rand.random() >= loss:
+                last_departure = departure
+                heapq.heappush(events, (departure + rtt, seq))
+            cc.on_send()
+            seq += 1
+
+        next_event = events[0][0] if events else duration
+        next_timeout = timeouts[0][0] if timeouts else duration
+        clock.now = min(next_event, next_timeout, duration)
+
+        while events and events[0][0] <= clock.now:
+            _, s = heapq.heappop(events)
+            if s in pending:
+                sent_time, _ = pending.pop(s)
+                sample = clock.now - sent_time
+                rtt_sum += sample
+                delivered += 1
+                cc.now_wind = len(pending)
+                cc.on_data(sample)
+
+        while timeouts and timeouts[0][0] <= clock.now:
+            deadline, s = heapq.heappop(timeouts)
+            if s in pending and pending[s][1] == deadline:
+                del pending[s]
+                num_of_timeouts += 1
+                cc.now_wind = len(pending)
+                cc.on_timeout()
+
+    utilization = delivered / (bandwidth * duration)
+    average_rtt = rtt_sum / delivered if delivered else 0
+    return utilization, average_rtt, num_of_timeouts, cc.window
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 30
+
+    print(f"{'link':>12} {'cc':>6} {'utilization':>12} {'avg rtt[ms]':>12} {'timeouts':>9} {'cwnd':>8}")
+    for link, bandwidth, rtt, buffer, loss in LINKS:
+        for name in CONGESTION_CONTROLS:
+            utilization, average_rtt, timeouts, window = simulate(name, bandwidth, rtt, buffer, loss, duration)
+            print(f"{link:>12} {name:>6} {utilization * 100:>11.1f}% {average_rtt * 1000:>12.1f} "
+                  f"{timeouts:>9} {window:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+模擬リンク上で main.py と同じダウンロードを行い、スループット・CPU時間・最大RSSを測る
+
+    python3 -m benchmark.bench_download --sizes 128 256 --engine asyncio --loss 0.001
+    python3 -m benchmark.bench_download --stream --picker streaming   # 最初の1バイトまでの時間も測る
+
+1回のダウンロードごとに子プロセスを作って測定する。
+CPU時間には requester プロセスと模擬リンクのスレッドの分も含まれる。
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import threading
+import time
+
+import src.application.bittorrent as b
+from src.application import metrics as m
+from src.application.async_bittorrent import AsyncBitTorrent
+from src.application.parallel_bittorrent import ParallelBitTorrent
+from src.application.congestion_controls import CONGESTION_CONTROLS
+from src.application.piece_picker import PIECE_PICKERS
+from src.domain.entity.torrent import Torrent
+from src.infrastructure.simulated_cefpyco import SimulatedLink
+
+from benchmark.dummy_torrent import DummyTorrent, MB
+
+ENGINES = {
+    'process': b.BitTorrent,
+    'asyncio': AsyncBitTorrent,
+    'parallel': ParallelBitTorrent,
+}
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128], help='torrentのサイズ[MB]')
+    parser.add_argument('--engine', choices=list(ENGINES), default='process')
+    parser.add_argument('--workers', type=int, default=b.MAX_PEER_CONNECT,
+                        help='parallel エンジンのワーカー数 (ワーカーごとに同じ条件の模擬リンクを持つ)')
+    parser.add_argument('--cc', choices=list(CONGESTION_CONTROLS), default='cubic')
+    parser.add_argument('--picker', choices=list(PIECE_PICKERS), default=b.PIECE_PICKER)
+    parser.add_argument('--no-endgame', dest='endgame', action='store_false')
+    parser.add_argument('--stream', action='store_true', help='StreamReaderで先頭から読みながらダウンロードする')
+    parser.add_argument('--profile', metavar='PATH', help='サンプリング結果を PATH.folded に書き出す (最後のサイズの結果が残る)')
+    parser.add_argument('--metrics', help='計測値をJSON linesで追記するファイル (サイズごとに追記される)')
+    parser.add_argument('--bandwidth', type=float, default=100, help='[MB/s]')
+    parser.add_argument('--latency', type=float, default=10, help='往復遅延[ms]')
+    parser.add_argument('--jitter', type=float, default=0, help='[ms]')
+    parser.add_argument('--loss', type=float, default=0)
+    parser.add_argument('--reorder', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mtu', type=int, help='指定するとこれを超えるDataを断片化する (ロスは断片ごと)')
+    parser.add_argument('--overhead', type=int, default=0, help='パケット(断片)ごとのヘッダ[byte]')
+    parser.add_argument('--chunk-size', type=chunk_size_arg, default=b.CHUNK_SIZE, help="[byte] / 'auto'")
+    parser.add_argument('--corrupt', type=float, default=0, help='Dataの1バイトを書き換える確率')
+    parser.add_argument('--piece-length', type=int, default=256 * 1024, help='[byte]')
+    parser.add_argument('--torrent-version', type=torrent_version_arg, default=1, help="1 / 2 / 'hybrid'")
+    return parser.parse_args(args)
+
+
+def chunk_size_arg(value: str):
+    return value if value == 'auto' else int(value)
+
+
+def torrent_version_arg(value: str):
+    return value if value == 'hybrid' else int(value)
+
+
+def create_link(dummy: DummyTorrent, args) -> SimulatedLink:
+    return SimulatedLink(dummy.source, bandwidth=args.bandwidth * MB, latency=args.latency / 1000,
+                         jitter=args.jitter / 1000, loss=args.loss, reorder=args.reorder, seed=args.seed,
+                         mtu=args.mtu, overhead=args.overhead, corrupt=args.corrupt)
+
+
+def download(torrent_path: str, dummy: DummyTorrent, args, directory: str, conn):
+    b.CACHE_PATH = directory + '/'
+    b.EVALUATION = False
+    options = dict(picker=args.picker, endgame=args.endgame, metrics_path=args.metrics,
+                   profile_path=args.profile, chunk_size=args.chunk_size)
+    link = create_link(dummy, args)
+    if args.engine == 'parallel':
+        def handle_factory():
+            handle = create_link(dummy, args).handle()
+            handle.begin()
+            return handle
+        bittorrent = ParallelBitTorrent(Torrent(torrent_path), args.cc, handle_factory, args.workers, **options)
+    else:
+        handle = link.handle()
+        handle.begin()
+        bittorrent = ENGINES[args.engine](Torrent(torrent_path), args.cc, handle, **options)
+
+    first_byte = []
+    if args.stream:
+        stream = bittorrent.open_stream()
+
+        def consume():
+            for _ in stream.chunks():
+                if not first_byte:
+                    first_byte.append(time.time())
+            stream.close()
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+
+    started = time.time()
+    bittorrent.run()
+    elapsed = time.time() - started
+    link.stop()
+    if args.stream:
+        consumer.join()
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    values = bittorrent.collect_metrics().values
+    conn.send({
+        'elapsed': elapsed,
+        'cpu': own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        'max_rss': max(own.ru_maxrss, children.ru_maxrss) * 1024,
+        # parallel はワーカーごとの模擬リンクの値を集めない
+        'interests': link.num_of_interests if args.engine != 'parallel' else '-',
+        'lost': link.num_of_lost if args.engine != 'parallel' else '-',
+        'ttfb': first_byte[0] - started if first_byte else None,
+        'chunk_size': bittorrent.chunk_size,
+        'corrupted': link.num_of_corrupted if args.engine != 'parallel' else '-',
+        'hash_failures': int(values[m.HASH_FAILURES]),
+        'block_failures': int(values[m.BLOCK_FAILURES]),
+    })
+    conn.close()
+
+
+def measure(size_mb: int, args) -> dict:
+    dummy = DummyTorrent(size_mb, args.piece_length, version=args.torrent_version)
+    with tempfile.TemporaryDirectory() as directory:
+        torrent_path = dummy.write(directory)
+
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=download,
+                                          args=(torrent_path, dummy, args, directory, child_conn))
+        process.start()
+        result = parent_conn.recv()
+        process.join()
+
+    result['throughput'] = dummy.length * 8 / result['elapsed'] / MB
+    return result
+
+
+def main():
+    args = parse_args()
+
+    results = []
+    for size_mb in args.sizes:
+        results.append((size_mb, measure(size_mb, args)))
+
+    print(f"engine={args.engine} cc={args.cc} picker={args.picker} endgame={args.endgame} bandwidth={args.bandwidth}MB/s latency={args.latency}ms "
+          f"jitter={args.jitter}ms loss={args.loss} reorder={args.reorder}")
+    print(f"{'size':>6} {'time[s]':>8} {'Mbps':>8} {'cpu[s]':>8} {'rss[MB]':>8} {'interests':>10} {'lost':>6}"
+          f"{' ttfb[ms]' if args.stream else ''}")
+    for size_mb, result in results:
+        ttfb = '' if result['ttfb'] is None else f" {result['ttfb'] * 1000:>8.1f}"
+        print(f"{size_mb:>4}MB {result['elapsed']:>8.2f} {result['throughput']:>8.1f} {result['cpu']:>8.2f} "
+              f"{result['max_rss'] / MB:>8.1f} {result['interests']:>10} {result['lost']:>6}{ttfb}")
+
+
+if __name__ == "__main__":
+    main()
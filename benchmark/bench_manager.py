@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+模擬リンク1本の上で TorrentManager により複数のtorrentを同時にダウンロードし、
+torrentごとの完了時間と全体のスループット・CPU時間を測る
+
+    python3 -m benchmark.bench_manager --sizes 32 32 32 --weights 1 1 2
+
+1回の測定ごとに子プロセスを作る。
+"""
+import argparse
+import multiprocessing
+import resource
+import tempfile
+import time
+
+import src.application.bittorrent as b
+from src.application.congestion_controls import CONGESTION_CONTROLS
+from src.application.torrent_manager import TorrentManager
+from src.domain.entity.torrent import Torrent
+from src.infrastructure.simulated_cefpyco import SimulatedLink
+
+from benchmark.dummy_torrent import DummyTorrent, MB
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[32, 32, 32], help='torrentごとのサイズ[MB]')
+    parser.add_argument('--weights', type=float, nargs='+', help='torrentごとの重み (省略時は全て1)')
+    parser.add_argument('--max-outstanding', type=int, help='応答待ちInterestの全体の上限')
+    parser.add_argument('--cc', choices=list(CONGESTION_CONTROLS), default='cubic')
+    parser.add_argument('--bandwidth', type=float, default=100, help='[MB/s]')
+    parser.add_argument('--latency', type=float, default=10, help='往復遅延[ms]')
+    parser.add_argument('--loss', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--metrics', help='torrentごとの計測値をJSON linesで追記するファイル')
+    parser.add_argument('--metrics-port', type=int, help='Prometheus形式の計測値を /metrics で返すポート')
+    parser.add_argument('--profile', metavar='PATH', help='サンプリング結果を PATH.folded に書き出す')
+    return parser.parse_args(args)
+
+
+def download(dummies, args, directory: str, conn):
+    b.CACHE_PATH = directory + '/'
+    b.EVALUATION = False
+    sources = {}
+
+    def source(name: str, chunk_num: int):
+        dummy = sources.get(name.split('/')[2])
+        return None if dummy is None else dummy.source(name, chunk_num)
+
+    link = SimulatedLink(source, bandwidth=args.bandwidth * MB, latency=args.latency / 1000,
+                         loss=args.loss, seed=args.seed)
+    handle = link.handle()
+    handle.begin()
+    manager = TorrentManager(args.cc, handle, args.max_outstanding, args.metrics, args.metrics_port,
+                             args.profile)
+    weights = args.weights or [1] * len(dummies)
+    sessions = []
+    for dummy, weight in zip(dummies, weights):
+        session = manager.add(Torrent(dummy.write(directory)), weight)
+        sources[session.info_hash] = dummy
+        sessions.append(session)
+
+    finished = {}
+    wait_session = manager.wait_session
+
+    async def record(session):
+        await wait_session(session)
+        finished[session.info_hash] = time.time()
+    manager.wait_session = record
+
+    started = time.time()
+    manager.run()
+    elapsed = time.time() - started
+    link.stop()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    conn.send({
+        'elapsed': elapsed,
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'finished': [finished[session.info_hash] - started for session in sessions],
+        'interests': link.num_of_interests,
+    })
+    conn.close()
+
+
+def main():
+    args = parse_args()
+    dummies = [DummyTorrent(size_mb, name=f'{size_mb}MB.{i}.dummy') for i, size_mb in enumerate(args.sizes)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=download, args=(dummies, args, directory, child_conn))
+        process.start()
+        result = parent_conn.recv()
+        process.join()
+
+    total = sum(dummy.length for dummy in dummies)
+    print(f"cc={args.cc} bandwidth={args.bandwidth}MB/s latency={args.latency}ms loss={args.loss} "
+          f"max_outstanding={args.max_outstanding}")
+    print(f"total: {result['elapsed']:.2f}s {total * 8 / result['elapsed'] / MB:.1f}Mbps "
+          f"cpu: {result['cpu']:.2f}s interests: {result['interests']}")
+    weights = args.weights or [1] * len(dummies)
+    print(f"{'torrent':>16} {'weight':>6} {'done[s]':>8} {'Mbps':>8}")
+    for dummy, weight, finished in zip(dummies, weights, result['finished']):
+        print(f"{dummy.name:>16} {weight:>6} {finished:>8.2f} {dummy.length * 8 / finished / MB:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Dataが壊れる経路での v1 (piece全体のSHA-1) と v2 (葉ごとのmerkle tree) の再要求量の比較
+
+bench_download と同じ条件の模擬リンクで、torrentの版とpieceの大きさだけを変えて1回ずつダウンロードする。
+extra は全ブロック数を超えて送ったInterest (タイムアウト・検証失敗の再要求と、v2の葉のハッシュの要求)。
+
+    python3 -m benchmark.bench_merkle --sizes 64 --corrupt 0.001 --engine asyncio
+"""
+import sys
+
+from benchmark.bench_download import parse_args, measure
+from benchmark.dummy_torrent import MB
+
+VERSIONS = ['1', '2']
+PIECE_LENGTHS = [256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+
+def main():
+    args = sys.argv[1:]
+    base = parse_args(args)
+    print(f"engine={base.engine} cc={base.cc} bandwidth={base.bandwidth}MB/s latency={base.latency}ms "
+          f"loss={base.loss} corrupt={base.corrupt}")
+    print(f"{'size':>6} {'piece':>7} {'ver':>4} {'time[s]':>8} {'Mbps':>8} {'corrupted':>10} {'interests':>10} "
+          f"{'extra':>7} {'piece fail':>11} {'block fail':>11}")
+    for size_mb in base.sizes:
+        for piece_length in PIECE_LENGTHS:
+            for version in VERSIONS:
+                result = measure(size_mb, parse_args(args + ['--piece-length', str(piece_length),
+                                                             '--torrent-version', version]))
+                blocks = -(-size_mb * MB // result['chunk_size'])
+                extra = result['interests'] - blocks if isinstance(result['interests'], int) else '-'
+                print(f"{size_mb:>4}MB {piece_length // 1024:>5}KB {version:>4} {result['elapsed']:>8.2f} "
+                      f"{result['throughput']:>8.1f} {result['corrupted']:>10} {result['interests']:>10} {extra:>7} "
+                      f"{result['hash_failures']:>11} {result['block_failures']:>11}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+完了判定・進捗表示のコスト比較
+全pieceの走査とBlockStatesの数え直し(従来) と DownloadProgress のカウンタ
+
+    python3 -m benchmark.bench_progress [piece_length]
+"""
+import sys
+import time
+
+import src.global_value as gv
+from src.domain.entity.piece.block import State
+from src.domain.entity.piece.block_state import BlockStates
+from src.domain.entity.piece.piece import Piece
+from src.domain.entity.piece.progress import DownloadProgress
+
+from benchmark.bench_block_state import piece_sizes_of, MB
+
+SIZES = [128, 512, 2048, 8192]
+CALLS = 1000
+
+
+def scan_completed(pieces) -> bool:
+    for piece in pieces:
+        if not piece.is_full:
+            return False
+    return True
+
+
+def measure(function) -> float:
+    started = time.perf_counter()
+    for _ in range(CALLS):
+        function()
+    return (time.perf_counter() - started) / CALLS
+
+
+def main():
+    piece_length = int(sys.argv[1]) if len(sys.argv) > 1 else 256 * 1024
+
+    print(f"{'size':>6} {'pieces':>7} {'impl':>16} {'completed[us]':>14} {'progress[us]':>13}")
+    for size in SIZES:
+        piece_sizes = piece_sizes_of(size * MB, piece_length)
+        block_states = BlockStates(piece_sizes, gv.CHUNK_SIZE, shared=True)
+        pieces = [Piece(i, piece_size, b'', None, block_states.piece(i)) for i, piece_size in enumerate(piece_sizes)]
+        progress = DownloadProgress(block_states, shared=True)
+        # 最後のpiece以外は完了している状態 (走査が最も長くなる)
+        for piece in pieces[:-1]:
+            piece.set_exist()
+            progress.restore(piece.piece_index)
+
+        for name, completed, count in (
+                ('scan', lambda: scan_completed(pieces), lambda: block_states.count(State.FULL)),
+                ('DownloadProgress', progress.is_complete, lambda: progress.blocks),
+        ):
+            print(f"{size:>4}MB {len(pieces):>7} {name:>16} {measure(completed) * 1e6:>14.2f} "
+                  f"{measure(count) * 1e6:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Seeder の配信性能を模擬リンク上で測る
+
+ディスクに書き込んだtorrentを Seeder が配信し、それを通常のダウンロードで受け取る。
+比較として同じリンクでメモリ上のデータを返す場合(source)も測る。
+
+    python3 -m benchmark.bench_seed --sizes 128 --hot-pieces 1 64 --bandwidth 1000 --latency 1
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+import src.application.bittorrent as b
+from src.application.async_bittorrent import AsyncBitTorrent
+from src.application.resume import ResumeData
+from src.application.seeder import Seeder, HOT_PIECES
+from src.domain.entity.layout import TorrentLayout
+from src.domain.entity.piece.piece import Piece
+from src.domain.entity.torrent import Torrent
+from src.infrastructure.simulated_cefpyco import SimulatedLink
+from src.infrastructure.storage import SingleFileStorage
+
+from benchmark.dummy_torrent import DummyTorrent, MB
+
+ENGINES = {
+    'process': b.BitTorrent,
+    'asyncio': AsyncBitTorrent,
+}
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128], help='torrentのサイズ[MB]')
+    parser.add_argument('--engine', choices=list(ENGINES), default='asyncio', help='受信側のエンジン')
+    parser.add_argument('--hot-pieces', type=int, nargs='+', default=[HOT_PIECES],
+                        help='Seeder のLRUに保持するpiece数 (値ごとに測る)')
+    parser.add_argument('--bandwidth', type=float, default=100, help='[MB/s]')
+    parser.add_argument('--latency', type=float, default=10, help='往復遅延[ms]')
+    return parser.parse_args(args)
+
+
+def prepare(torrent_path: str, dummy: DummyTorrent, directory: str):
+    """
+    ダウンロード済みと同じ状態 (本来のファイルとresumeファイル) を作る
+    """
+    torrent = Torrent(torrent_path)
+    file_path = os.path.join(directory, torrent.info.name)
+    storage = SingleFileStorage(file_path, TorrentLayout.from_torrent(torrent))
+    resume = ResumeData(file_path, torrent.info_hash.hex(), storage)
+    for i in range(dummy.number_of_pieces):
+        storage.write(i, dummy.piece_data(i))
+        resume.add(Piece(i, dummy.piece_size(i), b'', storage))
+    resume.save()
+    storage.close()
+
+
+def serve(torrent_path: str, directory: str, hot_pieces: int, handle, stop, conn):
+    b.CACHE_PATH = directory + '/'
+    seeder = Seeder(Torrent(torrent_path), handle, hot_pieces=hot_pieces)
+    threading.Thread(target=lambda: (stop.wait(), seeder.stop()), daemon=True).start()
+    seeder.run()
+    conn.send({'reads': seeder.num_of_reads, 'misses': seeder.num_of_misses})
+    conn.close()
+
+
+def download(torrent_path: str, dummy: DummyTorrent, args, seed_directory: str, hot_pieces, conn):
+    b.EVALUATION = False
+    source = dummy.source if hot_pieces is None else None
+    link = SimulatedLink(source, bandwidth=args.bandwidth * MB, latency=args.latency / 1000)
+    handle = link.handle()
+    handle.begin()
+
+    seeder = None
+    stop = multiprocessing.Event()
+    seeder_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    if hot_pieces is not None:
+        seeder = multiprocessing.Process(target=serve, args=(torrent_path, seed_directory, hot_pieces,
+                                                             link.producer_handle(), stop, child_conn))
+        seeder.start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        b.CACHE_PATH = directory + '/'
+        bittorrent = ENGINES[args.engine](Torrent(torrent_path), 'cubic', handle)
+        started = time.time()
+        bittorrent.run()
+        elapsed = time.time() - started
+    link.stop()
+
+    result = {'elapsed': elapsed, 'interests': link.num_of_interests, 'reads': '-', 'misses': '-'}
+    if seeder is not None:
+        stop.set()
+        result.update(seeder_conn.recv())
+        seeder.join()
+    conn.send(result)
+    conn.close()
+
+
+def measure(torrent_path: str, dummy: DummyTorrent, args, seed_directory: str, hot_pieces) -> dict:
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=download, args=(torrent_path, dummy, args, seed_directory,
+                                                             hot_pieces, child_conn))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    result['throughput'] = dummy.length * 8 / result['elapsed'] / MB
+    return result
+
+
+def main():
+    args = parse_args()
+
+    print(f"engine={args.engine} bandwidth={args.bandwidth}MB/s latency={args.latency}ms")
+    print(f"{'size':>6} {'server':>10} {'time[s]':>8} {'Mbps':>8} {'interests':>10} {'reads':>7} {'misses':>7}")
+    for size_mb in args.sizes:
+        dummy = DummyTorrent(size_mb)
+        with tempfile.TemporaryDirectory() as directory:
+            torrent_path = dummy.write(directory)
+            prepare(torrent_path, dummy, directory)
+            for hot_pieces in [None] + args.hot_pieces:
+                result = measure(torrent_path, dummy, args, directory, hot_pieces)
+                server = 'source' if hot_pieces is None else f'hot={hot_pieces}'
+                print(f"{size_mb:>4}MB {server:>10} {result['elapsed']:>8.2f} {result['throughput']:>8.1f} "
+                      f"{result['interests']:>10} {result['reads']:>7} {result['misses']:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+torrentファイルの読み込み(起動時)のコスト比較
+bcoding で全体をデコードし info を再エンコードしてハッシュする従来の方法と、src.infrastructure.bencode
+(bcoding はクライアントの依存から外したので、入っていない場合は src.infrastructure.bencode だけを測る)
+
+    python3 -m benchmark.bench_torrent_load [piece数 ...]
+"""
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+try:
+    import bcoding
+except ImportError:
+    bcoding = None
+
+from benchmark.dummy_torrent import bencode
+from src.domain.entity.torrent import Torrent, PieceHashes
+
+PIECE_COUNTS = [10000, 100000, 500000]
+REPEAT = 3
+
+
+def write_torrent(directory: str, number_of_pieces: int) -> str:
+    info = {
+        'length': number_of_pieces * 256 * 1024,
+        'name': f'{number_of_pieces}.dummy',
+        'piece length': 256 * 1024,
+        'pieces': os.urandom(number_of_pieces * 20),
+    }
+    path = os.path.join(directory, f'{number_of_pieces}.torrent')
+    with open(path, 'wb') as file:
+        file.write(bencode({'announce': 'http://localhost/announce', 'info': info}))
+    return path
+
+
+def load_bcoding(path: str):
+    with open(path, 'rb') as file:
+        torrent = bcoding.bdecode(file)
+    info_hash = hashlib.sha1(bcoding.bencode(torrent['info'])).digest()
+    pieces = torrent['info']['pieces']
+    hashes = [pieces[i * 20:i * 20 + 20] for i in range(len(pieces) // 20)]
+    return info_hash, hashes
+
+
+def load_streaming(path: str):
+    torrent = Torrent(path)
+    piece_hashes: PieceHashes = torrent.info.piece_hashes
+    return torrent.info_hash, list(piece_hashes)
+
+
+def load_lazy(path: str):
+    # pieceのハッシュは検証時まで取り出さない
+    torrent = Torrent(path)
+    return torrent.info_hash, torrent.info.piece_hashes
+
+
+def measure(load, path: str):
+    best = None
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        result = load(path)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    piece_counts = [int(n) for n in sys.argv[1:]] or PIECE_COUNTS
+
+    print(f"{'pieces':>8} {'file[MB]':>9} {'bcoding[ms]':>12} {'streaming[ms]':>14} {'speedup':>8} {'lazy[ms]':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        for number_of_pieces in piece_counts:
+            path = write_torrent(directory, number_of_pieces)
+            new_time, (new_hash, new_hashes) = measure(load_streaming, path)
+            lazy_time, (lazy_hash, _) = measure(load_lazy, path)
+            assert new_hash == lazy_hash
+            old_ms, speedup = '-', '-'
+            if bcoding is not None:
+                old_time, (old_hash, old_hashes) = measure(load_bcoding, path)
+                assert old_hash == new_hash and old_hashes == new_hashes
+                old_ms, speedup = f"{old_time * 1000:.1f}", f"{old_time / new_time:.1f}x"
+            print(f"{number_of_pieces:>8} {os.path.getsize(path) / 1024 ** 2:>9.1f} {old_ms:>12} "
+                  f"{new_time * 1000:>14.1f} {speedup:>8} {lazy_time * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
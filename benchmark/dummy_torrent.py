@@ -0,0 +1,119 @@
+import hashlib
+import os
+from functools import lru_cache
+from typing import Optional
+
+from src.application.bittorrent import CHUNK_SIZE, parse_piece_name, parse_hashes_name
+from src.domain.entity.piece.merkle import BLOCK_SIZE, leaf_hashes, merkle_root
+
+MB = 1024 ** 2
+
+
+def bencode(value) -> bytes:
+    """
+    ベンチマーク用のtorrentを書き出すためのエンコーダ (クライアントはデコードしかしない)
+    """
+    if isinstance(value, int):
+        return b'i%de' % value
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return b'%d:%s' % (len(value), value)
+    if isinstance(value, list):
+        return b'l' + b''.join(bencode(item) for item in value) + b'e'
+    if isinstance(value, dict):
+        items = sorted((key.encode() if isinstance(key, str) else key, item) for key, item in value.items())
+        return b'd' + b''.join(bencode(key) + bencode(item) for key, item in items) + b'e'
+    raise TypeError(f"cannot bencode {type(value).__name__}")
+
+
+class DummyTorrent:
+    """
+    ベンチマーク用の <size>MB.dummy と同じ構成のtorrent
+
+    piece i の中身は i から決まるパターンで、ファイルを置かずに任意のchunkを生成できる。
+    version が 2 / 'hybrid' なら file tree と piece layers を持つv2 (BEP 52) のtorrentにし、
+    <info_hash>/hashes/<piece_index> にpieceの葉のハッシュを返す。
+    """
+
+    def __init__(self, size_mb: int, piece_length: int = 256 * 1024, chunk_size: int = 1024 * 4,
+                 name: str = None, version=1):
+        """
+        :param name: 同じ大きさで info_hash の違うtorrentを作る場合に指定する
+        :param version: 1 / 2 / 'hybrid'
+        """
+        self.name = name or f'{size_mb}MB.dummy'
+        self.length = size_mb * MB
+        self.piece_length = piece_length
+        self.chunk_size = chunk_size
+        self.number_of_pieces = -(-self.length // piece_length)
+        self.version = version
+        self._piece_data = lru_cache(maxsize=64)(self._generate_piece)
+
+    def piece_size(self, piece_index: int) -> int:
+        return min(self.piece_length, self.length - piece_index * self.piece_length)
+
+    def _generate_piece(self, piece_index: int) -> bytes:
+        pattern = hashlib.sha256(piece_index.to_bytes(8, 'big')).digest()
+        size = self.piece_size(piece_index)
+        return (pattern * (size // len(pattern) + 1))[:size]
+
+    def piece_data(self, piece_index: int) -> bytes:
+        return self._piece_data(piece_index)
+
+    def piece_root(self, piece_index: int) -> bytes:
+        width = self.piece_length // BLOCK_SIZE if self.number_of_pieces > 1 else \
+            1 << max(-(-self.length // BLOCK_SIZE) - 1, 0).bit_length()
+        return merkle_root(leaf_hashes(self.piece_data(piece_index)), width)
+
+    def info(self) -> dict:
+        info = {
+            'name': self.name,
+            'piece length': self.piece_length,
+        }
+        if self.version != 2:
+            info['length'] = self.length
+            info['pieces'] = b''.join(hashlib.sha1(self.piece_data(i)).digest() for i in range(self.number_of_pieces))
+        if self.version != 1:
+            info['meta version'] = 2
+            info['file tree'] = {self.name: {'': {'length': self.length, 'pieces root': self.pieces_root()}}}
+        return info
+
+    def pieces_root(self) -> bytes:
+        roots = [self.piece_root(i) for i in range(self.number_of_pieces)]
+        if len(roots) == 1:
+            return roots[0]
+        width = 1 << (len(roots) - 1).bit_length()
+        return merkle_root(roots, width, merkle_root([], self.piece_length // BLOCK_SIZE))
+
+    def write(self, directory: str) -> str:
+        path = os.path.join(directory, self.name + '.torrent')
+        metainfo = {'info': self.info()}
+        if self.version != 1 and self.number_of_pieces > 1:
+            layer = b''.join(self.piece_root(i) for i in range(self.number_of_pieces))
+            metainfo['piece layers'] = {self.pieces_root(): layer}
+        with open(path, 'wb') as file:
+            file.write(bencode(metainfo))
+        return path
+
+    def source(self, name: str, chunk_num: int) -> Optional[bytes]:
+        """
+        ccnx:/BitTorrent/<info_hash>/<piece_index> の chunk_num 番目を返す
+        名前に大きさを含む場合 (<info_hash>/<chunk_size>/<piece_index>) はその大きさで返す
+        """
+        parsed = parse_piece_name(name)
+        if parsed is None:
+            hashes = parse_hashes_name(name)
+            if self.version == 1 or hashes is None or not 0 <= hashes[1] < self.number_of_pieces:
+                return None
+            return b''.join(leaf_hashes(self.piece_data(hashes[1])))
+        _, chunk_size, piece_index = parsed
+        if chunk_size == CHUNK_SIZE:
+            chunk_size = self.chunk_size
+        if not 0 <= piece_index < self.number_of_pieces:
+            return None
+
+        offset = chunk_num * chunk_size
+        if offset >= self.piece_size(piece_index):
+            return None
+        return self.piece_data(piece_index)[offset:offset + chunk_size]
@@ -1,71 +1,56 @@
 import cefpyco
 import threading
 import time
-import math
+import sys
 
-handle = cefpyco.handle()
-handle.begin()
-
-C = 0.4
-beta_cubic = 0.7
+from src.application.congestion_controls import create_congestion_control
 
-W_last_max = 0
-W_cubic_target = 0
-K = 0
+handle = cefpyco.CefpycoHandle()
+handle.begin()
 
-cwnd = 1
-ssthresh = 64
-RTT = 0.1
+congestion_control = create_congestion_control(sys.argv[1] if len(sys.argv) > 1 else 'cubic')
+lock = threading.Lock()
 
 pending_interests = {}  # Interestの名前をキーとして、送信時刻を保存
 
-def send_interest():
-    global cwnd, ssthresh, W_last_max, W_cubic_target, K, RTT
 
+def send_interest():
+    chunk_num = 0
     while True:
-        # CUBICの計算
-        if cwnd < ssthresh:
-            cwnd += 1
-        else:
-            t = time.time() - time_last_congestion
-            W_cubic = C * (t-K)**3 + W_last_max
-            if W_cubic > cwnd:
-                cwnd += (W_cubic - cwnd) / cwnd
+        with lock:
+            # Interestの送信
+            while len(pending_interests) < congestion_control.window:
+                interest_name = "ccnx:/example_name"
+                handle.send_interest(interest_name, chunk_num)
+                pending_interests[(interest_name, chunk_num)] = time.time()
+                congestion_control.on_send()
+                chunk_num += 1
+
+            # タイムアウトのチェック
+            current_time = time.time()
+            for key, sent_time in list(pending_interests.items()):
+                if current_time - sent_time > congestion_control.rtt.rto:
+                    congestion_control.on_timeout()
+                    del pending_interests[key]
+            congestion_control.now_wind = len(pending_interests)
+
+        time.sleep(0.001)
 
-        # Interestの送信
-        for _ in range(int(cwnd)):
-            interest_name = "example_name"
-            handle.send_interest(interest_name, payload=b"sample_payload")
-            pending_interests[interest_name] = time.time()
-
-        # タイムアウトのチェック
-        current_time = time.time()
-        for interest_name, sent_time in list(pending_interests.items()):
-            if current_time - sent_time > 2 * RTT:
-                handle_congestion_event()
-                del pending_interests[interest_name]
-
-        time.sleep(RTT)
-
-def handle_congestion_event():
-    global cwnd, ssthresh, W_last_max, K
-    cwnd *= beta_cubic
-    ssthresh = cwnd
-    W_last_max = max(W_last_max, cwnd)
-    K = (W_last_max - ssthresh) / (C * W_last_max)**(1/3)
 
 def listener():
     while True:
         data = handle.receive()
-        if data.is_data():
+        if data.is_succeeded and data.is_data:
             # Interestの応答を受け取った場合の処理
-            if data.name in pending_interests:
-                del pending_interests[data.name]
+            with lock:
+                sent_time = pending_interests.pop((data.name, data.chunk_num), None)
+                if sent_time is not None:
+                    congestion_control.on_data(time.time() - sent_time)
+                    congestion_control.now_wind = len(pending_interests)
 
-if __name__ == "__main__":
-    time_last_congestion = time.time()
 
+if __name__ == "__main__":
     listen_thread = threading.Thread(target=listener)
     listen_thread.start()
 
-    send_interest()
\ No newline at end of file
+    send_interest()
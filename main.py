@@ -1,10 +1,21 @@
 #!/usr/bin/env python3
-import asyncio
+import argparse
 
-import sys
 import src.global_value as gv
 import src.application.bittorrent as b
+from src.application.async_bittorrent import AsyncBitTorrent
+from src.application.cache_manager import EVICTION_POLICIES
+from src.application.parallel_bittorrent import ParallelBitTorrent
+from src.application.congestion_controls import CONGESTION_CONTROLS
+from src.application.piece_picker import PIECE_PICKERS
+from src.application.seeder import Seeder, HOT_PIECES
+from src.application.torrent_manager import TorrentManager
 from src.domain.entity.torrent import Torrent
+from src.infrastructure.storage import FSYNC_NEVER, FSYNC_PIECE, FSYNC_CLOSE
+
+
+def chunk_size_arg(value: str):
+    return value if value == 'auto' else int(value)
 
 
 def main():
@@ -16,13 +27,90 @@ def main():
         "1024MB.dummy.torrent",
         "2048MB.dummy.torrent",
     ]
-    gv.EVALUATION_PATH = gv.EVALUATION_PATH + paths[int(sys.argv[1])]
-    path = gv.TORRENT_FILE_PATH + paths[int(sys.argv[1])]
-    
+    parser = argparse.ArgumentParser()
+    parser.add_argument('index', type=int, nargs='+',
+                        help='paths のインデックス 複数指定すると1つのfaceで同時にダウンロードする')
+    parser.add_argument('--weights', type=float, nargs='+',
+                        help='複数ダウンロード時のtorrentごとの重み (省略時は全て1)')
+    parser.add_argument('--max-outstanding', type=int,
+                        help='複数ダウンロード時の応答待ちInterestの全体の上限')
+    parser.add_argument('--engine', choices=['process', 'asyncio', 'parallel'],
+                        help='process (省略時): listener/requester の2プロセス, asyncio: 1つのイベントループ, '
+                             'parallel: faceを持つ複数のワーカープロセスでpieceを分担 (1つのtorrentのみ)')
+    parser.add_argument('--workers', type=int,
+                        help=f'parallel エンジンのワーカー数 (省略時は{b.MAX_PEER_CONNECT})')
+    parser.add_argument('--cc', choices=list(CONGESTION_CONTROLS), default=gv.CONGESTION_CONTROL,
+                        help='輻輳制御アルゴリズム')
+    parser.add_argument('--rehash', action='store_true',
+                        help='resumeファイルと一致しない既存のpieceファイルも再ハッシュして再利用する')
+    parser.add_argument('--storage', choices=['single', 'piece'], default=b.STORAGE,
+                        help='single: 本来のファイルに書き込む, piece: pieceごとのファイル')
+    parser.add_argument('--fsync', choices=[FSYNC_NEVER, FSYNC_PIECE, FSYNC_CLOSE], default=b.FSYNC)
+    parser.add_argument('--picker', choices=list(PIECE_PICKERS), default=b.PIECE_PICKER,
+                        help='次に要求するpieceの選び方 (rarest はpieceの最初の応答のRTT・タイムアウトでキャッシュに無いpieceを先に取る)')
+    parser.add_argument('--metrics', help='計測値をJSON linesで1秒ごとに追記するファイル')
+    parser.add_argument('--metrics-port', type=int, help='Prometheus形式の計測値を /metrics で返すポート')
+    parser.add_argument('--metrics-host', default=b.METRICS_HOST,
+                        help="--metrics-port を待ち受けるアドレス ('' なら全てのインターフェース)")
+    parser.add_argument('--profile', metavar='PATH',
+                        help='全プロセスをサンプリングし PATH.folded (flame graph形式) に書き出す')
+    parser.add_argument('--chunk-size', type=chunk_size_arg, default=b.CHUNK_SIZE,
+                        help="1つのInterest/Dataで運ぶ大きさ[byte] / 'auto': 候補を実測して最も速いものを選ぶ")
+    parser.add_argument('--cache-budget', type=int,
+                        help='キャッシュ(CACHE_PATH)の全torrentの合計の上限[MB] 超えたら使われていないpieceから消す')
+    parser.add_argument('--cache-policy', choices=list(EVICTION_POLICIES), default=b.CACHE_POLICY,
+                        help='lru: 最終アクセスが古い順 / lfu: アクセス回数が少ない順に消す')
+    parser.add_argument('--seed', action='store_true',
+                        help='ダウンロード後も ccnx:/BitTorrent/<info_hash> を登録してpieceを配信し続ける')
+    parser.add_argument('--hot-pieces', type=int, default=HOT_PIECES, help='配信時にメモリに保持するpiece数')
+    parser.add_argument('--no-endgame', dest='endgame', action='store_false',
+                        help='最後の応答待ちブロックへの重複Interestを送らない')
+    args = parser.parse_args()
+
+    if args.weights is not None:
+        if len(args.weights) != len(args.index):
+            parser.error('--weights は index と同じ数だけ指定する')
+        if any(weight <= 0 for weight in args.weights):
+            parser.error('--weights は正の値で指定する')
+    if len(args.index) > 1:
+        # 複数ダウンロードは1つのfaceを共有する TorrentManager で動くので、エンジンの指定は使えない
+        for option, given in (('--engine', args.engine is not None), ('--workers', args.workers is not None),
+                              ('--chunk-size auto', args.chunk_size == 'auto'), ('--seed', args.seed)):
+            if given:
+                parser.error(f'{option} は1つのtorrentでのみ使える')
+
+    options = dict(rehash=args.rehash, storage=args.storage, fsync=args.fsync,
+                   picker=args.picker, endgame=args.endgame,
+                   cache_budget=args.cache_budget and args.cache_budget * 1024 ** 2, cache_policy=args.cache_policy,
+                   chunk_size=args.chunk_size)
+    metrics = dict(metrics_path=args.metrics, metrics_port=args.metrics_port, metrics_host=args.metrics_host,
+                   profile_path=args.profile)
+
+    if len(args.index) > 1:
+        manager = TorrentManager(args.cc, max_outstanding=args.max_outstanding, **metrics)
+        weights = args.weights or [1] * len(args.index)
+        for index, weight in zip(args.index, weights):
+            manager.add(Torrent(gv.TORRENT_FILE_PATH + paths[index]), weight,
+                        evaluation_path=gv.EVALUATION_PATH + paths[index], **options)
+        manager.run()
+        return
+
+    index = args.index[0]
+    options['evaluation_path'] = gv.EVALUATION_PATH + paths[index]
+    path = gv.TORRENT_FILE_PATH + paths[index]
+
     torrent = Torrent(path)
-    bp = b.BitTorrent(torrent)
+    if args.engine == 'parallel':
+        workers = args.workers if args.workers is not None else b.MAX_PEER_CONNECT
+        bp = ParallelBitTorrent(torrent, args.cc, workers=workers, **options, **metrics)
+    else:
+        engine = AsyncBitTorrent if args.engine == 'asyncio' else b.BitTorrent
+        bp = engine(torrent, args.cc, **options, **metrics)
     bp.run()
 
+    if args.seed:
+        Seeder(torrent, storage=args.storage, hot_pieces=args.hot_pieces).run()
+
 
 if __name__ == "__main__":
     main()
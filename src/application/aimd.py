@@ -0,0 +1,30 @@
+from src.application.congestion_control import CongestionControl, MIN_WINDOW
+
+
+class Aimd(CongestionControl):
+    """
+    Reno型のAIMD
+
+    slow start の後は1RTTごとに +1、パケロス検出時は半分にする。
+    """
+    name = 'aimd'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.a = 1.0  # 1RTTあたりの増加量
+        self.b = 0.5  # パケロス検出時の乗数
+
+    def on_data(self, rtt: float = None):
+        super().on_data(rtt)
+
+        if self.cwind < self.ssthresh:
+            self.cwind += 1
+        else:
+            self.cwind += self.a / self.cwind
+
+    def on_timeout(self) -> bool:
+        if not super().on_timeout():
+            return False
+        self.ssthresh = max(self.cwind * self.b, MIN_WINDOW)
+        self.cwind = self.ssthresh
+        return True
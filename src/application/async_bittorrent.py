@@ -0,0 +1,279 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from src.application import metrics as m
+from src.application.bittorrent import BitTorrent, VERIFY_WORKERS, VERIFY_QUEUE_SIZE, WINDOW_INTERVAL
+from src.application.metrics import Metrics
+from src.application.piece_verifier import write_with_retry
+from src.application.profiler import SET_TO_FULL, WRITE_ON_DISK
+from src.domain.entity.piece.piece import Piece
+
+from logger import logger
+
+# タイムアウト確認の間隔の上限
+TIMER_INTERVAL = 0.05
+# fileno() の無いハンドルで、受信スレッドから1回に受け取る上限
+RECEIVE_BATCH = 256
+
+
+async def receive_loop(cef_handle, handle_data):
+    """
+    受信したものを全て handle_data(info) に渡し続ける
+    ハンドルが fileno() を持っていればその読み込み可能通知で起き、
+    持っていなければ(cefpyco)専用スレッドでブロッキング受信し、起きたらそこで届いている分を
+    まとめて受け取る (1パケットごとにスレッドとループを行き来しない)。
+    """
+    loop = asyncio.get_running_loop()
+    fileno = getattr(cef_handle, 'fileno', None)
+
+    if fileno is None:
+        with ThreadPoolExecutor(1) as executor:
+            receive = functools.partial(_receive_batch, cef_handle)
+            while True:
+                for info in await loop.run_in_executor(executor, receive):
+                    handle_data(info)
+
+    readable = asyncio.Event()
+    fd = fileno()
+    loop.add_reader(fd, readable.set)
+    try:
+        while True:
+            await readable.wait()
+            readable.clear()
+            # ハンドル内部にバッファされている分も含めて全て読み出す
+            while True:
+                info = cef_handle.receive(timeout_ms=0)
+                if not info.is_succeeded:
+                    break
+                handle_data(info)
+    finally:
+        loop.remove_reader(fd)
+
+
+def _receive_batch(cef_handle) -> list:
+    info = cef_handle.receive(timeout_ms=1000)
+    infos = []
+    while info.is_succeeded:
+        infos.append(info)
+        if len(infos) >= RECEIVE_BATCH:
+            break
+        info = cef_handle.receive(timeout_ms=0)
+    return infos
+
+
+async def run_until(done, tasks: list):
+    """
+    done を待つ その前に tasks (常駐タスク・失敗を受け取るFuture) のどれかが終われば、
+    ダウンロードが進まないまま待ち続けないよう例外を送出する
+    """
+    waiter = asyncio.ensure_future(done)
+    try:
+        finished, _ = await asyncio.wait([waiter, *tasks], return_when=asyncio.FIRST_COMPLETED)
+        if waiter in finished:
+            return waiter.result()
+        for task in finished:
+            if task.cancelled():
+                raise RuntimeError(f"{task!r} was cancelled")
+            if task.exception() is not None:
+                raise task.exception()
+        raise RuntimeError(f"{finished.pop()!r} stopped before the download completed")
+    finally:
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+
+class AsyncBitTorrent(BitTorrent):
+    """
+    BitTorrent.run の代わりに1つのイベントループ上で動くエンジン
+
+    Interest送信、Data受信、タイムアウト処理、進捗表示、piece検証をそれぞれタスクとして動かす。
+    受信は receive_loop を使う。
+    ウィンドウが一杯の間、送信タスクは受信かタイムアウトで起こされるまで待つ。
+    """
+
+    loop = None
+
+    def run(self):
+        try:
+            self.create_profiler(processes=1)
+            self.start_profile('asyncio', 0)
+            self.started_time = time.time()
+            self.start_metrics()
+            asyncio.run(self.main())
+
+            logger.info(f'download time: {(time.time() - self.started_time):.2f}')
+            self.finish_profile()
+            self.stop_metrics()
+        except Exception as e:
+            logger.error(e)
+            raise e
+        except KeyboardInterrupt:
+            return
+        finally:
+            self.notify_piece_completed(stopped=True)
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        verify_executor = ThreadPoolExecutor(VERIFY_WORKERS)
+        self.prepare(asyncio.Event(), verify_executor, asyncio.Semaphore(VERIFY_QUEUE_SIZE))
+
+        tasks = [loop.create_task(coroutine) for coroutine in
+                 (self.receiver(), self.sender(), self.timer(), self.progress())]
+        try:
+            await run_until(self.completed.wait(), tasks + [self.failure])
+        finally:
+            self.loop = None
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            verify_executor.shutdown(wait=True)
+            self.finish()
+
+    def prepare(self, window_opened: asyncio.Event, verify_executor: ThreadPoolExecutor,
+                verify_slots: asyncio.Semaphore):
+        """
+        イベントループ上で動かす準備 TorrentManager では引数を複数のtorrentで共有する
+        """
+        self.loop = asyncio.get_running_loop()
+        self.started_time = time.time()
+        self.completed = asyncio.Event()
+        self.window_opened = window_opened
+        self.verify_executor = verify_executor
+        self.verify_slots = verify_slots
+        self.verifying = set()
+        # 検証タスクの例外 (run_until で待ち、ダウンロードを失敗させる)
+        self.failure = self.loop.create_future()
+
+        if self.all_pieces_completed():
+            self.completed.set()
+
+    def finish(self):
+        self.save_resume()
+        self.storage.close()
+        self.cache.unpin(self.info_hash)
+
+    async def receiver(self):
+        await receive_loop(self.cef_handle, self.handle_data)
+
+    async def sender(self):
+        while True:
+            self.window_opened.clear()
+            self.congestion_control.now_wind = self.scheduler.num_of_pending
+            self.send_piece_interest()
+            try:
+                await asyncio.wait_for(self.window_opened.wait(), WINDOW_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def timer(self):
+        while True:
+            deadline = self.scheduler.next_deadline()
+            delay = TIMER_INTERVAL if deadline is None else deadline - time.time()
+            await asyncio.sleep(min(max(delay, 0), TIMER_INTERVAL))
+
+            expired = self.scheduler.expire(time.time())
+            if expired:
+                self.on_loss(len(expired))
+                self.window_opened.set()
+
+    async def progress(self):
+        while True:
+            await asyncio.sleep(1)
+            self.print_progress()
+            self.save_resume()
+            self.report_metrics()
+
+    def collect_metrics(self) -> Metrics:
+        self.update_gauges()
+        self.metrics.values[m.VERIFY_QUEUE] = len(self.verifying) if self.loop is not None else 0
+        return self.metrics
+
+    def set_stream_cursor(self, piece_index: int):
+        self.call_in_loop(self.picker.set_cursor, piece_index)
+
+    def call_in_loop(self, callback, *args):
+        """
+        StreamReader など別スレッドからの呼び出しをイベントループ上で実行する
+        """
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(callback, *args)
+                return
+            except RuntimeError:
+                # ループは終了している
+                pass
+        callback(*args)
+
+    def on_block_received(self, piece: Piece, block_index: int):
+        acked, rtt = self.scheduler.set_full(piece.piece_index, block_index, time.time())
+        if acked:
+            self.on_rtt_sample(rtt)
+        self.window_opened.set()
+
+        if not piece.in_verification and piece.are_all_blocks_full():
+            piece.in_verification = True
+            task = asyncio.get_running_loop().create_task(self.verify_piece(piece))
+            self.verifying.add(task)
+            task.add_done_callback(self.on_verify_done)
+
+    def on_verify_done(self, task: asyncio.Task):
+        self.verifying.discard(task)
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.error(f"failed to verify a piece: {task.exception()!r}")
+        if not self.failure.done():
+            self.failure.set_exception(task.exception())
+
+    def on_blocks_failed(self, piece: Piece, block_indexes: List[int], block_index: int = None):
+        self.metrics.values[m.BLOCK_FAILURES] += len(block_indexes)
+        self.completion.remove_blocks(len(block_indexes))
+        now = time.time()
+        if block_index is not None:
+            acked, rtt = self.scheduler.set_full(piece.piece_index, block_index, now)
+            if acked:
+                self.on_rtt_sample(rtt)
+        self.scheduler.reset_blocks(piece.piece_index, block_indexes, now)
+        self.window_opened.set()
+
+    async def verify_piece(self, piece: Piece):
+        loop = asyncio.get_running_loop()
+        async with self.verify_slots:
+            try:
+                ok = await loop.run_in_executor(self.verify_executor, self._verify_and_write, piece)
+            finally:
+                piece.in_verification = False
+
+        if ok:
+            self.on_piece_completed(piece)
+            if self.all_pieces_completed():
+                self.completed.set()
+        elif piece.failed_blocks is not None:
+            self.on_blocks_failed(piece, piece.failed_blocks)
+        else:
+            self.metrics.values[m.WRITE_FAILURES if piece.write_error else m.HASH_FAILURES] += 1
+            self.hashes_requested[piece.piece_index] = 0
+            self.completion.remove_blocks(piece.number_of_blocks)
+            self.scheduler.reset_piece(piece.piece_index, time.time())
+            self.window_opened.set()
+
+    def _verify_and_write(self, piece: Piece) -> bool:
+        stages = self.stage_timers
+        started = time.perf_counter()
+        ok = piece.set_to_full()
+        verified = time.perf_counter()
+        self.metrics.observe_latency(m.VERIFY_LATENCY, verified - started)
+        if stages is not None:
+            stages.add(SET_TO_FULL, verified - started)
+        if not ok:
+            return False
+        if not write_with_retry(piece):
+            return False
+        written = time.perf_counter() - verified
+        self.metrics.observe_latency(m.WRITE_LATENCY, written)
+        if stages is not None:
+            stages.add(WRITE_ON_DISK, written)
+        return True
@@ -1,24 +1,127 @@
 import os
+import json
 import math
-import cefpyco
+import queue
+import threading
 import time
 import bitstring
-from typing import List
+from array import array
+from typing import List, Optional, Tuple
 import multiprocessing
 
-from src.application.cubic import Cubic
+from src.application import metrics as m
+from src.application.block_scheduler import BlockScheduler
+from src.application.cache_manager import CacheManager
+from src.application.chunk_size_probe import probe_chunk_size
+from src.application.congestion_controls import create_congestion_control
+from src.application.metrics import Metrics, MetricsExporter
+from src.application.piece_picker import create_piece_picker
+from src.application.piece_verifier import PieceVerifier
+from src.application.profiler import Profiler, StageTimers, HANDLE_PIECE, CHECK_CHUNK_STATE
+from src.application.resume import ResumeData
+from src.application.rtt_estimator import RttEstimator
+from src.application.stream_reader import StreamReader
 from src.domain.entity.piece.piece import Piece
-from src.domain.entity.piece.block import State
-from src.domain.entity.torrent import Torrent, Info, FileMode
+from src.domain.entity.piece.block_state import BlockStates
+from src.domain.entity.piece.buffer_pool import BufferPool
+from src.domain.entity.piece.merkle import merkle_pieces
+from src.domain.entity.piece.progress import DownloadProgress
+from src.domain.entity.layout import TorrentLayout
+from src.domain.entity.torrent import Torrent, Info
+from src.infrastructure.storage import Storage, PieceFileStorage, SingleFileStorage, FSYNC_NEVER
 
 from logger import logger
 
-CHUNK_SIZE = 1024 * 4
+try:
+    import cefpyco
+except ImportError:
+    # 模擬リンク(SimulatedHandle)だけで動かす場合はcefpycoが無くてもよい
+    cefpyco = None
+
+CHUNK_SIZE = 1024 * 4  # 既定のchunkの大きさ (この大きさのData名には大きさを含めない)
+MAX_CHUNK_SIZE = 64 * 1024
+NAME_PREFIX = "ccnx:/BitTorrent/"
+HASHES_COMPONENT = 'hashes'  # v2: pieceの葉のハッシュのData名 ccnx:/BitTorrent/<info_hash>/hashes/<piece_index>
 CACHE_PATH = os.environ['HOME'] + "/proxy_cache/"
-MAX_PEER_CONNECT = 1
-TIME_OUT = 4
-EVALUATION = True
+MAX_PEER_CONNECT = 4  # parallel エンジンのワーカー(CCN face)数
+TIME_OUT = 4  # RTOの上限
+VERIFY_WORKERS = 2
+VERIFY_QUEUE_SIZE = 32
+# listenerからrequesterへの受信通知をまとめる単位
+NOTIFY_BATCH = 256
+NOTIFY_INTERVAL = 0.005
+RECEIVE_TIMEOUT_MS = 1000
+VERIFY_POLL_MS = 5  # 検証中のpieceがある間は結果を待たせないよう受信待ちを短くする
+# ウィンドウが開くのを待つ上限 CUBICなどウィンドウが時間でも増えるため定期的に見直す
+WINDOW_INTERVAL = 0.01
+EVALUATION = True  # 終了時に evaluation_path (既定は EVALUATION_PATH) へ1行のJSONで結果を追記する
 EVALUATION_PATH = "/client/evaluation/ccn_client/test"
+METRICS_PATH = None  # 計測値をJSON linesで定期的に追記するファイル
+METRICS_PORT = None  # Prometheus形式の計測値を返すHTTPのポート
+METRICS_HOST = '127.0.0.1'  # METRICS_PORT を待ち受けるアドレス ('' なら全てのインターフェース)
+METRICS_GAUGE_INTERVAL = 0.1  # requester が cwnd などを書き込む間隔
+PROFILE_PATH = None  # サンプリングした結果を PROFILE_PATH + '.folded' に書き出す
+CONGESTION_CONTROL = 'cubic'
+STORAGE = 'single'  # single: 本来のファイルに書き込む / piece: pieceごとのファイル
+FSYNC = FSYNC_NEVER
+CACHE_BUDGET = None  # CACHE_PATH 以下の全torrentのpieceの合計の上限[byte] (Noneなら追い出さない)
+CACHE_POLICY = 'lru'  # lru / lfu
+PIECE_PICKER = 'sequential'  # sequential / random-first / rarest / streaming
+ENDGAME = True  # 全ブロック要求後、応答待ちのブロックのInterestを重複して送る
+ENDGAME_AGE = 1.5  # 送信からSRTTの何倍経ったブロックを重複して要求するか
+ENDGAME_BLOCKS = 64  # 応答待ちがこの数以下になってから重複して要求する
+
+
+def piece_name(info_hash: str, piece_index: int, chunk_size: int = CHUNK_SIZE) -> str:
+    """
+    pieceのData名 ccnx:/BitTorrent/<info_hash>/<piece_index>
+    既定以外のchunkの大きさでは ccnx:/BitTorrent/<info_hash>/<chunk_size>/<piece_index> として、
+    同じpieceでも大きさごとに別のDataにする
+    """
+    if chunk_size == CHUNK_SIZE:
+        return f'{NAME_PREFIX}{info_hash}/{piece_index}'
+    return f'{NAME_PREFIX}{info_hash}/{chunk_size}/{piece_index}'
+
+
+def hashes_name(info_hash: str, piece_index: int) -> str:
+    """
+    v2: pieceの葉(16KiB)のSHA-256を連結したDataの名前 (chunk 0 の1つのDataで運ぶ)
+    """
+    return f'{NAME_PREFIX}{info_hash}/{HASHES_COMPONENT}/{piece_index}'
+
+
+def parse_hashes_name(name: str) -> Optional[Tuple[str, int]]:
+    """
+    :return: (info_hash, piece_index) / 葉のハッシュのData名でなければNone
+    """
+    if not name.startswith(NAME_PREFIX):
+        return None
+    components = name[len(NAME_PREFIX):].split('/')
+    if len(components) != 3 or components[1] != HASHES_COMPONENT:
+        return None
+    try:
+        return components[0], int(components[2])
+    except ValueError:
+        return None
+
+
+def parse_piece_name(name: str) -> Optional[Tuple[str, int, int]]:
+    """
+    :return: (info_hash, chunk_size, piece_index) / pieceのData名でなければNone
+    """
+    if not name.startswith(NAME_PREFIX):
+        return None
+    components = name[len(NAME_PREFIX):].split('/')
+    try:
+        if len(components) == 2:
+            return components[0], CHUNK_SIZE, int(components[1])
+        if len(components) == 3:
+            chunk_size = int(components[1])
+            if 0 < chunk_size <= MAX_CHUNK_SIZE:
+                return components[0], chunk_size, int(components[2])
+    except ValueError:
+        pass
+    return None
 
 
 class Color:
@@ -47,78 +150,157 @@ class Color:
     RESET = '\033[0m'  # 全てリセット
 
 
-class MaxWindowSize(Exception):
-    pass
-
-
 class BitTorrent:
-    def __init__(self, torrent: Torrent):
+    def __init__(self, torrent: Torrent, congestion_control: str = CONGESTION_CONTROL, cef_handle=None,
+                 rehash: bool = False, storage: str = STORAGE, fsync: str = FSYNC,
+                 picker: str = PIECE_PICKER, endgame: bool = ENDGAME,
+                 metrics_path: str = METRICS_PATH, metrics_port: int = METRICS_PORT,
+                 profile_path: str = PROFILE_PATH,
+                 cache_budget: int = CACHE_BUDGET, cache_policy: str = CACHE_POLICY,
+                 chunk_size=CHUNK_SIZE, metrics_host: str = METRICS_HOST, evaluation_path: str = None):
         """
         トレントファイル解析
         ↓
         CCN Interest送信
         ↓
         CCN Data受信
+
+        :param chunk_size: 1つのInterest/Dataで運ぶ大きさ [byte] / 'auto' なら候補を実測して選ぶ
+        :param evaluation_path: 結果を追記するファイル / Noneなら EVALUATION_PATH
         """
         self.torrent = torrent
         self.info: Info = torrent.info
         self.info_hash = str(torrent.info_hash.hex())
         self.file_path = CACHE_PATH + self.info.name
 
-        self.name = "ccnx:/BitTorrent/" + self.info_hash
+        self.name = NAME_PREFIX + self.info_hash
 
         try:
             os.makedirs(self.file_path)
         except Exception as e:
             logger.error(e)
 
-        # number_of_pieces の計算
-        if torrent.file_mode == FileMode.single_file:
-            if self.info.length % self.info.piece_length == 0:
-                self.number_of_pieces = int(self.info.length / self.info.piece_length)
-            else:
-                self.number_of_pieces = int(self.info.length / self.info.piece_length) + 1
-        else:
-            length: int = 0
-            for file in self.info.files:
-                length += file.length
-            self.number_of_pieces = int(length / self.info.piece_length)
+        # pieceとファイルの対応表 number_of_pieces, 各pieceの大きさもここから求める
+        self.layout = TorrentLayout.from_torrent(torrent)
+        self.number_of_pieces = self.layout.number_of_pieces
+
+        # 渡されたハンドルは begin() 済みのものとして扱う (TorrentManager では複数のtorrentで共有する)
+        if cef_handle is None:
+            cef_handle = self.create_handle()
+        self.cef_handle = cef_handle
+
+        # ブロックの大きさ・Data名・受信時のオフセットは全てこの値から決まる
+        if chunk_size == 'auto':
+            chunk_size = self.tune_chunk_size()
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError(f"chunk size must be in (0, {MAX_CHUNK_SIZE}]: {chunk_size}")
+        self.chunk_size: int = chunk_size
+        # pieceごとのData名と、その逆引き (受信時は名前の辞書引き1回でpieceを決める)
+        self.piece_names = [piece_name(self.info_hash, i, chunk_size) for i in range(self.number_of_pieces)]
+        self.name_to_piece = {name: i for i, name in enumerate(self.piece_names)}
 
         self.bitfield: bitstring.BitArray = bitstring.BitArray(self.number_of_pieces)
+        # listener と requester の両プロセスから参照する共有テーブル
+        self.block_states = BlockStates(self.layout.piece_sizes(), chunk_size, shared=True)
+        self.buffer_pool = BufferPool()
+        self.storage = self._create_storage(storage, fsync)
+        # v2 (BEP 52) のtorrentはpieceごとのmerkle treeで検証する / v1のみならNone
+        self.merkle = merkle_pieces(torrent, self.layout)
         self.pieces = self._generate_pieces()
-        self.num_of_all_of_blocks = 0
-        for piece in self.pieces:
-            for _ in piece.blocks:
-                self.num_of_all_of_blocks += 1
+        # v2: 葉のハッシュのData名の逆引きと、pieceごとに要求済みか (requester が最初のInterestと一緒に送る)
+        self.name_to_hashes = {} if self.merkle is None else \
+            {hashes_name(self.info_hash, i): i for i in range(self.number_of_pieces)}
+        self.hashes_requested = bytearray(self.number_of_pieces)
+        self.num_of_all_of_blocks = len(self.block_states)
+        # 完了判定と進捗表示は全pieceを見ずにこのカウンタで行う (requester からも読む)
+        self.completion = DownloadProgress(self.block_states, self.progress_writers(), shared=True)
 
-        self.cef_handle = cefpyco.CefpycoHandle()
-        self.cef_handle.begin()
+        self.complete_pieces = 0
 
-        self.cubic = Cubic()
+        # ダウンロード中のtorrentのpieceは他のダウンロードからも追い出されない
+        # resumeを読む前に pin するので、読んだ後に他のプロセスが追い出したpieceを完了扱いのまま持つことは無い
+        # (pin する前に追い出されたpieceは、追い出したプロセスがresumeファイルからも外している)
+        self.cache = CacheManager(CACHE_PATH, cache_budget, cache_policy)
+        self.cache.register(self.info_hash, self.info.name, storage, self.layout)
+        self.cache.pin(self.info_hash)
+
+        # 前回までに書き込んだpieceは要求しない
+        self.resume = ResumeData(self.file_path, self.info_hash, self.storage)
+        trusted = self.resume.fast_check(self.pieces, rehash)
+        for piece in trusted:
+            piece.set_exist()
+            self.bitfield[piece.piece_index] = 1
+            self.complete_pieces += 1
+            self.completion.restore(piece.piece_index)
+        self.resume.save()
+        self.cache.sync(self.info_hash, [(piece.piece_index, piece.piece_size) for piece in trusted])
+        if self.complete_pieces > 0:
+            logger.info(f"resume: {self.complete_pieces} / {self.number_of_pieces} pieces")
+
+        self.congestion_control = create_congestion_control(congestion_control, RttEstimator(max_rto=TIME_OUT))
+        self.picker_name = picker
+        self.picker = create_piece_picker(picker, self.number_of_pieces)
+        self.scheduler = BlockScheduler(self.block_states, self.congestion_control.rtt.rto, self.picker)
+        self.endgame = endgame
 
-        self.compete_block = 0
-        self.complete_pieces = 0
         self.started_time = None
 
+        # listener -> requester の通知
+        #   ('get', (受信したglobal block indexの配列, 受信時刻の配列)) / ('error', piece_index)
+        #   ('error_blocks', (piece_index, [block_index, ...])) v2で葉の検証に失敗したブロック
+        #   ('cursor', piece_index)
         self.queue = multiprocessing.Queue()
+        self.received = array('q')
+        self.received_times = array('d')
+        self.last_notified_time = 0
+        self.verifier = None
+
+        # StreamReader への完了通知
+        self.piece_completed = threading.Condition()
+        self.stopped = False
+
+        # listener と requester が別々の値を書き込む
+        self.metrics = Metrics(shared=True)
+        self.metrics_path = metrics_path
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.exporter = None
+        self.profile_path = profile_path
+        self.profiler = None
+        self.evaluation_path = evaluation_path if evaluation_path is not None else EVALUATION_PATH
 
     def run(self):
         req_p = None
         try:
+            self.create_profiler(processes=2)
             self.started_time = time.time()
             req_p = multiprocessing.Process(target=self.request_piece_handle)
             req_p.start()
 
+            # 検証ワーカーとHTTPサーバーは子プロセスには不要なのでfork後に起動する
+            self.start_profile('listener', 0)
+            self.verifier = PieceVerifier(VERIFY_WORKERS, VERIFY_QUEUE_SIZE, self.stage_timers)
+            self.start_metrics()
             self.cef_listener()
+            self.verifier.close()
+            self.handle_verified_pieces()
+            self.save_resume()
+            self.storage.close()
+            self.cache.unpin(self.info_hash)
 
             logger.info(f'download time: {(time.time() - self.started_time):.2f}')
+            self.finish_profile(children=1)
+            self.stop_metrics()
         except Exception as e:
             logger.error(e)
             raise e
         except KeyboardInterrupt:
             return
         finally:
-            req_p.kill()
+            if req_p is not None:
+                req_p.kill()
+                req_p.join()
+            self.notify_piece_completed(stopped=True)
 
     def cef_listener(self):
         logger.debug("start cef listener")
@@ -127,118 +309,415 @@ class BitTorrent:
             while not self.all_pieces_completed():
                 if time.time() - last_seen_time > 1:
                     self.print_progress()
+                    self.save_resume()
+                    self.report_metrics()
                     last_seen_time = time.time()
 
-                info = self.cef_handle.receive(timeout_ms=1000)
-                # logger.debug(f"{info.name}, {info.chunk_num}")
-                if info.is_succeeded and info.is_data:
-                    prefix = info.name.split('/')
-                    if prefix[0] != 'ccnx:':
-                        logger.debug("incorrect prefix")
-                        continue
-                    if prefix[1] != 'BitTorrent':
-                        logger.debug("incorrect protocol")
-                        continue
-                    if prefix[2] != self.info_hash:
-                        logger.debug(f"incorrect info_hash: {prefix[2]}:{self.info_hash}")
-                        continue
-                    # logger.debug(f"{info.name}, {info.chunk_num}")
-                    self.handle_piece(info)
-                    # self.bittorrent.print_progress()
+                if time.time() - self.last_notified_time > NOTIFY_INTERVAL:
+                    self.notify_received()
+
+                # 1回起きたら届いている分を全て処理する
+                timeout_ms = VERIFY_POLL_MS if self.verifier.in_flight else RECEIVE_TIMEOUT_MS
+                if len(self.received) > 0:
+                    # まだ通知していない受信があるうちは通知の間隔より長く待たない
+                    timeout_ms = min(timeout_ms, int(NOTIFY_INTERVAL * 1000) + 1)
+                info = self.cef_handle.receive(timeout_ms=timeout_ms)
+                while info.is_succeeded:
+                    self.handle_data(info)
+                    info = self.cef_handle.receive(timeout_ms=0)
+
+                # 完了の判定より前に検証結果を反映する
+                self.handle_verified_pieces()
         except Exception as e:
             logger.error(e)
         except KeyboardInterrupt:
             return
 
+    def handle_data(self, info):
+        if not (info.is_succeeded and info.is_data):
+            return
+        piece_index = self.name_to_piece.get(info.name)
+        if piece_index is None:
+            piece_index = self.name_to_hashes.get(info.name)
+            if piece_index is not None:
+                self.handle_leaf_hashes(info, piece_index)
+                return
+            logger.debug(f"unexpected name: {info.name}")
+            return
+        self.handle_piece(info, piece_index)
+
     def request_piece_handle(self):
         logger.debug("requester is start")
+        self.start_profile('requester', 1)
         last_time = time.time()
+        message = None
         while not self.all_pieces_completed():
-            self.check_chunk_state()
+            self.check_chunk_state(message)
 
-            if time.time() - last_time > 1:
-                print(f'{Color.BG_BLUE}cubic_window: {int(self.cubic.cwind)}, now_window: {self.cubic.now_wind}{Color.RESET}')
+            if time.time() - last_time > METRICS_GAUGE_INTERVAL:
+                self.update_gauges()
                 last_time = time.time()
 
-            def send_piece_interest():
-                for piece in self.pieces:
-                    piece_index = piece.piece_index
+            message = None
+            if self.send_piece_interest() == 0:
+                # 送れるものが無い間は通知かタイムアウトの確認時刻まで眠る
+                message = self.wait_chunk_state()
 
-                    for block_index, block in enumerate(piece.blocks):
+        if self.profiler is not None:
+            # 親に kill される前にサンプルを送っておく
+            self.profiler.stop()
 
-                        if self.cubic.now_wind > self.cubic.cals_cwind():
-                            raise MaxWindowSize()
+    def send_piece_interest(self) -> int:
+        return self.send_interests(math.ceil(self.congestion_control.window - self.congestion_control.now_wind))
 
-                        if block.state == State.FREE:
-                            self.cef_handle.send_interest(
-                                name=self.name + '/' + str(piece_index),
-                                chunk_num=block_index
-                            )
-                            # logger.debug(f"piece_index: {piece_index}, chunk: {block_index}")
-                            piece.blocks[block_index].state = State.PENDING
-                            piece.blocks[block_index].last_seen = time.time()
-                            self.cubic.now_wind += 1
-                            # logger.debug(f"Send interest: {piece_index}, {chunk_num}")
+    def send_interests(self, limit: int) -> int:
+        """
+        最大 limit 個のInterestを送る
+        :return: 送った数 (要求するブロックが無くなれば limit より少ない)
+        """
+        if limit <= 0:
+            return 0
+        self.scheduler.time_out = self.congestion_control.rtt.rto
+        now = time.time()
+        sent = 0
+        for piece_index, block_indexes in self.scheduler.next_blocks(now, limit):
+            self.send_burst(piece_index, block_indexes)
+            sent += len(block_indexes)
+
+        if self.endgame and sent < limit and self.scheduler.num_of_pending <= ENDGAME_BLOCKS:
+            min_age = self.congestion_control.rtt.smoothed * ENDGAME_AGE
+            duplicated = 0
+            while sent < limit:
+                block = self.scheduler.duplicate_block(now, min_age)
+                if block is None:
+                    break
+                piece_index, block_index = block
+                self.send_burst(piece_index, [block_index])
+                sent += 1
+                duplicated += 1
+            self.metrics.values[m.ENDGAME_INTERESTS] += duplicated
+
+        if sent > 0:
+            self.congestion_control.on_send(sent)
+            self.metrics.values[m.INTERESTS] += sent
+        return sent
+
+    def send_burst(self, piece_index: int, block_indexes: List[int]):
+        """
+        1つのpieceの複数のブロックへのInterestをまとめて送る
+        ハンドルが send_interests を持っていれば1回の呼び出しで送る
+        """
+        name = self.piece_names[piece_index]
+        if self.merkle is not None and not self.hashes_requested[piece_index]:
+            # 葉のハッシュはpieceのブロックより先に届くよう最初のInterestの前に要求する
+            self.hashes_requested[piece_index] = 1
+            self.cef_handle.send_interest(name=hashes_name(self.info_hash, piece_index), chunk_num=0)
+        send_interests = getattr(self.cef_handle, 'send_interests', None)
+        if send_interests is not None:
+            send_interests(name, block_indexes)
+            return
+        for block_index in block_indexes:
+            self.cef_handle.send_interest(name=name, chunk_num=block_index)
 
-            try:
-                send_piece_interest()
-            except MaxWindowSize:
-                pass
+    def wait_chunk_state(self) -> Optional[tuple]:
+        """
+        listener からの通知を、次のdeadlineまで (WINDOW_INTERVAL を上限に) 待つ
+        :return: 受け取った通知 / 来なければNone
+        """
+        timeout = WINDOW_INTERVAL
+        deadline = self.scheduler.next_deadline()
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.time())
+        if timeout <= 0:
+            return None
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
 
-    def check_chunk_state(self):
-        while self.queue.qsize() > 0:
-            (piece_index, block_index, state) = self.queue.get()
-            piece = self.pieces[piece_index]
+    def check_chunk_state(self, message: tuple = None):
+        """
+        :param message: wait_chunk_state で受け取った通知 残りはキューから読めるだけ読む
+        """
+        while True:
+            if message is None:
+                try:
+                    message = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            (state, value), message = message, None
 
             if state == 'get':
-                block = piece.blocks[block_index]
-                block.state = State.FULL
-                block.last_seen = time.time()
+                for rtt in self.scheduler.received(*value):
+                    self.on_rtt_sample(rtt)
             elif state == 'error':
-                for block in piece.blocks:
-                    block.state = State.FREE
-                    block.last_seen = time.time()
-
-        pending_chunk_num = 0
-        for piece in self.pieces:
-            if piece.is_full:
-                continue
-
-            for block in piece.blocks:
-                if block.state == State.PENDING:
-                    if time.time() - block.last_seen > TIME_OUT:
-                        block.state = State.FREE
-                        block.last_seen = time.time()
-                        self.cubic.last_time_loss = time.time()
-                        self.cubic.w_max = self.cubic.cwind
-                    else:
-                        pending_chunk_num += 1
-
-        self.cubic.now_wind = pending_chunk_num
-
-    def handle_piece(self, info):
-        piece_index = int(info.name.split('/')[3])
+                # 葉のハッシュが届かずpiece全体で検証に失敗した場合なので、再要求と一緒に要求し直す
+                self.hashes_requested[value] = 0
+                self.scheduler.reset_piece(value, time.time())
+            elif state == 'error_blocks':
+                self.scheduler.reset_blocks(*value, time.time())
+            elif state == 'cursor':
+                self.picker.set_cursor(value)
+
+        expired = self.scheduler.expire(time.time())
+        if expired:
+            self.on_loss(len(expired))
+
+        self.congestion_control.now_wind = self.scheduler.num_of_pending
+
+    def set_stream_cursor(self, piece_index: int):
+        """
+        StreamReader の読み出し位置を requester の piece picker へ渡す
+        """
+        self.queue.put(('cursor', piece_index))
+
+    def open_stream(self, file_index: int = None, timeout: float = None) -> StreamReader:
+        """
+        検証済みのデータから順に読めるファイルオブジェクト (run() は別スレッドで動かす)
+        """
+        return StreamReader(self, file_index, timeout)
+
+    def wait_for_piece(self, piece_index: int, timeout: float = None):
+        with self.piece_completed:
+            if not self.piece_completed.wait_for(lambda: self.bitfield[piece_index] or self.stopped, timeout):
+                raise TimeoutError(f"piece {piece_index} is not downloaded yet")
+        if not self.bitfield[piece_index]:
+            raise IOError(f"download stopped before piece {piece_index}")
+
+    def on_piece_completed(self, piece: Piece):
+        """
+        検証・書き込みが終わったpieceを記録する
+        """
+        self.bitfield[piece.piece_index] = 1
+        self.complete_pieces += 1
+        self.completion.complete(piece.piece_index)
+        self.metrics.values[m.PIECES] += 1
+        self.resume.add(piece)
+        self.cache.add(self.info_hash, piece.piece_index, piece.piece_size)
+        self.notify_piece_completed()
+
+    def save_resume(self):
+        """
+        resumeファイルと、完了したpieceのキャッシュの索引への追加をまとめて書き出す (1秒ごとと終了時)
+        """
+        self.resume.save()
+        self.cache.flush()
+
+    def notify_piece_completed(self, stopped: bool = False):
+        with self.piece_completed:
+            self.stopped = self.stopped or stopped
+            self.piece_completed.notify_all()
+
+    def on_rtt_sample(self, rtt):
+        """
+        :param rtt: 再送したブロックなどサンプルに使えない場合はNone
+        """
+        self.congestion_control.on_data(rtt)
+        if rtt is not None:
+            self.metrics.observe_rtt(rtt)
+
+    def on_loss(self, count: int = 1):
+        self.metrics.values[m.TIMEOUTS] += count
+        self.congestion_control.on_timeout()
+
+    def handle_piece(self, info, piece_index: int):
         payload = info.payload
         chunk_num = info.chunk_num
 
-        offset = chunk_num * CHUNK_SIZE
+        offset = chunk_num * self.chunk_size
         piece = self.pieces[piece_index]
         block_index = chunk_num
+        self.metrics.values[m.DATA] += 1
 
-        if piece.is_full:
+        if piece.is_full or not piece.set_block(offset=offset, data=payload):
+            self.metrics.values[m.DUPLICATE_DATA] += 1
             return
 
-        piece.set_block(offset=offset, data=payload)
+        self.completion.add_block(len(payload))
+        if piece.merkle is not None:
+            # v2: 葉のハッシュが届いていれば、このブロックで揃った葉を検証する
+            failed = piece.check_block(block_index)
+            if failed:
+                self.on_blocks_failed(piece, failed, block_index)
+                return
+        self.on_block_received(piece, block_index)
+
+    def handle_leaf_hashes(self, info, piece_index: int):
+        """
+        v2: 届かない・壊れている場合はpiece全体を merkle tree の根で検証する
+        """
+        piece = self.pieces[piece_index]
+        if piece.is_full or piece.leaf_hashes is not None:
+            return
+        failed = piece.set_leaf_hashes(info.payload)
+        if failed:
+            self.on_blocks_failed(piece, failed)
 
-        if piece.are_all_blocks_full():
-            if piece.set_to_full():
-                self.bitfield[piece_index] = 1
-                self.complete_pieces += 1
-                piece.write_on_disk()
+    def on_blocks_failed(self, piece: Piece, block_indexes: List[int], block_index: int = None):
+        """
+        v2: 葉の検証に失敗してFREEに戻したブロックだけを requester に再要求させる
+        :param block_index: 受信した直後に失敗が分かったブロック 応答待ちから外すため受信は通知する
+        """
+        self.metrics.values[m.BLOCK_FAILURES] += len(block_indexes)
+        self.completion.remove_blocks(len(block_indexes))
+        if block_index is not None:
+            self.received.append(self.block_states.global_index(piece.piece_index, block_index))
+            self.received_times.append(time.time())
+        # 'error_blocks' より前に受信したブロックの通知を届けておく
+        self.notify_received()
+        self.queue.put(('error_blocks', (piece.piece_index, block_indexes)))
+
+    def on_block_received(self, piece: Piece, block_index: int):
+        piece_index = piece.piece_index
+        if not piece.in_verification and piece.are_all_blocks_full():
+            # SHA-1検証と書き込みはワーカーで行い、結果は handle_verified_pieces で受け取る
+            piece.in_verification = True
+            self.verifier.submit(piece)
+
+        self.received.append(self.block_states.global_index(piece_index, block_index))
+        self.received_times.append(time.time())
+        if len(self.received) >= NOTIFY_BATCH:
+            self.notify_received()
+
+    def notify_received(self):
+        if len(self.received) > 0:
+            self.queue.put(('get', (self.received, self.received_times)))
+            self.received = array('q')
+            self.received_times = array('d')
+        self.last_notified_time = time.time()
+
+    def handle_verified_pieces(self):
+        for piece, ok in self.verifier.results():
+            piece.in_verification = False
+            if ok:
+                self.on_piece_completed(piece)
+            elif piece.failed_blocks is not None:
+                self.on_blocks_failed(piece, piece.failed_blocks)
             else:
-                self.queue.put((piece_index, None, "error"))
-                return
-        self.queue.put((piece_index, block_index, "get"))
+                # 書き込みの失敗も piece.reset() 済みなのでハッシュの失敗と同じく全体を再要求する
+                self.metrics.values[m.WRITE_FAILURES if piece.write_error else m.HASH_FAILURES] += 1
+                self.completion.remove_blocks(piece.number_of_blocks)
+                # 'error' より前に受信したブロックの通知を届けておく
+                self.notify_received()
+                self.queue.put(('error', piece.piece_index))
+
+    def update_gauges(self):
+        """
+        送信側の値 (process エンジンでは requester が書く)
+        """
+        values = self.metrics.values
+        rtt = self.congestion_control.rtt
+        values[m.CWND] = self.congestion_control.window
+        values[m.PENDING] = self.scheduler.num_of_pending
+        values[m.RTO] = rtt.rto
+        values[m.SRTT] = rtt.srtt or 0
+
+    def collect_metrics(self) -> Metrics:
+        """
+        受信側の値を書き込んでから返す
+        """
+        values = self.metrics.values
+        if self.verifier is not None:
+            values[m.VERIFY_QUEUE] = self.verifier.queue_depth
+            values[m.VERIFY_LATENCY] = self.verifier.verify_latency
+            values[m.WRITE_LATENCY] = self.verifier.write_latency
+        try:
+            values[m.NOTIFY_QUEUE] = self.queue.qsize()
+        except NotImplementedError:
+            pass
+        return self.metrics
+
+    def start_metrics(self):
+        if self.metrics_path is not None or self.metrics_port is not None:
+            self.exporter = MetricsExporter([(self.collect_metrics, {'torrent': self.info.name})],
+                                            self.metrics_path, self.metrics_port, self.metrics_host)
+
+    def report_metrics(self):
+        if self.exporter is not None:
+            self.exporter.export()
+
+    def stop_metrics(self):
+        if self.exporter is not None:
+            self.exporter.close()
+            self.exporter = None
+        if EVALUATION:
+            self.write_evaluation()
+
+    def write_evaluation(self):
+        """
+        1回のダウンロードの結果を evaluation_path に1行のJSONで追記する
+        """
+        elapsed = time.time() - self.started_time
+        record = {
+            'time': time.time(),
+            'torrent': self.info.name,
+            'info_hash': self.info_hash,
+            'engine': type(self).__name__,
+            'congestion_control': self.congestion_control.name,
+            'picker': self.picker_name,
+            'length': self.layout.length,
+            'elapsed': elapsed,
+            'throughput_mbps': self.layout.length * 8 / elapsed / 1024 ** 2,
+            **self.collect_metrics().snapshot(),
+        }
+        try:
+            directory = os.path.dirname(self.evaluation_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.evaluation_path, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+        except OSError as e:
+            logger.warning(f"failed to write evaluation: {e}")
+
+    def create_profiler(self, processes: int):
+        """
+        --profile 時のみ fork より前に作る
+        :param processes: サンプリングするプロセス数 (親を含む)
+        """
+        if self.profile_path is not None:
+            self.profiler = Profiler(self.profile_path, processes)
+
+    @property
+    def stage_timers(self) -> StageTimers:
+        return self.profiler.stages if self.profiler is not None else None
+
+    def start_profile(self, role: str, slot: int):
+        """
+        fork後の各プロセスで呼ぶ プロファイル時だけステージ計測用のラッパーに差し替える
+        """
+        if self.profiler is None:
+            return
+        self.profiler.start(role, slot)
+        self.time_stages()
+
+    def time_stages(self):
+        stages = self.profiler.stages
+        self.handle_piece = stages.timed(HANDLE_PIECE, self.handle_piece)
+        self.check_chunk_state = stages.timed(CHECK_CHUNK_STATE, self.check_chunk_state)
+
+    def finish_profile(self, children: int = 0):
+        if self.profiler is not None:
+            self.profiler.finish(children)
+
+    def tune_chunk_size(self, cef_handle=None) -> int:
+        """
+        chunk_size='auto' の時に候補の大きさを実測して選ぶ
+        """
+        return probe_chunk_size(cef_handle or self.cef_handle, self.layout.piece_sizes(),
+                                lambda i, size: piece_name(self.info_hash, i, size), default=CHUNK_SIZE)
+
+    @staticmethod
+    def create_handle():
+        if cefpyco is None:
+            raise RuntimeError("cefpyco is not installed: pass a cef_handle (e.g. SimulatedLink.handle())")
+        cef_handle = cefpyco.CefpycoHandle()
+        cef_handle.begin()
+        return cef_handle
+
+    def _create_storage(self, storage: str, fsync: str) -> Storage:
+        if storage == 'piece':
+            return PieceFileStorage(self.file_path, self.info.piece_length, fsync)
+        return SingleFileStorage(self.file_path, self.layout, fsync)
 
     def _generate_pieces(self) -> List[Piece]:
         """
@@ -246,42 +725,43 @@ class BitTorrent:
         :return: List[Piece]
         """
         pieces: List[Piece] = []
-        last_piece = self.number_of_pieces - 1
-
-        for i in range(self.number_of_pieces):
-            start = i * 20
-            end = start + 20
 
-            if i == last_piece:
-                piece_length = self.info.length - (self.number_of_pieces - 1) * self.info.piece_length
-                pieces.append(Piece(i, piece_length, self.info.pieces[start:end], self.file_path))
-            else:
-                pieces.append(Piece(i, self.info.piece_length, self.info.pieces[start:end], self.file_path))
+        # v2のみのtorrentにはSHA-1が無い
+        piece_hashes = getattr(self.info, 'piece_hashes', None) or [None] * self.number_of_pieces
+        merkle = self.merkle or [None] * self.number_of_pieces
+        for i, (piece_length, piece_hash) in enumerate(zip(self.block_states.piece_sizes, piece_hashes)):
+            pieces.append(Piece(i, piece_length, piece_hash, self.storage,
+                                self.block_states.piece(i), self.buffer_pool, merkle[i]))
         return pieces
 
-    def all_pieces_completed(self) -> bool:
-        for piece in self.pieces:
-            if not piece.is_full:
-                return False
-        return True
+    def progress_writers(self) -> int:
+        """
+        DownloadProgress のカウンタに書き込むプロセス数
+        """
+        return 1
 
-    last_bock_num = 0
+    def all_pieces_completed(self) -> bool:
+        return self.completion.is_complete()
 
     def print_progress(self):
-        block_num = 0
-        for piece in self.pieces:
-            for block in piece.blocks:
-                if block.state == State.FULL:
-                    block_num += 1
-
-        progress = (block_num / (self.num_of_all_of_blocks + 1)) * 100
-        throughput = ((block_num - self.last_bock_num) * CHUNK_SIZE * 8) / 1024 ** 2
-        self.last_bock_num = block_num
-        # throughput = (block_num * CHUNK_SIZE * 8 / (time.time() - self.started_time)) / 1024 ** 2
+        completion = self.completion
+        block_num = completion.blocks
+        metrics = self.collect_metrics()
+
+        progress = (block_num / self.num_of_all_of_blocks) * 100
+        throughput = completion.update_rate(time.time()) * 8 / 1024 ** 2
+        eta = completion.eta
         print(f"{Color.GREEN}"
-              f"[piece: {self.complete_pieces} / {self.number_of_pieces}]"
-              f"[block: {block_num} / {self.num_of_all_of_blocks + 1}, "
+              f"[piece: {completion.pieces} / {self.number_of_pieces}]"
+              f"[block: {block_num} / {self.num_of_all_of_blocks}, "
               f"{progress:.2f}%], "
-              f"[Throughput: {throughput:.2f}Mbps]"
+              f"[Throughput: {throughput:.2f}Mbps, ETA: {'-' if eta is None else f'{eta:.1f}s'}]"
+              f"[cwnd: {int(metrics.values[m.CWND])}, rto: {metrics.values[m.RTO] * 1000:.0f}ms]"
+              f"{self.verify_progress()}"
               f"{Color.RESET}")
-        print(self.bitfield)
+
+    def verify_progress(self) -> str:
+        if self.verifier is None:
+            return ''
+        return (f"[verify queue: {self.verifier.queue_depth}, "
+                f"latency: {self.verifier.verify_latency * 1000:.1f}ms]")
@@ -0,0 +1,269 @@
+import heapq
+from bisect import bisect_right
+from array import array
+from collections import deque
+from typing import Deque, Iterable, List, Optional, Set, Tuple
+
+from src.application.piece_picker import PiecePicker, SequentialPicker
+from src.domain.entity.piece.block import State
+from src.domain.entity.piece.block_state import BlockStates
+
+
+class BlockScheduler:
+    """
+    ブロック単位のInterest送信スケジューラ
+
+    FREE    - pieceごとのdequeと、FREEブロックを持つpieceの PiecePicker
+              (タイムアウト・検証失敗で戻ったpieceは picker より優先する)
+    PENDING - deadline順のヒープ(遅延削除)と応答待ちの集合
+    FULL    - BlockStates を読むだけ
+
+    次に送るブロックの選択もタイムアウト処理も、torrent全体ではなく
+    実際に処理したブロック数に比例するコストで済む。
+    BlockStates の状態バイトには書き込まない (FREE/FULL は listener だけが書く)。
+    PENDING と送信時刻はこのオブジェクトの中だけに持つので、受信済みのFULLを上書きすることは無い。
+
+    picker が observes なら、応答のRTTとタイムアウトを piece ごとに picker へ渡す (rarest-first の推定に使う)
+
+    endgame - 全ブロックを要求済みになったら、応答待ちのブロックを送信の古い順に1回ずつ再要求する
+              (最後の数pieceでInterestが1つ失われた時にRTOまで待たずに済む)
+    """
+
+    def __init__(self, block_states: BlockStates, time_out: float, picker: PiecePicker = None,
+                 pieces: Iterable[int] = None):
+        """
+        :param pieces: 要求するpiece (複数のワーカーでpieceを分担する場合) / Noneなら全て
+        """
+        self.block_states = block_states
+        self.time_out = time_out
+
+        number_of_pieces = len(block_states.piece_sizes)
+        if picker is None:
+            picker = SequentialPicker(number_of_pieces)
+        # FREEブロックを持つpiece
+        self.picker = picker
+        # pieceごとのFREEブロック
+        self._free: List[Deque[int]] = [deque() for _ in range(number_of_pieces)]
+        # タイムアウト・検証失敗でFREEブロックが戻ったpiece
+        self._retry: Deque[int] = deque()
+        self._in_retry: List[bool] = [False] * number_of_pieces
+        # (deadline, piece_index, block_index, sent_at)
+        self._pending: List[Tuple[float, int, int, float]] = []
+        # 応答待ちブロック(PENDING)のglobal block index
+        self._in_flight: Set[int] = set()
+        # ブロックごとの最後の送信時刻 (RTTの計算と、ヒープの古いエントリの判定に使う)
+        self._sent_at = array('d', bytes(8 * len(block_states)))
+        # タイムアウトして再送したブロック RTTサンプルに使わない(Karn's algorithm)
+        self._retransmitted: Set[int] = set()
+        # endgameで再要求する候補 (piece_index, block_index, sent_at) 送信順
+        self._endgame: Optional[Deque[Tuple[int, int, float]]] = None
+
+        states = block_states.states
+        offsets = block_states.offsets
+        for piece_index in (range(number_of_pieces) if pieces is None else pieces):
+            start = offsets[piece_index]
+            free = self._free[piece_index]
+            free.extend(i for i in range(offsets[piece_index + 1] - start) if states[start + i] != State.FULL)
+            if free:
+                self.picker.add(piece_index)
+
+    @property
+    def num_of_pending(self) -> int:
+        return len(self._in_flight)
+
+    def next_deadline(self) -> Optional[float]:
+        """
+        最も早いdeadline(受信済みの古いエントリを含むことがある)
+        """
+        return self._pending[0][0] if self._pending else None
+
+    def next_block(self, now: float) -> Optional[Tuple[int, int]]:
+        """
+        次に要求するブロックをPENDINGにして返す
+        :return: (piece_index, block_index) / FREEブロックが無ければNone
+        """
+        runs = self.next_blocks(now, 1)
+        if not runs:
+            return None
+        piece_index, block_indexes = runs[0]
+        return piece_index, block_indexes[0]
+
+    def next_blocks(self, now: float, limit: int) -> List[Tuple[int, List[int]]]:
+        """
+        次に要求する最大 limit 個のブロックを同じ時刻でPENDINGにして返す
+        :return: pieceごとにまとめた (piece_index, [block_index, ...]) のリスト
+        """
+        states = self.block_states.states
+        sent_at = self._sent_at
+        offsets = self.block_states.offsets
+        pending = self._pending
+        in_flight = self._in_flight
+        endgame = self._endgame
+        deadline = now + self.time_out
+
+        runs = []
+        count = 0
+        while count < limit:
+            piece_index = self._next_piece()
+            if piece_index is None:
+                break
+            free = self._free[piece_index]
+            start = offsets[piece_index]
+
+            block_indexes = []
+            while free and count < limit:
+                block_index = free.popleft()
+                g = start + block_index
+                if g in in_flight or states[g] == State.FULL:
+                    continue
+
+                sent_at[g] = now
+                heapq.heappush(pending, (deadline, piece_index, block_index, now))
+                in_flight.add(g)
+                if endgame is not None:
+                    endgame.append((piece_index, block_index, now))
+                block_indexes.append(block_index)
+                count += 1
+
+            if block_indexes:
+                runs.append((piece_index, block_indexes))
+            if not free:
+                self.picker.remove(piece_index)
+        return runs
+
+    def _next_piece(self) -> Optional[int]:
+        while self._retry:
+            piece_index = self._retry[0]
+            if self._free[piece_index]:
+                return piece_index
+            self._retry.popleft()
+            self._in_retry[piece_index] = False
+        return self.picker.peek()
+
+    def duplicate_block(self, now: float, min_age: float = 0) -> Optional[Tuple[int, int]]:
+        """
+        endgame: FREEブロックが無い時に、送信から min_age 以上経った応答待ちのブロックを1つ選んで再要求させる
+        同じ送信に対する再要求は1回だけ。deadlineは元の送信のまま。
+        :return: (piece_index, block_index) / 候補が無ければNone
+        """
+        if self._endgame is None:
+            entries = sorted(self._pending, key=lambda entry: entry[3])
+            self._endgame = deque((piece_index, block_index, sent_at)
+                                  for _, piece_index, block_index, sent_at in entries)
+
+        states = self.block_states.states
+        offsets = self.block_states.offsets
+        endgame = self._endgame
+        while endgame:
+            piece_index, block_index, sent_at = endgame[0]
+            if now - sent_at < min_age:
+                return None
+            endgame.popleft()
+            g = offsets[piece_index] + block_index
+            if not self._is_pending(g, sent_at) or states[g] == State.FULL:
+                continue
+            # どちらのInterestへの応答か分からないのでRTTサンプルに使わない
+            self._retransmitted.add(g)
+            return piece_index, block_index
+        return None
+
+    def set_full(self, piece_index: int, block_index: int, now: float) -> Tuple[bool, Optional[float]]:
+        """
+        受信したブロックを応答待ちから外す (FULLは Piece.set_block が書き込み済み)
+        :return: (応答待ちだったか, RTTサンプル)
+        """
+        return self._ack(self.block_states.global_index(piece_index, block_index), now)
+
+    def received(self, global_indexes, received_times) -> List[Optional[float]]:
+        """
+        listener から通知された受信済みブロックを応答待ちから外す
+        状態(FULL)は listener が共有テーブルに書き込み済みなので触らない
+        :return: 応答待ちだったブロックのRTTサンプル(使えないものはNone)
+        """
+        samples = []
+        for g, received_time in zip(global_indexes, received_times):
+            acked, rtt = self._ack(g, received_time)
+            if acked:
+                samples.append(rtt)
+        return samples
+
+    def _ack(self, g: int, now: float) -> Tuple[bool, Optional[float]]:
+        if g not in self._in_flight:
+            return False, None
+        self._in_flight.discard(g)
+
+        if g in self._retransmitted:
+            self._retransmitted.discard(g)
+            return True, None
+        rtt = now - self._sent_at[g]
+        if self.picker.observes:
+            self.picker.on_response(bisect_right(self.block_states.offsets, g) - 1, rtt)
+        return True, rtt
+
+    def _is_pending(self, g: int, sent_at: float) -> bool:
+        """
+        ヒープ・endgameのエントリが今も応答待ちの送信を指しているか (受信済み・再送済みなら古い)
+        """
+        return g in self._in_flight and self._sent_at[g] == sent_at
+
+    def reset_piece(self, piece_index: int, now: float):
+        """
+        ハッシュ検証に失敗したpieceの全ブロックを要求し直す
+        (状態バイトは listener が Piece.reset などでFREEに戻し済み その後に届いたFULLは送信時に読み飛ばす)
+        """
+        blocks = self.block_states.piece(piece_index)
+        self._in_flight.difference_update(range(blocks.start, blocks.end))
+        self._retransmitted.difference_update(range(blocks.start, blocks.end))
+
+        free = self._free[piece_index]
+        free.clear()
+        free.extend(range(len(blocks)))
+        self._push_retry(piece_index)
+
+    def reset_blocks(self, piece_index: int, block_indexes: List[int], now: float):
+        """
+        v2で葉の検証に失敗したブロックだけを要求し直す (状態バイトは listener がFREEに戻し済み)
+        """
+        start = self.block_states.offsets[piece_index]
+        for block_index in block_indexes:
+            g = start + block_index
+            self._in_flight.discard(g)
+            self._retransmitted.discard(g)
+        self._free[piece_index].extendleft(reversed(block_indexes))
+        self._push_retry(piece_index)
+
+    def expire(self, now: float) -> List[Tuple[int, int]]:
+        """
+        deadlineを過ぎたPENDINGブロックをFREEに戻す
+        :return: タイムアウトした (piece_index, block_index) のリスト
+        """
+        states = self.block_states.states
+        offsets = self.block_states.offsets
+
+        expired = []
+        pending = self._pending
+        while pending and pending[0][0] <= now:
+            _, piece_index, block_index, sent_at = heapq.heappop(pending)
+            g = offsets[piece_index] + block_index
+            # 受信済み・再送済みのエントリは読み捨てる
+            # FULLで応答待ちのままのブロックは受信の通知が届く途中なので、タイムアウトにしない
+            if not self._is_pending(g, sent_at) or states[g] == State.FULL:
+                continue
+
+            self._in_flight.discard(g)
+            self._retransmitted.add(g)
+            self.picker.on_timeout(piece_index)
+            expired.append((piece_index, block_index))
+
+        # 先頭に戻すので後ろから積み、タイムアウトしたpiece・ブロックを元の送信順に要求し直す
+        for piece_index, block_index in reversed(expired):
+            self._free[piece_index].appendleft(block_index)
+            self._push_retry(piece_index)
+        return expired
+
+    def _push_retry(self, piece_index: int):
+        self.picker.add(piece_index)
+        if self._in_retry[piece_index]:
+            return
+        self._in_retry[piece_index] = True
+        self._retry.appendleft(piece_index)
@@ -0,0 +1,394 @@
+import fcntl
+import json
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from src.application.resume import ResumeData
+from src.domain.entity.layout import TorrentLayout, check_path
+from src.infrastructure.storage import Storage, PieceFileStorage, SingleFileStorage
+
+from logger import logger
+
+INDEX_FILE = '.cache_index'
+LOCK_FILE = '.cache_index.lock'
+EVICTION_POLICIES = ('lru', 'lfu')
+LOW_WATERMARK = 0.9  # 予算を超えたら予算のこの割合までまとめて減らす
+COMPACT_LINES = 4096  # ログがこの行数と有効なエントリ数の倍の両方を超えたら書き直す
+
+# インデックスのログの1行 (JSONのリスト)
+#   ['torrent', info_hash, name, storage, piece_length, [[path, length(, true: 詰め物)], ...]]
+#   ['add', info_hash, piece_index, size, last_access, hits]
+#   ['touch', info_hash, piece_index, last_access]
+#   ['remove', info_hash, piece_index]
+#   ['pin', info_hash, pid, start_time] / ['unpin', info_hash, pid, start_time]
+#   (start_time はプロセスの起動時刻 PIDが再利用されても別のプロセスと区別する 取れなければnull)
+_TORRENT = 'torrent'
+_ADD = 'add'
+_TOUCH = 'touch'
+_REMOVE = 'remove'
+_PIN = 'pin'
+_UNPIN = 'unpin'
+
+# entries の値の添字
+_SIZE = 0
+_LAST_ACCESS = 1
+_HITS = 2
+
+
+class CacheManager:
+    """
+    CACHE_PATH 以下の全torrentのpieceの索引と、容量の上限によるpieceの追い出し
+
+    索引 (info_hash, piece_index) -> (サイズ, 最終アクセス時刻, アクセス回数) は
+    <CACHE_PATH>/.cache_index に追記だけのログとして保存し、同じキャッシュを使う全プロセスで共有する。
+    更新はロックファイルの flock の下で、他のプロセスが追記した分を読み込んでから自分の分を追記する。
+    メモリ上では最終アクセス順の OrderedDict に持つので、追加・アクセスの記録はO(1)。
+    ダウンロード中に完了したpieceは add() でためておき、flush() (resumeの保存と同じ間隔) でまとめて追記する。
+    前回までに書き込んだpieceを要求しないのは ResumeData の fast check が行うので、ここでは引かない。
+    (追い出す時はそのtorrentのresumeファイルからも外し、ダウンロード中のtorrentは pin で追い出さないので、
+    resumeにあるpieceは索引にもある)
+
+    budget [byte] を超えたら policy (lru: 最終アクセスが古い順 / lfu: アクセス回数が少ない順) で
+    LOW_WATERMARK まで追い出す。ダウンロード中・配信中のtorrent (pin したプロセスが生きているもの) の
+    pieceは追い出さない。プロセスは (PID, 起動時刻) で区別する。追い出したpieceはストレージから消し、そのtorrentのresumeファイルからも外す。
+    """
+
+    def __init__(self, directory: str, budget: Optional[int] = None, policy: str = 'lru'):
+        """
+        :param budget: 全torrentのpieceの合計の上限 [byte] Noneなら追い出さない
+        """
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"unknown eviction policy: {policy}")
+        self.directory = directory
+        self.budget = budget
+        self.policy = policy
+        self.path = os.path.join(directory, INDEX_FILE)
+        self.lock_path = os.path.join(directory, LOCK_FILE)
+        os.makedirs(directory, exist_ok=True)
+
+        # flush() で追記するaddの記録
+        self._added: List[list] = []
+        # 予算を超えているのに追い出せない状態を警告済みか (続く間は繰り返さない)
+        self._warned = False
+
+        self._reset()
+        with self._locked():
+            pass
+
+    def _reset(self):
+        self.entries: 'OrderedDict[Tuple[str, int], List]' = OrderedDict()
+        self.torrents: Dict[str, list] = {}
+        self.pins: Dict[str, Set[Tuple[int, Optional[int]]]] = {}
+        self.total_bytes = 0
+        # torrentごとのpieceの合計 (pin されていないpieceが残っているかを全エントリを見ずに調べる)
+        self.torrent_bytes: Dict[str, int] = {}
+        self._offset = 0
+        self._inode = None
+        self._lines = 0
+
+    def pieces(self, info_hash: str) -> List[int]:
+        return [piece_index for (entry_hash, piece_index) in self.entries if entry_hash == info_hash]
+
+    def register(self, info_hash: str, name: str, storage: str, layout: TorrentLayout):
+        """
+        追い出す時にストレージを開き直せるようにtorrentの構成を記録する
+        """
+        files = [[file.path, file.length, True] if file.padding else [file.path, file.length] for file in layout.files]
+        record = [_TORRENT, info_hash, name, storage, layout.piece_length, files]
+        with self._locked():
+            if self.torrents.get(info_hash) != record[2:]:
+                self._append([record])
+
+    def pin(self, info_hash: str):
+        with self._locked():
+            self._append([[_PIN, info_hash, *_current_process()]])
+
+    def unpin(self, info_hash: str):
+        with self._locked():
+            process = _current_process()
+            if process in self.pins.get(info_hash, ()):
+                self._append([[_UNPIN, info_hash, *process]])
+
+    def add(self, info_hash: str, piece_index: int, size: int):
+        """
+        受信ループから呼ぶのでロックも追記もせずにためておく (flush() で書き出す)
+        """
+        self._added.append([_ADD, info_hash, piece_index, size, time.time(), 1])
+
+    def flush(self):
+        """
+        ためておいたaddをまとめて追記し、予算を超えていれば追い出す
+        """
+        if not self._added:
+            return
+        records, self._added = self._added, []
+        with self._locked():
+            self._append(records)
+            self._evict()
+
+    def touch(self, info_hash: str, piece_index: int):
+        with self._locked():
+            if (info_hash, piece_index) in self.entries:
+                self._append([[_TOUCH, info_hash, piece_index, time.time()]])
+
+    def sync(self, info_hash: str, pieces: Iterable[Tuple[int, int]]):
+        """
+        起動時にresumeで確認したpiece (piece_index, size) と索引を揃える
+        (キャッシュの管理を始める前に書き込んだpieceや、手で消されたpiece)
+        """
+        pieces = dict(pieces)
+        with self._locked():
+            now = time.time()
+            records = [[_REMOVE, info_hash, piece_index] for piece_index in self.pieces(info_hash)
+                       if piece_index not in pieces]
+            records += [[_ADD, info_hash, piece_index, size, now, 1] for piece_index, size in pieces.items()
+                        if (info_hash, piece_index) not in self.entries]
+            if records:
+                self._append(records)
+            self._evict()
+
+    def evict(self):
+        """
+        予算を超えていれば追い出す (予算を変えた後など)
+        """
+        with self._locked():
+            self._evict()
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._catch_up()
+                yield
+                if self._lines > max(COMPACT_LINES, 2 * len(self.entries)):
+                    self._compact()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _catch_up(self):
+        """
+        他のプロセスが追記した分を反映する (書き直されていたら最初から読み直す)
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            if self._inode is not None:
+                self._reset()
+            return
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            self._reset()
+            self._inode = stat.st_ino
+        if stat.st_size == self._offset:
+            return
+
+        with open(self.path, 'rb') as file:
+            file.seek(self._offset)
+            data = file.read()
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            try:
+                self._apply(json.loads(line))
+            except (ValueError, IndexError, TypeError) as e:
+                logger.warning(f"ignore broken cache index record: {e}")
+        self._offset += end
+
+    def _append(self, records: List[list]):
+        data = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records).encode()
+        with open(self.path, 'ab') as file:
+            file.write(data)
+            self._inode = os.fstat(file.fileno()).st_ino
+        self._offset += len(data)
+        for record in records:
+            self._apply(record)
+
+    def _apply(self, record: list):
+        self._lines += 1
+        op, info_hash = record[0], record[1]
+        if op == _TORRENT:
+            self.torrents[info_hash] = record[2:]
+        elif op == _ADD:
+            key = (info_hash, record[2])
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self._count(info_hash, -old[_SIZE])
+            self.entries[key] = [record[3], record[4], record[5]]
+            self._count(info_hash, record[3])
+        elif op == _TOUCH:
+            entry = self.entries.get((info_hash, record[2]))
+            if entry is not None:
+                entry[_LAST_ACCESS] = record[3]
+                entry[_HITS] += 1
+                self.entries.move_to_end((info_hash, record[2]))
+        elif op == _REMOVE:
+            entry = self.entries.pop((info_hash, record[2]), None)
+            if entry is not None:
+                self._count(info_hash, -entry[_SIZE])
+        elif op == _PIN:
+            self.pins.setdefault(info_hash, set()).add(_process(record))
+        elif op == _UNPIN:
+            self.pins.get(info_hash, set()).discard(_process(record))
+
+    def _count(self, info_hash: str, size: int):
+        self.total_bytes += size
+        size += self.torrent_bytes.get(info_hash, 0)
+        if size:
+            self.torrent_bytes[info_hash] = size
+        else:
+            self.torrent_bytes.pop(info_hash, None)
+
+    def _compact(self):
+        """
+        現在の状態だけをログに書き直す (終了したプロセスのpinと、pieceの無いtorrentは落とす)
+        """
+        pins = {info_hash: {process for process in processes if _is_alive(*process)}
+                for info_hash, processes in self.pins.items()}
+        used = {info_hash for info_hash, _ in self.entries} | \
+               {info_hash for info_hash, processes in pins.items() if processes}
+        records = [[_TORRENT, info_hash] + torrent for info_hash, torrent in self.torrents.items()
+                   if info_hash in used]
+        records += [[_PIN, info_hash, *process] for info_hash, processes in pins.items() for process in processes]
+        records += [[_ADD, info_hash, piece_index] + entry for (info_hash, piece_index), entry in self.entries.items()]
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write(''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records))
+        os.replace(tmp_path, self.path)
+        self._reset()
+        self._catch_up()
+
+    def _evict(self):
+        if self.budget is None or self.total_bytes <= self.budget:
+            self._warned = False
+            return
+
+        pinned = {info_hash for info_hash, processes in self.pins.items()
+                  if info_hash in self.torrent_bytes and any(_is_alive(*process) for process in processes)}
+        if self.total_bytes - sum(self.torrent_bytes[info_hash] for info_hash in pinned) <= 0:
+            # 追い出せるpieceが無い間は全エントリを見ない
+            self._warn_over_budget()
+            return
+        candidates = (item for item in self.entries.items() if item[0][0] not in pinned)
+        if self.policy == 'lfu':
+            # 同じ回数なら古い順 (entries は最終アクセス順なので安定ソートで保たれる)
+            candidates = sorted(candidates, key=lambda item: item[1][_HITS])
+
+        target = self.budget * LOW_WATERMARK
+        remaining = self.total_bytes
+        victims: Dict[str, List[Tuple[int, int]]] = {}
+        for (info_hash, piece_index), entry in candidates:
+            if remaining <= target:
+                break
+            victims.setdefault(info_hash, []).append((piece_index, entry[_SIZE]))
+            remaining -= entry[_SIZE]
+
+        evicted = 0
+        for info_hash, pieces in victims.items():
+            removed = self._discard(info_hash, pieces)
+            if removed:
+                self._append([[_REMOVE, info_hash, piece_index] for piece_index in removed])
+            evicted += len(removed)
+        logger.info(f"cache: evicted {evicted} pieces "
+                    f"of {len(victims)} torrents, {self.total_bytes} / {self.budget} bytes")
+        if self.total_bytes > self.budget:
+            self._warn_over_budget()
+        else:
+            self._warned = False
+
+    def _warn_over_budget(self):
+        if self._warned:
+            return
+        self._warned = True
+        logger.warning(f"cache is over budget ({self.total_bytes} > {self.budget} bytes) "
+                       f"and the remaining pieces belong to active torrents or could not be discarded")
+
+    def _discard(self, info_hash: str, pieces: List[Tuple[int, int]]) -> List[int]:
+        """
+        pieceをストレージから消し、resumeファイルからも外す
+        :return: 索引から外してよいpiece (消せなかったpieceはディスクに残っているので索引にも残す)
+        """
+        dropped = [piece_index for piece_index, _ in pieces]
+        torrent = self.torrents.get(info_hash)
+        if torrent is None:
+            logger.warning(f"cache: unknown torrent {info_hash}, drop from index only")
+            return dropped
+        name, kind, piece_length, files = torrent
+        try:
+            check_path([name])
+            layout = TorrentLayout([tuple(file) for file in files], piece_length) if kind != 'piece' else None
+        except ValueError as e:
+            logger.warning(f"cache: {e}, drop from index only")
+            return dropped
+        directory = os.path.join(self.directory, name)
+        storage = self._open_storage(directory, kind, piece_length, layout)
+        if storage is None:
+            # ディレクトリやファイルが消されているのでpieceも残っていない
+            return dropped
+        removed = []
+        try:
+            resume = ResumeData(directory, info_hash, storage)
+            for piece_index, size in pieces:
+                if storage.discard(piece_index, size):
+                    resume.remove(piece_index)
+                    removed.append(piece_index)
+            resume.save()
+        finally:
+            storage.close()
+        if len(removed) < len(pieces):
+            logger.warning(f"cache: {len(pieces) - len(removed)} pieces of {name} could not be discarded, "
+                           f"keep them in the index")
+        return removed
+
+    @staticmethod
+    def _open_storage(directory: str, kind: str, piece_length: int, layout: Optional[TorrentLayout]) \
+            -> Optional[Storage]:
+        if not os.path.isdir(directory):
+            return None
+        if kind == 'piece':
+            return PieceFileStorage(directory, piece_length)
+        # 消されたファイルを作り直さないよう、全て揃っている場合だけ開く
+        if not all(os.path.exists(os.path.join(directory, *file.path)) for file in layout.files if not file.padding):
+            return None
+        return SingleFileStorage(directory, layout)
+
+
+def _start_time(pid: int) -> Optional[int]:
+    """
+    プロセスの起動時刻 (/proc/<pid>/stat の starttime 起動からのclock tick) / 取れなければNone
+    """
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as file:
+            stat = file.read()
+        # 2番目の項目(comm)は括弧で囲まれ空白を含みうるので、最後の ')' の後から数える
+        return int(stat[stat.rindex(b')') + 2:].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _current_process() -> Tuple[int, Optional[int]]:
+    pid = os.getpid()
+    return pid, _start_time(pid)
+
+
+def _process(record: list) -> Tuple[int, Optional[int]]:
+    """
+    pin/unpin の記録の (pid, start_time) (start_time の無い古い記録はNone)
+    """
+    return record[2], record[3] if len(record) > 3 else None
+
+
+def _is_alive(pid: int, start_time: Optional[int] = None) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    if start_time is None:
+        return True
+    # 同じPIDでも起動時刻が違えば pin したプロセスは終了して、PIDが再利用されている
+    current = _start_time(pid)
+    return current is None or current == start_time
@@ -0,0 +1,103 @@
+import time
+from collections import deque
+from typing import Callable, Dict, List, Tuple
+
+from logger import logger
+
+PROBE_CHUNK_SIZES = [1024, 2048, 4096, 8192, 16384, 32768]  # chunk_size='auto' で試す候補
+PROBE_BYTES = 1024 * 1024  # 候補ごとに受信する量
+# 応答待ちの量 (候補によらず同じバイト数にして、ウィンドウではなくパケットごとのコストと損失を比べる)
+PROBE_WINDOW_BYTES = 128 * 1024
+PROBE_TIMEOUT = 0.5  # 最後の受信からこの秒数届かなければその候補を打ち切る
+PROBE_RTO_FACTOR = 2  # 計測中の最大RTTのこの倍を過ぎた応答待ちは再要求する
+PROBE_MIN_RTO = 0.01
+PROBE_RECEIVE_MS = 50
+
+
+def probe_chunk_size(cef_handle, piece_sizes: List[int], piece_name: Callable[[int, int], str],
+                     candidates: List[int] = None, default: int = None) -> int:
+    """
+    候補のchunkの大きさごとに先頭のpieceから PROBE_BYTES 分を同じ量の応答待ちで受信し、
+    goodput(受信したペイロード / 経過時間) が最も高いものを返す
+
+    MTUを超えて断片化するとロスや遅延が増え、小さすぎるとパケットごとの処理が律速になるので、
+    経路ごとに実測して選ぶ。届かなかったchunk(断片の損失・プロデューサーが未対応の大きさ)は
+    再要求の待ち時間としてその候補の評価を下げ、最後まで届かずに打ち切った候補は選ばない。
+    計測で受信したデータは捨てる (候補ごとに PROBE_BYTES、ダウンロードの開始時に1回だけ)。
+    :param piece_name: (piece_index, chunk_size) -> Data名
+    :param default: どの候補も受信できなかった場合の値
+    """
+    if candidates is None:
+        candidates = PROBE_CHUNK_SIZES
+    best, best_goodput = default, 0.0
+    for chunk_size in candidates:
+        chunks = _chunks(piece_sizes, piece_name, chunk_size)
+        goodput, received, retransmissions = _measure(cef_handle, chunks, max(1, PROBE_WINDOW_BYTES // chunk_size))
+        logger.info(f"probe chunk size {chunk_size}: {goodput * 8 / 1024 ** 2:.1f} Mbps "
+                    f"({received} / {len(chunks)} chunks, {retransmissions} retransmissions)")
+        if received < len(chunks):
+            # 途中で止まる大きさは、止まる前が速くても本番で止まる
+            continue
+        if goodput > best_goodput:
+            best, best_goodput = chunk_size, goodput
+
+    if best_goodput == 0:
+        logger.warning(f"no chunk size received all of its probe data, use {default}")
+    else:
+        logger.info(f"chunk size: {best}")
+    return best
+
+
+def _chunks(piece_sizes: List[int], piece_name: Callable[[int, int], str], chunk_size: int) -> List[Tuple[str, int]]:
+    chunks = []
+    remaining = PROBE_BYTES
+    for piece_index, piece_size in enumerate(piece_sizes):
+        name = piece_name(piece_index, chunk_size)
+        for chunk_num in range(-(-piece_size // chunk_size)):
+            if remaining <= 0:
+                return chunks
+            chunks.append((name, chunk_num))
+            remaining -= chunk_size
+    return chunks
+
+
+def _measure(cef_handle, chunks: List[Tuple[str, int]], window: int) -> Tuple[float, int, int]:
+    """
+    :return: (goodput [byte/s], 受信したchunk数, 再要求した回数)
+             goodput は全て受信するか打ち切るまでの経過時間で割る (打ち切りまでの待ち時間も含める)
+    """
+    pending = deque(chunks)
+    waiting: Dict[Tuple[str, int], float] = {}  # 応答待ち -> 送信時刻
+    received_bytes = 0
+    retransmissions = 0
+    max_rtt = 0.0
+    started = last_received = now = time.time()
+    while pending or waiting:
+        now = time.time()
+        while pending and len(waiting) < window:
+            name, chunk_num = key = pending.popleft()
+            cef_handle.send_interest(name=name, chunk_num=chunk_num)
+            waiting[key] = now
+
+        info = cef_handle.receive(timeout_ms=PROBE_RECEIVE_MS)
+        now = time.time()
+        key = (info.name, info.chunk_num)
+        if info.is_succeeded and info.is_data and key in waiting:
+            max_rtt = max(max_rtt, now - waiting.pop(key))
+            received_bytes += len(info.payload)
+            last_received = now
+        elif now - last_received > PROBE_TIMEOUT:
+            # 1つも届かない (プロデューサーがこの大きさに対応していない)
+            break
+
+        # 失われたchunkは再要求する 損失の多い大きさほど再要求の待ち時間で評価が下がる
+        rto = max(PROBE_MIN_RTO, PROBE_RTO_FACTOR * max_rtt)
+        for key, sent_time in waiting.items():
+            if now - sent_time > rto:
+                name, chunk_num = key
+                cef_handle.send_interest(name=name, chunk_num=chunk_num)
+                waiting[key] = now
+                retransmissions += 1
+
+    elapsed = max(now - started, 1e-6)
+    return received_bytes / elapsed, len(chunks) - len(pending) - len(waiting), retransmissions
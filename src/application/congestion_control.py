@@ -0,0 +1,56 @@
+import math
+import time
+
+from src.application.rtt_estimator import RttEstimator
+
+INITIAL_WINDOW = 4
+MIN_WINDOW = 1
+
+
+class CongestionControl:
+    """
+    Interestのウィンドウ制御の共通インターフェース
+
+    on_send     - Interestを送信した
+    on_data     - Dataを受信した(RTTサンプル付き)
+    on_timeout  - タイムアウトを検出した
+    window      - 応答待ちにしてよいInterestの数
+    now_wind は応答待ちのInterest数で、送信側が on_send と実際の応答待ち数で更新する。
+    """
+    name = ''
+
+    def __init__(self, rtt: RttEstimator = None, clock=time.time):
+        self.now_wind = 0
+
+        self.cwind = INITIAL_WINDOW
+        self.ssthresh = math.inf
+        self.last_time_loss = 0
+
+        self.rtt = RttEstimator() if rtt is None else rtt
+        self.clock = clock
+
+    @property
+    def window(self) -> float:
+        return self.cwind
+
+    def on_send(self, count: int = 1):
+        self.now_wind += count
+
+    def on_data(self, rtt: float = None):
+        """
+        :param rtt: RTTサンプル 再送したInterestなど、サンプルとして使えない場合はNone
+        """
+        if rtt is not None:
+            self.rtt.update(rtt)
+
+    def on_timeout(self) -> bool:
+        """
+        1RTTの間の2回目以降のタイムアウトでは何もしない
+        :return: パケロスとして扱った場合True
+        """
+        now = self.clock()
+        if now - self.last_time_loss < self.rtt.smoothed:
+            return False
+        self.last_time_loss = now
+        self.rtt.backoff()
+        return True
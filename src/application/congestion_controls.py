@@ -0,0 +1,20 @@
+from typing import Dict, Type
+
+from src.application.aimd import Aimd
+from src.application.congestion_control import CongestionControl
+from src.application.cubic import Cubic
+from src.application.rtt_estimator import RttEstimator
+from src.application.vegas import Vegas
+
+CONGESTION_CONTROLS: Dict[str, Type[CongestionControl]] = {
+    Cubic.name: Cubic,
+    Aimd.name: Aimd,
+    Vegas.name: Vegas,
+}
+
+
+def create_congestion_control(name: str, rtt: RttEstimator = None, **kwargs) -> CongestionControl:
+    try:
+        return CONGESTION_CONTROLS[name](rtt, **kwargs)
+    except KeyError:
+        raise ValueError(f"unknown congestion control: {name}")
@@ -1,24 +1,74 @@
 import math
-import time
 
+from src.application.congestion_control import CongestionControl, MIN_WINDOW
 
-class Cubic:
-    def __init__(self):
-        self.now_wind = 0
 
-        self.cwind = 0
+class Cubic(CongestionControl):
+    """
+    CUBIC (RFC 8312) によるInterestのウィンドウ制御
+
+    slow start  - ssthresh までは受信ごとに +1
+    CUBIC       - W(t) = C * (t - K)^3 + w_max に向けて増加
+    Reno-friendly - 同条件のRenoのウィンドウ w_est を下回らない
+    パケロス(タイムアウト)検出時は cwind を (1 - B) 倍にする。1RTTの間に複数回は減らさない。
+    """
+    name = 'cubic'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
         self.w_max = 0  # パケロス検出時のウィンドウサイズ
 
         self.C = 0.4  # 増幅幅を決めるパラメータ
-        self.B = 0.1  # パケロス検出時のウィンドウサイズ減少幅 default = 0.2
+        self.B = 0.3  # パケロス検出時のウィンドウサイズ減少幅
+
+        self.t = 0  # CUBIC増加を始めてからの経過時間
+        self.k = 0
+        self.epoch_start = None
+        self.w_est = 0
+
+    def on_data(self, rtt: float = None):
+        super().on_data(rtt)
+
+        if self.cwind < self.ssthresh:
+            self.cwind += 1
+            return
+
+        now = self.clock()
+        if self.epoch_start is None:
+            self.epoch_start = now
+            if self.cwind < self.w_max:
+                self.k = self.calc_k()
+            else:
+                self.k = 0
+                self.w_max = self.cwind
+            self.w_est = self.cwind
+
+        self.t = now - self.epoch_start
+        target = self.C * (self.t + self.rtt.smoothed - self.k) ** 3 + self.w_max
+        if target > self.cwind:
+            self.cwind += (target - self.cwind) / self.cwind
+        else:
+            self.cwind += 0.01 / self.cwind
+
+        # Reno-friendly region
+        self.w_est += (3 * self.B / (2 - self.B)) / self.cwind
+        if self.w_est > self.cwind:
+            self.cwind = self.w_est
 
-        self.t = 0  # パケロス検出時からの経過時間
-        self.last_time_loss = time.time()
+    def on_timeout(self) -> bool:
+        if not super().on_timeout():
+            return False
+        self.epoch_start = None
 
-    def cals_cwind(self):
-        self.t = time.time() - self.last_time_loss
-        self.cwind = self.C * (self.t - self.calc_k()) ** 3 + self.w_max
-        return self.cwind
+        # fast convergence
+        if self.cwind < self.w_max:
+            self.w_max = self.cwind * (2 - self.B) / 2
+        else:
+            self.w_max = self.cwind
+        self.ssthresh = max(self.cwind * (1 - self.B), MIN_WINDOW)
+        self.cwind = self.ssthresh
+        return True
 
     def calc_k(self):
-        return math.pow((self.w_max * self.B) / self.C, 1/3)
+        return math.pow(max(self.w_max - self.cwind, 0) / self.C, 1/3)
@@ -0,0 +1,238 @@
+import bisect
+import json
+import math
+import mmap
+import os
+import threading
+import time
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+from logger import logger
+
+# Metrics.values の添字 ホットループでは metrics.values[INTERESTS] += n のように直接書く
+# カウンタ
+INTERESTS = 0  # 送ったInterest(endgameの重複を含む)
+ENDGAME_INTERESTS = 1  # endgameで重複して送ったInterest
+DATA = 2  # 受信したData
+DUPLICATE_DATA = 3  # 受信済みブロックのData
+TIMEOUTS = 4  # タイムアウトしたブロック
+HASH_FAILURES = 5
+PIECES = 6  # 検証・書き込みの済んだpiece
+BLOCK_FAILURES = 7  # v2で葉の検証に失敗して再要求したブロック
+WRITE_FAILURES = 8  # 書き直しても書き込めず再受信に回したpiece
+# ゲージ
+CWND = 9
+PENDING = 10  # 応答待ちのブロック
+RTO = 11
+SRTT = 12
+VERIFY_QUEUE = 13  # 検証待ちのpiece
+NOTIFY_QUEUE = 14  # listener -> requester の未処理の通知
+VERIFY_LATENCY = 15  # 指数移動平均[s]
+WRITE_LATENCY = 16
+# RTTヒストグラム
+RTT_SUM = 17
+RTT_COUNT = 18
+RTT_BUCKETS_START = 19
+RTT_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 4.0, math.inf)
+NUMBER_OF_VALUES = RTT_BUCKETS_START + len(RTT_BUCKETS)
+
+COUNTERS = {
+    'interests_sent': INTERESTS,
+    'endgame_interests': ENDGAME_INTERESTS,
+    'data_received': DATA,
+    'duplicate_data': DUPLICATE_DATA,
+    'timeouts': TIMEOUTS,
+    'hash_failures': HASH_FAILURES,
+    'pieces_completed': PIECES,
+    'block_hash_failures': BLOCK_FAILURES,
+    'write_failures': WRITE_FAILURES,
+}
+GAUGES = {
+    'cwnd': CWND,
+    'pending': PENDING,
+    'rto_seconds': RTO,
+    'srtt_seconds': SRTT,
+    'verify_queue': VERIFY_QUEUE,
+    'notify_queue': NOTIFY_QUEUE,
+    'verify_latency_seconds': VERIFY_LATENCY,
+    'write_latency_seconds': WRITE_LATENCY,
+}
+# 複数のMetricsをまとめる時に合計ではなく平均をとるゲージ
+AVERAGED_GAUGES = (RTO, SRTT, VERIFY_LATENCY, WRITE_LATENCY)
+
+PROMETHEUS_PREFIX = 'ccn_torrent_'
+
+
+class Metrics:
+    """
+    ダウンロードの計測値
+
+    値は全て1つのdouble配列に持つ。shared=True の場合は無名mmap上に置き、fork後の
+    listener と requester がそれぞれ自分の書く値だけを書き込む(同じ値を複数のプロセスから書かない)。
+    """
+
+    def __init__(self, shared: bool = False):
+        if shared:
+            self._mmap = mmap.mmap(-1, NUMBER_OF_VALUES * 8)
+            self.values = memoryview(self._mmap).cast('d')
+        else:
+            self.values = array('d', bytes(NUMBER_OF_VALUES * 8))
+
+    def observe_rtt(self, rtt: float):
+        values = self.values
+        values[RTT_SUM] += rtt
+        values[RTT_COUNT] += 1
+        values[RTT_BUCKETS_START + bisect.bisect_left(RTT_BUCKETS, rtt)] += 1
+
+    def observe_latency(self, index: int, sample: float, alpha: float = 0.125):
+        average = self.values[index]
+        self.values[index] = sample if average == 0 else (1 - alpha) * average + alpha * sample
+
+    def rtt_quantile(self, q: float) -> float:
+        """
+        ヒストグラムの上端から求めた分位点 (サンプルが無ければ0)
+        """
+        count = self.values[RTT_COUNT]
+        if count == 0:
+            return 0.0
+        rank = q * count
+        cumulative = 0
+        for i, bound in enumerate(RTT_BUCKETS):
+            cumulative += self.values[RTT_BUCKETS_START + i]
+            if cumulative >= rank:
+                return bound
+        return math.inf
+
+    def snapshot(self) -> dict:
+        values = self.values
+        count = values[RTT_COUNT]
+        snapshot = {name: int(values[index]) for name, index in COUNTERS.items()}
+        snapshot.update({name: values[index] for name, index in GAUGES.items()})
+        snapshot['rtt'] = {
+            'count': int(count),
+            'mean': values[RTT_SUM] / count if count else 0.0,
+            'p50': self.rtt_quantile(0.5),
+            'p90': self.rtt_quantile(0.9),
+            'p99': self.rtt_quantile(0.99),
+            'buckets': {str(bound): int(values[RTT_BUCKETS_START + i]) for i, bound in enumerate(RTT_BUCKETS)},
+        }
+        return snapshot
+
+    @classmethod
+    def aggregate(cls, metrics: List['Metrics']) -> 'Metrics':
+        """
+        複数のワーカーの値をまとめる (遅延・RTOなどは平均、それ以外は合計)
+        """
+        total = cls()
+        for m in metrics:
+            for i in range(NUMBER_OF_VALUES):
+                total.values[i] += m.values[i]
+        if metrics:
+            for i in AVERAGED_GAUGES:
+                total.values[i] /= len(metrics)
+        return total
+
+
+def escape_label_value(value) -> str:
+    """
+    ラベルの値はtorrent名などをそのまま使うので、Prometheusのtext形式で意味を持つ文字を逃がす
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(sources: List[Tuple[Metrics, Dict[str, str]]]) -> str:
+    """
+    Prometheusのtext形式 sources は (Metrics, ラベル) のリスト
+    """
+    lines = []
+
+    def label_text(labels: Dict[str, str], **extra) -> str:
+        labels = {**labels, **extra}
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{escape_label_value(value)}"' for key, value in labels.items()) + '}'
+
+    for name, index in COUNTERS.items():
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}{name}_total counter')
+        for metrics, labels in sources:
+            lines.append(f'{PROMETHEUS_PREFIX}{name}_total{label_text(labels)} {metrics.values[index]:g}')
+    for name, index in GAUGES.items():
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}{name} gauge')
+        for metrics, labels in sources:
+            lines.append(f'{PROMETHEUS_PREFIX}{name}{label_text(labels)} {metrics.values[index]:g}')
+
+    name = PROMETHEUS_PREFIX + 'rtt_seconds'
+    lines.append(f'# TYPE {name} histogram')
+    for metrics, labels in sources:
+        cumulative = 0
+        for i, bound in enumerate(RTT_BUCKETS):
+            cumulative += metrics.values[RTT_BUCKETS_START + i]
+            le = '+Inf' if bound == math.inf else f'{bound:g}'
+            lines.append(f'{name}_bucket{label_text(labels, le=le)} {cumulative:g}')
+        lines.append(f'{name}_sum{label_text(labels)} {metrics.values[RTT_SUM]:g}')
+        lines.append(f'{name}_count{label_text(labels)} {metrics.values[RTT_COUNT]:g}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    """
+    Metrics の定期出力
+
+    path - export() のたびに1行のJSONを追記する
+    port - GET /metrics にPrometheusのtext形式で応答するHTTPサーバーを別スレッドで動かす
+           host を指定しなければ 127.0.0.1 だけで待ち受ける ('' なら全てのインターフェース)
+    sources は (Metrics を返す関数, ラベル) のリスト。ワーカーの値を集計する場合があるので関数で受け取る。
+    """
+
+    def __init__(self, sources, path: str = None, port: int = None, host: str = '127.0.0.1'):
+        self.sources = sources
+        self.file = None
+        self.server = None
+
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.file = open(path, 'a')
+
+        if port is not None:
+            exporter = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = prometheus_text(exporter.collect()).encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer((host, port), Handler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logger.info(f"metrics endpoint: http://{host or 'localhost'}:{port}/metrics")
+
+    def collect(self) -> List[Tuple[Metrics, Dict[str, str]]]:
+        return [(source(), labels) for source, labels in self.sources]
+
+    def export(self):
+        if self.file is None:
+            return
+        now = time.time()
+        for metrics, labels in self.collect():
+            self.file.write(json.dumps({'time': now, **labels, **metrics.snapshot()}) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.export()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,197 @@
+import asyncio
+import multiprocessing
+import queue
+import time
+from typing import List
+
+from src.application import metrics as m
+from src.application.async_bittorrent import AsyncBitTorrent, WINDOW_INTERVAL
+from src.application.bittorrent import BitTorrent, CONGESTION_CONTROL, MAX_PEER_CONNECT
+from src.application.block_scheduler import BlockScheduler
+from src.application.metrics import Metrics
+from src.application.piece_picker import create_piece_picker
+from src.domain.entity.piece.piece import Piece
+from src.domain.entity.torrent import Torrent
+
+from logger import logger
+
+# 全pieceの完了後、ワーカーが後片付け(書き込みの同期など)を終えるのを待つ上限
+WORKER_JOIN_TIMEOUT = 10
+
+
+class ParallelBitTorrent(AsyncBitTorrent):
+    """
+    1つのtorrentを複数のワーカープロセスで受信するエンジン
+
+    ワーカーはそれぞれ自分のCCN face(cefpycoハンドル)と輻輳制御を持ち、
+    piece_index % workers が自分の番号のpieceだけを AsyncBitTorrent と同じ処理で要求・受信・検証・書き込みする。
+    ブロックの状態は共有メモリの BlockStates に直接書かれ、検証の済んだpieceは ('piece', piece_index) で
+    親プロセスに通知する。親は bitfield・resume・StreamReader への通知と進捗表示だけを行う。
+    """
+
+    def __init__(self, torrent: Torrent, congestion_control: str = CONGESTION_CONTROL, handle_factory=None,
+                 workers: int = MAX_PEER_CONNECT, **kwargs):
+        """
+        :param handle_factory: ワーカープロセス内で begin() 済みのハンドルを作る関数 / Noneならcefpyco
+        :param kwargs: BitTorrent へそのまま渡す (rehash, storage, picker など)
+        """
+        self.handle_factory = handle_factory or BitTorrent.create_handle
+        self.number_of_workers = workers
+        self.worker_index = None
+        super().__init__(torrent, congestion_control, **kwargs)
+
+        # 親 -> ワーカーの通知 ('cursor', piece_index)
+        self.control_queues = [multiprocessing.Queue() for _ in range(workers)]
+        # ワーカーごとの計測値 親が集計して出力する
+        self.worker_metrics = [Metrics(shared=True) for _ in range(workers)]
+
+    def progress_writers(self) -> int:
+        # 親(slot 0)とワーカー
+        return self.number_of_workers + 1
+
+    def create_handle(self):
+        # 親プロセスは受信しない
+        return None
+
+    def tune_chunk_size(self, cef_handle=None) -> int:
+        # 親はハンドルを持たないので計測用に1つ作る
+        handle = self.handle_factory()
+        try:
+            return super().tune_chunk_size(handle)
+        finally:
+            handle.end()
+
+    def run(self):
+        workers = []
+        try:
+            self.create_profiler(processes=self.number_of_workers + 1)
+            self.started_time = time.time()
+            for worker_index in range(self.number_of_workers):
+                worker = multiprocessing.Process(target=self.worker, args=(worker_index,))
+                worker.start()
+                workers.append(worker)
+
+            self.start_profile('collector', 0)
+            self.start_metrics()
+            self.collect(workers)
+            for worker in workers:
+                worker.join(WORKER_JOIN_TIMEOUT)
+            self.save_resume()
+            self.storage.close()
+            self.cache.unpin(self.info_hash)
+
+            logger.info(f'download time: {(time.time() - self.started_time):.2f}')
+            self.finish_profile(children=self.number_of_workers)
+            self.stop_metrics()
+        except Exception as e:
+            logger.error(e)
+            raise e
+        except KeyboardInterrupt:
+            return
+        finally:
+            for worker in workers:
+                worker.kill()
+                worker.join()
+            self.notify_piece_completed(stopped=True)
+
+    def collect(self, workers: List[multiprocessing.Process]):
+        """
+        ワーカーから完了したpieceを受け取って記録する
+        """
+        last_seen_time = time.time()
+        while not self.all_pieces_completed():
+            if time.time() - last_seen_time > 1:
+                self.print_progress()
+                self.save_resume()
+                self.report_metrics()
+                last_seen_time = time.time()
+
+            try:
+                state, value = self.queue.get(timeout=1)
+            except queue.Empty:
+                self.check_workers(workers)
+                continue
+
+            if state == 'piece':
+                piece = self.pieces[value]
+                piece.set_exist()
+                self.on_piece_completed(piece)
+
+    def check_workers(self, workers: List[multiprocessing.Process]):
+        """
+        担当分を終えずに終了したワーカーがいれば、そのpieceは誰も取らないので中断する
+        (キューが空の時に呼ぶので、終了前に送られた完了通知は受け取り済み)
+        """
+        for worker_index, worker in enumerate(workers):
+            if worker.exitcode is None:
+                continue
+            remaining = [piece_index for piece_index in
+                         range(worker_index, self.number_of_pieces, self.number_of_workers)
+                         if not self.bitfield[piece_index]]
+            if remaining:
+                raise RuntimeError(f"worker {worker_index} exited with code {worker.exitcode} "
+                                   f"leaving {len(remaining)} pieces of its partition")
+
+    def set_stream_cursor(self, piece_index: int):
+        if self.worker_index is not None:
+            return super().set_stream_cursor(piece_index)
+        for control in self.control_queues:
+            control.put(('cursor', piece_index))
+
+    # 以下はワーカープロセス内で動く
+
+    def collect_metrics(self) -> Metrics:
+        if self.worker_index is not None:
+            return super().collect_metrics()
+        return Metrics.aggregate(self.worker_metrics)
+
+    def worker(self, worker_index: int):
+        self.worker_index = worker_index
+        self.metrics = self.worker_metrics[worker_index]
+        self.completion.set_writer(worker_index + 1)
+        self.cef_handle = self.handle_factory()
+
+        partition = [piece_index for piece_index in range(worker_index, self.number_of_pieces, self.number_of_workers)
+                     if not self.completion.is_complete(piece_index)]
+        self.partition_remaining = len(partition)
+        self.picker = create_piece_picker(self.picker_name, self.number_of_pieces)
+        self.scheduler = BlockScheduler(self.block_states, self.congestion_control.rtt.rto, self.picker, partition)
+        self.start_profile(f'worker{worker_index}', worker_index + 1)
+        asyncio.run(self.main())
+        if self.profiler is not None:
+            # サンプルを親へ送ってから終了する
+            self.profiler.stop()
+
+    def all_pieces_completed(self) -> bool:
+        if self.worker_index is None:
+            return super().all_pieces_completed()
+        return self.partition_remaining == 0
+
+    def on_piece_completed(self, piece: Piece):
+        if self.worker_index is None:
+            return super().on_piece_completed(piece)
+        self.bitfield[piece.piece_index] = 1
+        self.complete_pieces += 1
+        self.partition_remaining -= 1
+        self.metrics.values[m.PIECES] += 1
+        self.queue.put(('piece', piece.piece_index))
+
+    def finish(self):
+        if self.worker_index is None:
+            return super().finish()
+        # resumeは親が保存する
+        self.storage.close()
+
+    async def progress(self):
+        # 進捗表示は親が行う ワーカーは計測値の更新と親からの通知だけ見る
+        control = self.control_queues[self.worker_index]
+        while True:
+            await asyncio.sleep(WINDOW_INTERVAL)
+            self.collect_metrics()
+            while True:
+                try:
+                    state, value = control.get_nowait()
+                except queue.Empty:
+                    break
+                if state == 'cursor':
+                    self.picker.set_cursor(value)
@@ -0,0 +1,191 @@
+import heapq
+import math
+import random
+from typing import Dict, List, Optional, Tuple, Type
+
+RANDOM_FIRST_PIECES = 4
+STREAM_WINDOW = 16  # 読み出し位置から優先して取るpiece数
+CACHE_HIT_RATIO = 1.5  # pieceの最初の応答のRTTが最小RTTのこの倍以下ならキャッシュから返ったとみなす
+RAREST_SPREAD = 16  # 1つのpieceの観測を後ろの何pieceまで当てはめるか (キャッシュは連続したpieceを持っていることが多い)
+
+
+class PiecePicker:
+    """
+    FREEブロックを持つpieceの中から次に要求するpieceを選ぶ
+
+    候補は優先度付きのヒープで持ち、優先度が変わった時は新しいエントリを積む(古いものは読み捨てる)。
+    毎回全pieceを並べ替えることはしない。
+    """
+    name = ''
+    # on_response / on_timeout を使うか (使わないpickerではスケジューラがpieceを引かずに済む)
+    observes = False
+
+    def __init__(self, number_of_pieces: int):
+        self.number_of_pieces = number_of_pieces
+        self._heap: List[Tuple[tuple, int]] = []
+        self._candidate = bytearray(number_of_pieces)
+
+    def priority(self, piece_index: int) -> tuple:
+        raise NotImplementedError
+
+    def add(self, piece_index: int):
+        if self._candidate[piece_index]:
+            return
+        self._candidate[piece_index] = 1
+        heapq.heappush(self._heap, (self.priority(piece_index), piece_index))
+
+    def remove(self, piece_index: int):
+        self._candidate[piece_index] = 0
+
+    def peek(self) -> Optional[int]:
+        heap = self._heap
+        while heap:
+            key, piece_index = heap[0]
+            if self._candidate[piece_index] and key == self.priority(piece_index):
+                return piece_index
+            heapq.heappop(heap)
+        return None
+
+    def set_cursor(self, piece_index: int):
+        pass
+
+    def on_response(self, piece_index: int, rtt: float):
+        """
+        piece のブロックへの応答のRTT (再送したブロックは渡さない)
+        """
+        pass
+
+    def on_timeout(self, piece_index: int):
+        """
+        piece のブロックのInterestがタイムアウトした
+        """
+        pass
+
+
+class SequentialPicker(PiecePicker):
+    """
+    piece_index の小さい順
+    """
+    name = 'sequential'
+
+    def priority(self, piece_index: int) -> tuple:
+        return (piece_index,)
+
+
+class RarestFirstPicker(PiecePicker):
+    """
+    ネットワーク上に少ないpieceから
+
+    CCNのDataには取得先のbitfieldが無いので、pieceの最初の応答から availability を推定する。
+    最小RTTに近い応答は途中のキャッシュから返ったとみなして +1、
+    遅い応答・タイムアウトはプロデューサーにしか無いとみなして -1 し、
+    そのpieceから RAREST_SPREAD 個先までのpieceにも同じだけ加える。
+    availability の小さい順 (プロデューサーにしか無いpieceを先に、キャッシュにあるpieceを後に)、同じなら piece_index の小さい順
+    """
+    name = 'rarest'
+    observes = True
+
+    def __init__(self, number_of_pieces: int):
+        super().__init__(number_of_pieces)
+        self.availability = [0] * number_of_pieces
+        self.min_rtt = math.inf
+        self._observed = bytearray(number_of_pieces)
+
+    def priority(self, piece_index: int) -> tuple:
+        return self.availability[piece_index], piece_index
+
+    def on_response(self, piece_index: int, rtt: float):
+        if self._observed[piece_index]:
+            return
+        self.min_rtt = min(self.min_rtt, rtt)
+        self._observe(piece_index, 1 if rtt <= self.min_rtt * CACHE_HIT_RATIO else -1)
+
+    def on_timeout(self, piece_index: int):
+        if self._observed[piece_index]:
+            return
+        self._observe(piece_index, -1)
+
+    def _observe(self, piece_index: int, delta: int):
+        self._observed[piece_index] = 1
+        for i in range(piece_index, min(piece_index + RAREST_SPREAD, self.number_of_pieces)):
+            self.availability[i] += delta
+            if self._candidate[i]:
+                heapq.heappush(self._heap, (self.priority(i), i))
+
+
+class RandomFirstPicker(RarestFirstPicker):
+    """
+    最初の random_pieces 個はランダムに選び、以降は rarest-first
+
+    同時に始めた複数のクライアントが全員同じpieceから取り始めるのを避ける。
+    """
+    name = 'random-first'
+
+    def __init__(self, number_of_pieces: int, random_pieces: int = RANDOM_FIRST_PIECES, seed: int = None):
+        super().__init__(number_of_pieces)
+        self.random_pieces = random_pieces
+        self._order = list(range(number_of_pieces))
+        random.Random(seed).shuffle(self._order)
+
+    def priority(self, piece_index: int) -> tuple:
+        if self.random_pieces > 0:
+            return (self._order[piece_index],)
+        return super().priority(piece_index)
+
+    def remove(self, piece_index: int):
+        if self._candidate[piece_index] and self.random_pieces > 0:
+            self.random_pieces -= 1
+            if self.random_pieces == 0:
+                # 優先度の付け方が変わるので候補を積み直す(1回だけ)
+                self._heap = [(self.priority(i), i) for i in range(self.number_of_pieces)
+                              if self._candidate[i] and i != piece_index]
+                heapq.heapify(self._heap)
+        super().remove(piece_index)
+
+
+class StreamingPicker(RarestFirstPicker):
+    """
+    読み出し位置(cursor)から window 個のpieceを piece_index の小さい順に最優先し、
+    その先は rarest-first、cursor より前のpieceは最後に回す
+
+    cursor が動いた時は優先度が変わるpieceだけ積み直す。
+    """
+    name = 'streaming'
+
+    def __init__(self, number_of_pieces: int, window: int = STREAM_WINDOW):
+        super().__init__(number_of_pieces)
+        self.window = window
+        self.cursor = 0
+
+    def priority(self, piece_index: int) -> tuple:
+        if piece_index < self.cursor:
+            return 2, piece_index
+        if piece_index < self.cursor + self.window:
+            return 0, piece_index
+        return 1, self.availability[piece_index], piece_index
+
+    def set_cursor(self, piece_index: int):
+        if piece_index == self.cursor:
+            return
+        # 優先度が変わるのは古いcursorと新しいcursor(+window)の間だけ
+        start = min(self.cursor, piece_index)
+        end = min(max(self.cursor, piece_index) + self.window, self.number_of_pieces)
+        self.cursor = piece_index
+        for i in range(start, end):
+            if self._candidate[i]:
+                heapq.heappush(self._heap, (self.priority(i), i))
+
+
+PIECE_PICKERS: Dict[str, Type[PiecePicker]] = {
+    SequentialPicker.name: SequentialPicker,
+    RandomFirstPicker.name: RandomFirstPicker,
+    RarestFirstPicker.name: RarestFirstPicker,
+    StreamingPicker.name: StreamingPicker,
+}
+
+
+def create_piece_picker(name: str, number_of_pieces: int) -> PiecePicker:
+    try:
+        return PIECE_PICKERS[name](number_of_pieces)
+    except KeyError:
+        raise ValueError(f"unknown piece picker: {name}")
@@ -0,0 +1,133 @@
+import queue
+import threading
+import time
+from typing import List, Tuple
+
+from src.application.profiler import StageTimers, SET_TO_FULL, WRITE_ON_DISK
+from src.domain.entity.piece.piece import Piece
+
+from logger import logger
+
+WRITE_RETRIES = 3  # 書き込みに失敗したpieceを再受信に回す前に書き直す回数
+WRITE_RETRY_DELAY = 0.1  # [s] 試すごとに倍にする
+
+
+def write_with_retry(piece: Piece) -> bool:
+    """
+    検証済みのpieceを書き込む (ENOSPC / EIO などは間を空けて書き直す)
+    書き込めなかった場合はpieceを受信前の状態に戻す (is_full のままだと再受信したブロックを全て捨ててしまう)
+    :return: 書き込めたか
+    """
+    delay = WRITE_RETRY_DELAY
+    for attempt in range(WRITE_RETRIES + 1):
+        try:
+            piece.write_on_disk()
+            return True
+        except OSError as e:
+            logger.error(f"failed to write piece {piece.piece_index} ({attempt + 1} / {WRITE_RETRIES + 1}): {e}")
+            piece.write_error = e
+            if attempt < WRITE_RETRIES:
+                time.sleep(delay)
+                delay *= 2
+    piece.reset()
+    return False
+
+
+class PieceVerifier:
+    """
+    SHA-1検証とディスク書き込みを受信ループの外で行うワーカープール
+
+    受信ループは全ブロックが揃ったpieceを submit() で有界キューに積むだけで、
+    結果(pass/fail)は results() でまとめて受け取る。
+    hashlibは大きなバッファのハッシュ計算中にGILを解放するのでスレッドで並列化できる。
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 32, stages: StageTimers = None):
+        """
+        :param stages: --profile 時に set_to_full / write_on_disk の時間を記録する
+        """
+        self.stages = stages
+        self._tasks: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._results: queue.Queue = queue.Queue()
+
+        # 指数移動平均(秒)
+        self.verify_latency = 0.0
+        self.write_latency = 0.0
+        self.max_verify_latency = 0.0
+        self.num_of_verified = 0
+        self.num_of_failed = 0
+        self.num_of_write_failures = 0
+        # submit() してまだ results() で受け取っていないpiece数
+        self.in_flight = 0
+
+        self._workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._tasks.qsize()
+
+    def submit(self, piece: Piece):
+        """
+        キューが一杯の場合はワーカーが追いつくまでブロックする
+        """
+        self.in_flight += 1
+        self._tasks.put(piece)
+
+    def results(self) -> List[Tuple[Piece, bool]]:
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                self.in_flight -= len(results)
+                return results
+
+    def close(self):
+        """
+        キューに残っているpieceを処理し終えてからワーカーを止める
+        """
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _worker(self):
+        while True:
+            piece = self._tasks.get()
+            if piece is None:
+                return
+
+            try:
+                started = time.perf_counter()
+                ok = piece.set_to_full()
+                verified = time.perf_counter()
+                latency = verified - started
+                if self.stages is not None:
+                    self.stages.add(SET_TO_FULL, latency)
+                if ok:
+                    ok = write_with_retry(piece)
+                    written = time.perf_counter() - verified
+                    if ok:
+                        self.write_latency = self._ewma(self.write_latency, written)
+                        self.num_of_verified += 1
+                    else:
+                        self.num_of_write_failures += 1
+                    if self.stages is not None:
+                        self.stages.add(WRITE_ON_DISK, written)
+                else:
+                    self.num_of_failed += 1
+
+                self.verify_latency = self._ewma(self.verify_latency, latency)
+                self.max_verify_latency = max(self.max_verify_latency, latency)
+            except Exception as e:
+                logger.error(e)
+                piece.reset()
+                ok = False
+
+            self._results.put((piece, ok))
+
+    @staticmethod
+    def _ewma(average: float, sample: float, alpha: float = 0.125) -> float:
+        return sample if average == 0 else (1 - alpha) * average + alpha * sample
@@ -0,0 +1,233 @@
+import mmap
+import multiprocessing
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+
+from logger import logger
+
+PROFILE_INTERVAL = 0.005  # スタックを取る間隔[s]
+PROFILE_COLLECT_TIMEOUT = 5  # 他のプロセスのサンプルを待つ上限[s]
+PROFILE_TOP = 20  # ログに出す関数の数
+PROFILER_THREAD = 'profiler'  # この名前で始まるスレッドはサンプルに含めない
+
+# 区間計測するステージ
+HANDLE_PIECE = 'handle_piece'
+SET_TO_FULL = 'set_to_full'
+WRITE_ON_DISK = 'write_on_disk'
+CHECK_CHUNK_STATE = 'check_chunk_state'
+STAGES = (HANDLE_PIECE, SET_TO_FULL, WRITE_ON_DISK, CHECK_CHUNK_STATE)
+# ステージごとに 回数, 合計[s], 最大[s]
+_STAGE_FIELDS = 3
+
+
+class StageTimers:
+    """
+    ステージごとの呼び出し回数と所要時間
+
+    値は無名mmap上に置き、プロセスごとに別の領域(slot)へ書くので fork 後の全プロセスの値を親から読める。
+    """
+
+    def __init__(self, processes: int):
+        self.processes = processes
+        self._mmap = mmap.mmap(-1, processes * len(STAGES) * _STAGE_FIELDS * 8)
+        self.values = memoryview(self._mmap).cast('d')
+        self._indexes = {stage: i * _STAGE_FIELDS for i, stage in enumerate(STAGES)}
+        self._base = 0
+
+    def set_slot(self, slot: int):
+        self._base = slot * len(STAGES) * _STAGE_FIELDS
+
+    def add(self, stage: str, elapsed: float):
+        i = self._base + self._indexes[stage]
+        values = self.values
+        values[i] += 1
+        values[i + 1] += elapsed
+        if elapsed > values[i + 2]:
+            values[i + 2] = elapsed
+
+    def timed(self, stage: str, function: Callable) -> Callable:
+        """
+        function を呼ぶたびに stage の時間を記録する関数を返す
+        """
+        perf_counter = time.perf_counter
+
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, perf_counter() - started)
+        return wrapper
+
+    def summary(self) -> Dict[str, dict]:
+        """
+        全プロセスの合計 (呼ばれなかったステージは含めない)
+        """
+        summary = {}
+        for stage, index in self._indexes.items():
+            count = total = longest = 0.0
+            for slot in range(self.processes):
+                i = slot * len(STAGES) * _STAGE_FIELDS + index
+                count += self.values[i]
+                total += self.values[i + 1]
+                longest = max(longest, self.values[i + 2])
+            if count:
+                summary[stage] = {'count': int(count), 'total': total, 'mean': total / count, 'max': longest}
+        return summary
+
+
+class _Sampler(threading.Thread):
+    """
+    自プロセスの全スレッドのスタックを一定間隔で取る (待ち時間も含む実時間のサンプリング)
+    """
+
+    def __init__(self, role: str, interval: float, stop_all, on_stopped: Callable[[str, Counter], None]):
+        super().__init__(name=PROFILER_THREAD + '-sampler', daemon=True)
+        self.role = role
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop_all = stop_all
+        self._stopped = threading.Event()
+        self._on_stopped = on_stopped
+
+    def run(self):
+        while not self._stopped.wait(self.interval) and not self._stop_all.is_set():
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, str(ident))
+                if not name.startswith(PROFILER_THREAD):
+                    self.samples[self._fold(name, frame)] += 1
+        self._on_stopped(self.role, self.samples)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def _fold(self, thread_name: str, frame) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        stack.append(thread_name)
+        stack.append(self.role)
+        # flame graphのfolded形式 (根から順に ; で区切る)
+        return ';'.join(reversed(stack))
+
+
+class Profiler:
+    """
+    --profile: ダウンロード中の各プロセスをサンプリングし、親プロセスでまとめて出力する
+
+    各プロセスは fork 後に start(role, slot) を呼ぶ。子プロセスのサンプルは stop_all が立った時か
+    自分で stop() した時にキューで親へ送られ、親の finish() が合算して
+    path + '.folded' (flamegraph.pl や speedscope でそのまま読める形式) に書き出し、
+    関数ごとのコストとステージ計測をログに出す。
+    """
+
+    def __init__(self, path: str, processes: int = 1, interval: float = PROFILE_INTERVAL):
+        """
+        :param processes: サンプリングするプロセス数 (親を含む)
+        """
+        self.path = path
+        self.interval = interval
+        self.stages = StageTimers(processes)
+        self._stop_all = multiprocessing.Event()
+        self._results = multiprocessing.Queue()
+        self._sampler: Optional[_Sampler] = None
+        self._samples: Dict[str, Counter] = {}
+        self._received = threading.Condition()
+        self._is_parent = True
+
+    def start(self, role: str, slot: int = 0):
+        self.stages.set_slot(slot)
+        self._is_parent = slot == 0
+        if self._is_parent:
+            # 子プロセスがパイプに書き切れず終了できなくならないよう、届いた分はすぐに受け取る
+            threading.Thread(target=self._receive, name=PROFILER_THREAD + '-receiver', daemon=True).start()
+        self._sampler = _Sampler(role, self.interval, self._stop_all, self._on_stopped)
+        self._sampler.start()
+
+    def stop(self):
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler = None
+
+    def _on_stopped(self, role: str, samples: Counter):
+        if self._is_parent:
+            self._add(role, samples)
+        else:
+            self._results.put((role, dict(samples)))
+
+    def _receive(self):
+        while True:
+            result = self._results.get()
+            if result is None:
+                return
+            role, counts = result
+            self._add(role, Counter(counts))
+
+    def _add(self, role: str, samples: Counter):
+        with self._received:
+            self._samples[role] = samples
+            self._received.notify_all()
+
+    def finish(self, children: int = 0) -> Dict[str, Counter]:
+        """
+        親プロセスで呼ぶ 子プロセスのサンプルを集めて書き出す
+        :param children: サンプルを送ってくる子プロセスの数
+        """
+        self.stop()
+        self._stop_all.set()
+        with self._received:
+            if not self._received.wait_for(lambda: len(self._samples) > children, PROFILE_COLLECT_TIMEOUT):
+                logger.warning("profile: some processes did not send their samples")
+            samples = dict(self._samples)
+        self._results.put(None)
+
+        self.write(samples)
+        self.log(samples)
+        return samples
+
+    def write(self, samples: Dict[str, Counter]):
+        path = self.path + '.folded'
+        with open(path, 'w') as file:
+            for counts in samples.values():
+                for stack, count in counts.most_common():
+                    file.write(f"{stack} {count}\n")
+        logger.info(f"profile: {sum(sum(c.values()) for c in samples.values())} samples written to {path}")
+
+    def log(self, samples: Dict[str, Counter]):
+        for line in function_costs(samples, PROFILE_TOP):
+            logger.info(line)
+        for stage, s in self.stages.summary().items():
+            logger.info(f"stage {stage:>18}: {s['count']:>8} calls, total {s['total']:.3f}s, "
+                        f"mean {s['mean'] * 1e6:.1f}us, max {s['max'] * 1e3:.2f}ms")
+
+
+def function_costs(samples: Dict[str, Counter], top: int = PROFILE_TOP) -> List[str]:
+    """
+    プロセス(role)・関数ごとの self (その関数自体) と total (呼び出し先を含む) のサンプル数の表
+    """
+    own: Counter = Counter()
+    cumulative: Counter = Counter()
+    totals: Counter = Counter()
+    for role, counts in samples.items():
+        for stack, count in counts.items():
+            # 先頭の2つは role とスレッド名
+            frames = stack.split(';')[2:]
+            totals[role] += count
+            if not frames:
+                continue
+            own[role, frames[-1]] += count
+            for frame in set(frames):
+                cumulative[role, frame] += count
+
+    lines = [f"{'process':>10} {'self%':>6} {'total%':>7}  function"]
+    for (role, frame), count in own.most_common(top):
+        lines.append(f"{role:>10} {count / totals[role] * 100:>6.1f} "
+                     f"{cumulative[role, frame] / totals[role] * 100:>7.1f}  {frame}")
+    return lines
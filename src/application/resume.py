@@ -0,0 +1,179 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set, Tuple
+
+from src.domain.entity.piece.piece import Piece
+from src.infrastructure.storage import Storage
+
+from logger import logger
+
+RESUME_FILE = '.resume'
+JOURNAL_FILE = '.resume.journal'
+
+
+class ResumeData:
+    """
+    書き込み済みpieceの記録 (<CACHE_PATH>/<name>/.resume)
+
+    piece_index -> (サイズ, mtime_ns) を保存しておき、再起動時は Storage.stat() がそれと一致する
+    pieceを再ハッシュせずに完了扱いにする(fast check)。
+
+    mtime はファイル単位なので、最後の保存の後に他のpieceを書き込むと記録済みpieceの mtime も変わる。
+    そのため保存の後に完了したpieceは .resume.journal に追記しておき(次の保存で消す)、
+    mtime の変わったファイルが全てジャーナルのpieceの書き込み先なら記録済みpieceはそのまま信用する。
+    中断した後に再ハッシュするのはジャーナルのpieceと、説明のつかない変更があったファイルのpieceだけ。
+    rehash=True の場合は記録に無い・一致しないpieceも再ハッシュする。
+    """
+
+    def __init__(self, directory: str, info_hash: str, storage: Storage):
+        self.path = os.path.join(directory, RESUME_FILE)
+        self.journal_path = os.path.join(directory, JOURNAL_FILE)
+        self.info_hash = info_hash
+        self.storage = storage
+        self.pieces: Dict[int, Tuple[int, int]] = {}
+        # 最後の保存の後に完了したpiece (前回の実行でジャーナルに残っていたものを含む)
+        self.journal: Set[int] = set()
+        self.dirty = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            # 最初の保存より前に中断した場合もジャーナルのpieceは再ハッシュで確認できる
+            self._load_journal()
+            return
+        except (ValueError, OSError) as e:
+            logger.warning(f"ignore broken resume file: {e}")
+            return
+
+        if data.get('info_hash') != self.info_hash:
+            logger.warning("ignore resume file of another torrent")
+            return
+        self.pieces = {int(index): (size, mtime) for index, (size, mtime) in data['pieces'].items()}
+        self._load_journal()
+
+    def _load_journal(self):
+        try:
+            with open(self.journal_path) as file:
+                lines = file.read().split('\n')
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.warning(f"ignore broken resume journal: {e}")
+            return
+        # 書きかけの最後の行は読み捨てる
+        for line in lines[:-1]:
+            try:
+                self.journal.add(int(line))
+            except ValueError:
+                logger.warning(f"ignore broken resume journal record: {line!r}")
+
+    def save(self):
+        if not self.dirty:
+            return
+        if self.storage.stat_changes_on_write:
+            # 後から書き込んだpieceで mtime が変わるので保存時点の値に揃える
+            cache = {}
+            for index, (size, _) in list(self.pieces.items()):
+                stat = self.storage.stat(index, size, cache)
+                if stat is None:
+                    del self.pieces[index]
+                else:
+                    self.pieces[index] = stat
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'info_hash': self.info_hash,
+                       'pieces': {str(index): stat for index, stat in self.pieces.items()}}, file)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+        if self.journal:
+            # ジャーナルのpieceは全て今の mtime で保存した
+            self.journal.clear()
+            try:
+                os.remove(self.journal_path)
+            except FileNotFoundError:
+                pass
+
+    def add(self, piece: Piece):
+        stat = self.storage.stat(piece.piece_index, piece.piece_size)
+        if stat is None:
+            logger.error(f"piece {piece.piece_index} is not on the storage")
+            return
+        self.pieces[piece.piece_index] = stat
+        self.dirty = True
+        if self.storage.stat_changes_on_write and piece.piece_index not in self.journal:
+            self.journal.add(piece.piece_index)
+            with open(self.journal_path, 'a') as file:
+                file.write(f'{piece.piece_index}\n')
+
+    def remove(self, piece_index: int):
+        if self.pieces.pop(piece_index, None) is not None:
+            self.dirty = True
+
+    def fast_check(self, pieces: List[Piece], rehash: bool = False, workers: int = 4) -> List[Piece]:
+        """
+        ディスク上の既存pieceを確認する
+        :return: 完了扱いにしてよいpiece
+        """
+        trusted = []
+        candidates = []
+        cache = {}
+        # 前回の最後の保存の後に書き込んだファイル
+        written = set()
+        for piece in pieces:
+            if piece.piece_index in self.journal:
+                written.update(self.storage.file_mtimes(piece.piece_index, cache))
+
+        for piece in pieces:
+            stat = self.storage.stat(piece.piece_index, piece.piece_size, cache)
+            if stat is None:
+                continue
+
+            recorded = self.pieces.get(piece.piece_index)
+            if recorded == stat:
+                trusted.append(piece)
+            elif piece.piece_index in self.journal:
+                candidates.append(piece)
+            elif recorded is not None and recorded[0] == stat[0]:
+                if self._changed_by_journal(piece, recorded[1], written, cache):
+                    self.pieces[piece.piece_index] = stat
+                    self.dirty = True
+                    trusted.append(piece)
+                else:
+                    candidates.append(piece)
+            elif rehash:
+                candidates.append(piece)
+
+        if candidates:
+            with ThreadPoolExecutor(workers) as executor:
+                for piece, ok in zip(candidates, executor.map(self._hash_piece, candidates)):
+                    if ok:
+                        self.add(piece)
+                        trusted.append(piece)
+
+        # 記録と一致しなかったものは忘れる
+        valid = {piece.piece_index for piece in trusted}
+        for index in list(self.pieces):
+            if index not in valid:
+                del self.pieces[index]
+                self.dirty = True
+        if self.journal:
+            # 次の保存で今の mtime を記録してジャーナルを消す
+            self.dirty = True
+        return trusted
+
+    def _changed_by_journal(self, piece: Piece, recorded_mtime: int, written: Set, cache: Dict) -> bool:
+        """
+        保存の後に mtime が変わったファイルが全て、ジャーナルのpieceを書き込んだファイルか
+        """
+        if not written:
+            return False
+        return all(file in written for file, mtime in self.storage.file_mtimes(piece.piece_index, cache).items()
+                   if mtime > recorded_mtime)
+
+    def _hash_piece(self, piece: Piece) -> bool:
+        data = self.storage.read(piece.piece_index, 0, piece.piece_size)
+        return piece.is_valid(data)
@@ -0,0 +1,52 @@
+import math
+
+
+class RttEstimator:
+    """
+    RTT推定とRTO計算 (RFC 6298)
+
+    SRTT/RTTVAR をInterestごとのRTTサンプルで更新し、
+    RTO = SRTT + max(G, K * RTTVAR) を [min_rto, max_rto] に収める。
+    """
+
+    def __init__(self, initial_rto: float = 1.0, min_rto: float = 0.2, max_rto: float = 4.0):
+        self.alpha = 1 / 8
+        self.beta = 1 / 4
+        self.k = 4
+        self.granularity = 0.001  # 時計の粒度 G
+
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+        self.srtt = None
+        self.rttvar = None
+        self.min_rtt = math.inf
+        self.rto = initial_rto
+
+    def update(self, rtt: float):
+        if rtt < 0:
+            return
+
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.min_rtt = min(self.min_rtt, rtt)
+
+        self.rto = self.srtt + max(self.granularity, self.k * self.rttvar)
+        self.rto = min(max(self.rto, self.min_rto), self.max_rto)
+
+    def backoff(self):
+        """
+        タイムアウト時にRTOを倍にする 次の有効なサンプルで元に戻る
+        """
+        self.rto = min(self.rto * 2, self.max_rto)
+
+    @property
+    def smoothed(self) -> float:
+        """
+        SRTT まだサンプルが無ければRTO
+        """
+        return self.rto if self.srtt is None else self.srtt
@@ -0,0 +1,206 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from src.application import bittorrent
+from src.application.bittorrent import BitTorrent, NAME_PREFIX, CHUNK_SIZE, RECEIVE_TIMEOUT_MS, STORAGE, \
+    piece_name, parse_piece_name, parse_hashes_name
+from src.application.cache_manager import CacheManager
+from src.application.resume import ResumeData
+from src.domain.entity.layout import TorrentLayout
+from src.domain.entity.piece.block_state import BlockStates
+from src.domain.entity.piece.merkle import merkle_pieces, leaf_hashes
+from src.domain.entity.piece.piece import Piece
+from src.domain.entity.torrent import Torrent
+from src.infrastructure.storage import Storage, PieceFileStorage, SingleFileStorage
+
+from logger import logger
+
+HOT_PIECES = 64  # 読み出したpieceを保持しておく数 (LRU)
+PARSED_NAMES = 16384  # 既定以外の大きさのData名の解析結果を保持しておく数 (LRU)
+STATS_INTERVAL = 1
+
+
+class Seeder:
+    """
+    ダウンロード済みのpieceを配信するプロデューサー
+
+    ccnx:/BitTorrent/<info_hash> を登録し、<prefix>/<piece_index> の chunk_num 番目のInterestに
+    CHUNK_SIZE ずつDataを返す。Data名に大きさを含むInterest (ccnx:/BitTorrent/<info_hash>/<chunk_size>/<piece_index>)
+    にはその大きさで返す。配信するのはresumeファイルで書き込み済みと確認できたpieceだけ。
+    v2のtorrentでは <prefix>/hashes/<piece_index> に、そのpieceの葉(16KiB)のSHA-256を連結して1つのDataで返す
+    (pieceごとに1回だけ計算して保持する)。
+    ファイルは起動時に開いたまま(SingleFileStorageはファイルごとのmmap)にしておき、
+    最近要求されたpieceの読み出し結果(memoryview)を HOT_PIECES 個までLRUで保持する。
+    配信中のtorrentはキャッシュから追い出されないよう pin し、ストレージから読み出すたびにアクセスを記録する。
+    """
+
+    def __init__(self, torrent: Torrent, cef_handle=None, storage: str = STORAGE,
+                 hot_pieces: int = HOT_PIECES, rehash: bool = False):
+        self.info = torrent.info
+        self.info_hash = str(torrent.info_hash.hex())
+        self.file_path = bittorrent.CACHE_PATH + self.info.name
+        self.name = NAME_PREFIX + self.info_hash
+
+        layout = TorrentLayout.from_torrent(torrent)
+        self.piece_sizes = layout.piece_sizes()
+        self.number_of_pieces = layout.number_of_pieces
+        # Data名 -> (piece_index, chunk_size) 既定の大きさの名前は先に作り、
+        # それ以外は届いた時に解析して PARSED_NAMES 個までLRUで覚える
+        self.name_to_piece: Dict[str, Tuple[int, int]] = {
+            piece_name(self.info_hash, i): (i, CHUNK_SIZE) for i in range(self.number_of_pieces)}
+        self.parsed_names: 'OrderedDict[str, Tuple[int, int]]' = OrderedDict()
+        self.storage: Storage = self._create_storage(storage, layout)
+
+        self.cache = CacheManager(bittorrent.CACHE_PATH)
+        self.cache.register(self.info_hash, self.info.name, storage, layout)
+        self.cache.pin(self.info_hash)
+
+        # 書き込み済みと確認できたpieceだけを配信する
+        self.merkle = merkle_pieces(torrent, layout)
+        block_states = BlockStates(self.piece_sizes, CHUNK_SIZE)
+        piece_hashes = getattr(self.info, 'piece_hashes', None) or [None] * self.number_of_pieces
+        merkle = self.merkle or [None] * self.number_of_pieces
+        pieces = [Piece(i, piece_size, piece_hash, self.storage, block_states.piece(i), merkle=merkle[i])
+                  for i, (piece_size, piece_hash) in enumerate(zip(self.piece_sizes, piece_hashes))]
+        resume = ResumeData(self.file_path, self.info_hash, self.storage)
+        trusted = resume.fast_check(pieces, rehash)
+        self.available = bytearray(self.number_of_pieces)
+        for piece in trusted:
+            self.available[piece.piece_index] = 1
+        resume.save()
+        self.cache.sync(self.info_hash, [(piece.piece_index, piece.piece_size) for piece in trusted])
+        logger.info(f"seed: {sum(self.available)} / {self.number_of_pieces} pieces")
+
+        self.hot_pieces = hot_pieces
+        self.piece_cache: 'OrderedDict[int, memoryview]' = OrderedDict()
+        # v2: piece_index -> 葉のハッシュを連結したpayload (1pieceにつき葉の数 x 32byte)
+        self.leaf_hash_payloads: Dict[int, bytes] = {}
+
+        if cef_handle is None:
+            cef_handle = BitTorrent.create_handle()
+        self.cef_handle = cef_handle
+        self.stopped = False
+
+        self.num_of_interests = 0
+        self.num_of_data = 0
+        self.num_of_bytes = 0
+        self.num_of_misses = 0  # 持っていないpiece・範囲外のchunkへのInterest
+        self.num_of_reads = 0  # LRUに無くストレージから読み出した回数
+
+    def _create_storage(self, storage: str, layout: TorrentLayout) -> Storage:
+        if storage == 'piece':
+            return PieceFileStorage(self.file_path, self.info.piece_length)
+        return SingleFileStorage(self.file_path, layout)
+
+    def run(self):
+        self.cef_handle.register(self.name)
+        logger.info(f"seeding {self.name}")
+        try:
+            last_seen_time = time.time()
+            last_bytes = 0
+            while not self.stopped:
+                # 1回起きたら届いている分を全て処理する
+                info = self.cef_handle.receive(timeout_ms=RECEIVE_TIMEOUT_MS)
+                while info.is_succeeded:
+                    self.handle_interest(info)
+                    info = self.cef_handle.receive(timeout_ms=0)
+
+                now = time.time()
+                if now - last_seen_time > STATS_INTERVAL:
+                    rate = (self.num_of_bytes - last_bytes) * 8 / (now - last_seen_time) / 1024 ** 2
+                    logger.info(f"seed: {rate:.1f} Mbps, data {self.num_of_data}, "
+                                f"miss {self.num_of_misses}, read {self.num_of_reads}")
+                    last_seen_time = now
+                    last_bytes = self.num_of_bytes
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.piece_cache.clear()
+            self.storage.close()
+            self.cache.unpin(self.info_hash)
+
+    def stop(self):
+        self.stopped = True
+
+    def handle_interest(self, info):
+        if not info.is_interest:
+            return
+        self.num_of_interests += 1
+        target = self.lookup(info.name)
+        if target is None and self.merkle is not None:
+            self.send_leaf_hashes(info)
+            return
+        if target is None or not self.available[target[0]]:
+            self.num_of_misses += 1
+            return
+
+        piece_index, chunk_size = target
+        offset = info.chunk_num * chunk_size
+        piece_size = self.piece_sizes[piece_index]
+        if not 0 <= offset < piece_size:
+            self.num_of_misses += 1
+            return
+
+        piece = self.get_piece(piece_index)
+        payload = bytes(piece[offset:offset + chunk_size])
+        self.cef_handle.send_data(info.name, payload, info.chunk_num,
+                                  end_chunk_num=(piece_size - 1) // chunk_size)
+        self.num_of_data += 1
+        self.num_of_bytes += len(payload)
+
+    def send_leaf_hashes(self, info):
+        parsed = parse_hashes_name(info.name)
+        if parsed is None or parsed[0] != self.info_hash or not 0 <= parsed[1] < self.number_of_pieces \
+                or not self.available[parsed[1]] or self.merkle[parsed[1]] is None:
+            self.num_of_misses += 1
+            return
+        piece_index = parsed[1]
+        payload = self.leaf_hash_payloads.get(piece_index)
+        if payload is None:
+            piece = self.get_piece(piece_index)
+            payload = self.leaf_hash_payloads[piece_index] = \
+                b''.join(leaf_hashes(piece[:self.merkle[piece_index].length]))
+        self.cef_handle.send_data(info.name, payload, 0, end_chunk_num=0)
+        self.num_of_data += 1
+        self.num_of_bytes += len(payload)
+
+    def lookup(self, name: str) -> Optional[Tuple[int, int]]:
+        """
+        :return: (piece_index, chunk_size) / このtorrentのpieceの名前でなければNone
+        """
+        target = self.name_to_piece.get(name)
+        if target is not None:
+            return target
+        parsed_names = self.parsed_names
+        target = parsed_names.get(name)
+        if target is not None:
+            parsed_names.move_to_end(name)
+            return target
+
+        parsed = parse_piece_name(name)
+        if parsed is None or parsed[0] != self.info_hash or not 0 <= parsed[2] < self.number_of_pieces:
+            return None
+        _, chunk_size, piece_index = parsed
+        # 同じpieceの別の書き方 ("+4096", "04096" など) は piece_name() の出力と違うので受け付けない
+        if name != piece_name(self.info_hash, piece_index, chunk_size):
+            return None
+        target = parsed_names[name] = (piece_index, chunk_size)
+        if len(parsed_names) > PARSED_NAMES:
+            parsed_names.popitem(last=False)
+        return target
+
+    def get_piece(self, piece_index: int) -> memoryview:
+        cache = self.piece_cache
+        piece = cache.get(piece_index)
+        if piece is not None:
+            cache.move_to_end(piece_index)
+            return piece
+
+        self.num_of_reads += 1
+        self.cache.touch(self.info_hash, piece_index)
+        piece = memoryview(self.storage.view(piece_index, self.piece_sizes[piece_index]))
+        cache[piece_index] = piece
+        if len(cache) > self.hot_pieces:
+            cache.popitem(last=False)
+        return piece
@@ -0,0 +1,95 @@
+import io
+from typing import Iterator
+
+
+class StreamReader(io.RawIOBase):
+    """
+    ダウンロード中のtorrent(またはその中の1ファイル)を先頭から読むためのファイルオブジェクト
+
+    検証済みのpieceはすぐに読み、未取得のpieceを読む時だけその検証が終わるまで待つ。
+    読み出し位置のpieceを BitTorrent.set_stream_cursor で requester に伝えるので、
+    picker が 'streaming' なら読み出し位置の先から優先して要求される。
+    BitTorrent.run は別スレッドで動かしておく。
+    """
+
+    def __init__(self, bittorrent, file_index: int = None, timeout: float = None):
+        """
+        :param file_index: マルチファイルの場合に読むファイル / Noneならtorrent全体
+        :param timeout: 1つのpieceを待つ上限[s] 超えたら TimeoutError
+        """
+        super().__init__()
+        self.bittorrent = bittorrent
+        self.layout = bittorrent.layout
+        if file_index is None:
+            self.start, self.length = 0, self.layout.length
+        else:
+            file = self.layout.files[file_index]
+            self.start, self.length = file.offset, file.length
+        self.timeout = timeout
+        self.position = 0
+        # run() の終了時にStorageが閉じられても読めるように専用のハンドルを使う
+        self.storage = bittorrent.storage.reader()
+        self._cursor = None
+        self._update_cursor()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.position = max(offset, 0)
+        self._update_cursor()
+        return self.position
+
+    def readinto(self, b) -> int:
+        """
+        1回の呼び出しでは1つのpieceに収まる範囲だけ読む
+        """
+        remaining = self.length - self.position
+        if remaining <= 0:
+            return 0
+
+        piece_length = self.layout.piece_length
+        position = self.start + self.position
+        piece_index = position // piece_length
+        offset = position - piece_index * piece_length
+        n = min(len(b), remaining, self.layout.piece_size(piece_index) - offset)
+
+        self.bittorrent.wait_for_piece(piece_index, self.timeout)
+        data = self.storage.read(piece_index, offset, n)
+        b[:len(data)] = data
+        self.position += len(data)
+        self._update_cursor()
+        return len(data)
+
+    def chunks(self) -> Iterator[bytes]:
+        """
+        検証済みのデータをpiece単位(先頭と末尾は途中から・途中まで)で返す
+        """
+        piece_length = self.layout.piece_length
+        while True:
+            data = self.read(piece_length)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        if not self.closed:
+            self.storage.close()
+        super().close()
+
+    def _update_cursor(self):
+        position = min(self.start + self.position, max(self.layout.length - 1, 0))
+        piece_index = position // self.layout.piece_length
+        if piece_index != self._cursor:
+            self._cursor = piece_index
+            self.bittorrent.set_stream_cursor(piece_index)
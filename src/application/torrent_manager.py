@@ -0,0 +1,215 @@
+import asyncio
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from src.application import metrics as m
+from src.application.async_bittorrent import AsyncBitTorrent, receive_loop, run_until, WINDOW_INTERVAL, TIMER_INTERVAL
+from src.application.bittorrent import BitTorrent, CONGESTION_CONTROL, NAME_PREFIX, TIME_OUT, VERIFY_WORKERS, \
+    VERIFY_QUEUE_SIZE, METRICS_PATH, METRICS_PORT, METRICS_HOST, PROFILE_PATH
+from src.application.congestion_controls import create_congestion_control
+from src.application.metrics import MetricsExporter
+from src.application.profiler import Profiler
+from src.application.rtt_estimator import RttEstimator
+from src.domain.entity.torrent import Torrent
+
+from logger import logger
+
+INFO_HASH_START = len(NAME_PREFIX)
+
+
+class TorrentManager:
+    """
+    複数のtorrentを1つのCCN face・1つのイベントループで同時にダウンロードする
+
+    Dataは名前の ccnx:/BitTorrent/<info_hash> で振り分ける。
+    輻輳制御はface全体で1つとし、そのウィンドウ(max_outstanding があればそれ以下)を
+    応答待ちInterestの全体の予算として、未完了のtorrentに weight の比で分ける。
+    要求するブロックが無くなったtorrentの余りは他のtorrentが使う。
+    """
+
+    def __init__(self, congestion_control: str = CONGESTION_CONTROL, cef_handle=None,
+                 max_outstanding: int = None, metrics_path: str = METRICS_PATH, metrics_port: int = METRICS_PORT,
+                 profile_path: str = PROFILE_PATH, metrics_host: str = METRICS_HOST):
+        if cef_handle is None:
+            cef_handle = BitTorrent.create_handle()
+        self.cef_handle = cef_handle
+        self.congestion_control = create_congestion_control(congestion_control, RttEstimator(max_rto=TIME_OUT))
+        self.max_outstanding = max_outstanding
+        self.metrics_path = metrics_path
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.exporter = None
+        self.profile_path = profile_path
+        self.profiler = None
+
+        self.sessions: Dict[str, AsyncBitTorrent] = {}
+        self.weights: Dict[str, float] = {}
+        self._turn = 0
+
+    def add(self, torrent: Torrent, weight: float = 1, **kwargs) -> AsyncBitTorrent:
+        """
+        :param kwargs: AsyncBitTorrent へそのまま渡す (rehash, storage, picker など)
+        """
+        session = AsyncBitTorrent(torrent, self.congestion_control.name, self.cef_handle, **kwargs)
+        session.congestion_control = self.congestion_control
+        self.sessions[session.info_hash] = session
+        self.weights[session.info_hash] = weight
+        return session
+
+    def run(self):
+        try:
+            if self.profile_path is not None:
+                self.profiler = Profiler(self.profile_path)
+                self.profiler.start('manager')
+                for session in self.sessions.values():
+                    session.profiler = self.profiler
+                    session.time_stages()
+            started_time = time.time()
+            if self.metrics_path is not None or self.metrics_port is not None:
+                self.exporter = MetricsExporter([(session.collect_metrics, {'torrent': session.info.name})
+                                                 for session in self.sessions.values()],
+                                                self.metrics_path, self.metrics_port, self.metrics_host)
+            asyncio.run(self.main())
+
+            logger.info(f'download time: {(time.time() - started_time):.2f}')
+            if self.profiler is not None:
+                self.profiler.finish()
+        except Exception as e:
+            logger.error(e)
+            raise e
+        except KeyboardInterrupt:
+            return
+        finally:
+            if self.exporter is not None:
+                self.exporter.close()
+            for session in self.sessions.values():
+                session.notify_piece_completed(stopped=True)
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        self.window_opened = asyncio.Event()
+        verify_executor = ThreadPoolExecutor(VERIFY_WORKERS)
+        verify_slots = asyncio.Semaphore(VERIFY_QUEUE_SIZE)
+        for session in self.sessions.values():
+            session.prepare(self.window_opened, verify_executor, verify_slots)
+
+        tasks = [loop.create_task(coroutine) for coroutine in
+                 (self.receiver(), self.sender(), self.timer(), self.progress())]
+        try:
+            await run_until(asyncio.gather(*(self.wait_session(session) for session in self.sessions.values())),
+                            tasks + [session.failure for session in self.sessions.values()])
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            verify_executor.shutdown(wait=True)
+            for session in self.sessions.values():
+                session.loop = None
+                if not session.completed.is_set():
+                    session.finish()
+
+    async def wait_session(self, session: AsyncBitTorrent):
+        await session.completed.wait()
+        session.finish()
+        logger.info(f'{session.info.name}: download time: {(time.time() - session.started_time):.2f}')
+        session.stop_metrics()
+
+    async def receiver(self):
+        await receive_loop(self.cef_handle, self.handle_data)
+
+    def handle_data(self, info):
+        if not info.is_succeeded:
+            return
+        # ccnx:/BitTorrent/<info_hash>/<piece_index> の info_hash だけ切り出して振り分ける
+        name = info.name
+        session = self.sessions.get(name[INFO_HASH_START:name.find('/', INFO_HASH_START)])
+        if session is None:
+            logger.debug(f"unexpected name: {name}")
+            return
+        session.handle_data(info)
+
+    def active_sessions(self) -> List[AsyncBitTorrent]:
+        return [session for session in self.sessions.values() if not session.completed.is_set()]
+
+    async def sender(self):
+        while True:
+            self.window_opened.clear()
+            self.send_interests()
+            try:
+                await asyncio.wait_for(self.window_opened.wait(), WINDOW_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def send_interests(self):
+        """
+        全体の予算を weight の比で分けて送り、使われなかった分を順番に他のtorrentへ回す
+        """
+        sessions = self.active_sessions()
+        if not sessions:
+            return
+        pending = [session.scheduler.num_of_pending for session in sessions]
+        self.congestion_control.now_wind = sum(pending)
+
+        budget = self.congestion_control.window
+        if self.max_outstanding is not None:
+            budget = min(budget, self.max_outstanding)
+        room = math.ceil(budget - self.congestion_control.now_wind)
+        if room <= 0:
+            return
+
+        total_weight = sum(self.weights[session.info_hash] for session in sessions)
+        for session, n in zip(sessions, pending):
+            share = math.ceil(budget * self.weights[session.info_hash] / total_weight) - n
+            if share > 0:
+                room -= session.send_interests(min(share, room))
+            if room <= 0:
+                return
+
+        # 開始位置を毎回ずらして同じtorrentばかりに余りが回らないようにする
+        self._turn = (self._turn + 1) % len(sessions)
+        for session in sessions[self._turn:] + sessions[:self._turn]:
+            room -= session.send_interests(room)
+            if room <= 0:
+                return
+
+    async def timer(self):
+        while True:
+            deadlines = [deadline for deadline in (session.scheduler.next_deadline()
+                                                   for session in self.active_sessions())
+                         if deadline is not None]
+            delay = TIMER_INTERVAL if not deadlines else min(deadlines) - time.time()
+            await asyncio.sleep(min(max(delay, 0), TIMER_INTERVAL))
+
+            now = time.time()
+            expired = False
+            for session in self.active_sessions():
+                timeouts = session.scheduler.expire(now)
+                if timeouts:
+                    session.metrics.values[m.TIMEOUTS] += len(timeouts)
+                    expired = True
+            if expired:
+                self.congestion_control.on_timeout()
+                self.window_opened.set()
+
+    async def progress(self):
+        while True:
+            await asyncio.sleep(1)
+            self.print_progress()
+            for session in self.active_sessions():
+                session.save_resume()
+            if self.exporter is not None:
+                self.exporter.export()
+
+    def print_progress(self):
+        cc = self.congestion_control
+        print(f'{cc.name}_window: {int(cc.window)}, now_window: {cc.now_wind}, rto: {cc.rtt.rto * 1000:.0f}ms')
+        now = time.time()
+        for session in self.sessions.values():
+            completion = session.completion
+            rate = completion.update_rate(now)
+            eta = completion.eta
+            print(f'  {session.info.name}: {completion.pieces} / {session.number_of_pieces} pieces, '
+                  f'{rate * 8 / 1024 ** 2:.1f}Mbps, ETA: {"-" if eta is None else f"{eta:.1f}s"}, '
+                  f'pending: {session.scheduler.num_of_pending}')
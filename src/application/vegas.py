@@ -0,0 +1,62 @@
+from src.application.congestion_control import CongestionControl, MIN_WINDOW
+
+
+class Vegas(CongestionControl):
+    """
+    遅延ベース(TCP Vegas型)のウィンドウ制御
+
+    1RTTごとに、最小RTTから見た期待スループットと実測スループットの差から
+    ボトルネックのキューに溜まっているInterest数 diff を推定し、
+        diff < alpha なら +1, diff > beta なら -1
+    とする。slow start は diff が gamma を超えるまで1RTTごとに倍にする。
+    """
+    name = 'vegas'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.alpha = 2
+        self.beta = 4
+        self.gamma = 1
+
+        self.diff = 0
+        self._epoch_end = 0
+        self._rtt_sum = 0.0
+        self._rtt_count = 0
+
+    def on_data(self, rtt: float = None):
+        super().on_data(rtt)
+        if rtt is not None:
+            self._rtt_sum += rtt
+            self._rtt_count += 1
+
+        now = self.clock()
+        if now < self._epoch_end:
+            return
+
+        # 1RTTに1回だけ調整する
+        if self._rtt_count > 0:
+            # time.time() の差は0になりうるので時計の粒度を下限にする
+            floor = self.rtt.granularity
+            current_rtt = max(self._rtt_sum / self._rtt_count, floor)
+            self.diff = self.cwind * (1 - max(self.rtt.min_rtt, floor) / current_rtt)
+
+            if self.cwind < self.ssthresh:
+                if self.diff > self.gamma:
+                    self.ssthresh = self.cwind
+                else:
+                    self.cwind *= 2
+            elif self.diff < self.alpha:
+                self.cwind += 1
+            elif self.diff > self.beta:
+                self.cwind = max(self.cwind - 1, MIN_WINDOW)
+
+        self._rtt_sum = 0.0
+        self._rtt_count = 0
+        self._epoch_end = now + self.rtt.smoothed
+
+    def on_timeout(self) -> bool:
+        if not super().on_timeout():
+            return False
+        self.ssthresh = max(self.cwind / 2, MIN_WINDOW)
+        self.cwind = self.ssthresh
+        return True
@@ -0,0 +1,106 @@
+import os
+from typing import List, Tuple
+
+from src.domain.entity.torrent import Torrent, FileMode
+
+
+def check_path(path: List[str]):
+    """
+    torrentのファイル名は信用できないので、保存先ディレクトリの外を指すパスを弾く
+    """
+    if len(path) == 0:
+        raise ValueError("empty file path")
+    for component in path:
+        if not isinstance(component, str) or component in ('', '.', '..') or os.path.isabs(component) \
+                or '/' in component or (os.path.altsep is not None and os.path.altsep in component) \
+                or '\0' in component:
+            raise ValueError(f"invalid path component {component!r} in {path!r}")
+
+
+class FileEntry:
+    def __init__(self, path: List[str], offset: int, length: int, padding: bool = False):
+        self.path = path  # 保存先ディレクトリからのパス
+        self.offset = offset  # torrent全体でのオフセット
+        self.length = length
+        self.padding = padding  # pieceの境界を揃える詰め物 (中身は全て0でファイルは作らない)
+
+
+class TorrentLayout:
+    """
+    torrent全体のバイト列とファイルの対応表
+
+    piece i が掛かるファイルごとの範囲 (file_index, ファイル内のオフセット, 長さ) を起動時に全て計算しておき、
+    pieceの大きさの計算と、ファイルを跨ぐ読み書きに使う。
+    """
+
+    def __init__(self, files: List[tuple], piece_length: int):
+        """
+        :param files: (保存先ディレクトリからのパス, 長さ[, 詰め物か]) のリスト
+        """
+        self.piece_length = piece_length
+        self.files: List[FileEntry] = []
+        offset = 0
+        for path, length, *padding in files:
+            check_path(path)
+            self.files.append(FileEntry(path, offset, length, bool(padding and padding[0])))
+            offset += length
+        self.length = offset
+        self.number_of_pieces = -(-self.length // piece_length)
+
+        self.piece_spans: List[List[Tuple[int, int, int]]] = []
+        file_index = 0
+        for piece_index in range(self.number_of_pieces):
+            spans = []
+            position = piece_index * piece_length
+            remaining = self.piece_size(piece_index)
+            while remaining > 0:
+                file = self.files[file_index]
+                file_offset = position - file.offset
+                n = min(remaining, file.length - file_offset)
+                if n <= 0:
+                    file_index += 1
+                    continue
+                spans.append((file_index, file_offset, n))
+                position += n
+                remaining -= n
+            self.piece_spans.append(spans)
+
+    @classmethod
+    def from_torrent(cls, torrent: Torrent) -> 'TorrentLayout':
+        info = torrent.info
+        # 保存先ディレクトリ <CACHE_PATH>/<name> にも使う
+        check_path([info.name])
+        if torrent.file_mode == FileMode.single_file:
+            files = [([info.name], info.length)]
+        else:
+            files = [(file.path, file.length, file.padding) for file in info.files]
+        return cls(files, info.piece_length)
+
+    def piece_size(self, piece_index: int) -> int:
+        return min(self.piece_length, self.length - piece_index * self.piece_length)
+
+    def piece_sizes(self) -> List[int]:
+        return [self.piece_size(i) for i in range(self.number_of_pieces)]
+
+    def spans(self, piece_index: int, offset: int = 0, length: int = None) -> List[Tuple[int, int, int]]:
+        """
+        piece内の [offset, offset + length) が掛かるファイルごとの範囲 (ブロック単位の読み書き用)
+        """
+        piece_spans = self.piece_spans[piece_index]
+        if offset == 0 and length is None:
+            return piece_spans
+        if length is None:
+            length = self.piece_size(piece_index) - offset
+
+        spans = []
+        for file_index, file_offset, n in piece_spans:
+            if offset >= n:
+                offset -= n
+                continue
+            m = min(n - offset, length)
+            spans.append((file_index, file_offset + offset, m))
+            length -= m
+            offset = 0
+            if length <= 0:
+                break
+        return spans
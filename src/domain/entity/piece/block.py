@@ -1,20 +1,10 @@
-from enum import Enum
-import src.global_value as gv
+from enum import IntEnum
 
 
-class State(Enum):
+class State(IntEnum):
+    """
+    BlockStates の状態バイト (PENDING は BlockScheduler が自分のメモリに持ち、状態バイトには書かない)
+    """
     FREE = 0
     PENDING = 1
     FULL = 2
-
-
-class Block:
-    def __init__(self, state: State = State.FREE, block_size: int = gv.CHUNK_SIZE,
-                 data: bytes = b'', last_seen: float = 0):
-        self.state: State = state
-        self.block_size = block_size
-        self.data: bytes = data
-        self.last_seen: float = last_seen
-
-    def __str__(self):
-        return "%s - %d - %d - %d" % (self.state, self.block_size, len(self.data), self.last_seen)
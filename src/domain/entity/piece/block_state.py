@@ -0,0 +1,104 @@
+import mmap
+from array import array
+from typing import List
+
+import src.global_value as gv
+from src.domain.entity.piece.block import State
+
+
+class BlockStates:
+    """
+    torrent全体のブロック状態テーブル
+
+    ブロックごとのオブジェクトを作らず、全ブロックの状態を通し番号(global block index)で
+    bytearray に詰めて持つ。
+    各pieceからは PieceBlocks を通して自分の範囲だけを扱う。
+
+    shared=True の場合は無名共有メモリ(mmap)上に確保し、fork後の listener と requester が
+    同じテーブルを読み書きする。状態バイトを書くのは listener だけで、requester は読むだけ。
+        listener  - FULL (Piece.set_block) と、検証・書き込みの失敗時の FREE への初期化
+        requester - 読むだけ (PENDING と送信時刻は BlockScheduler が自分のメモリに持つ)
+    FULL が requester に上書きされることは無いので、受信したブロックは1回だけ数えられる。
+    """
+
+    def __init__(self, piece_sizes: List[int], chunk_size: int = gv.CHUNK_SIZE, shared: bool = False):
+        self.chunk_size = chunk_size
+        self.piece_sizes = piece_sizes
+
+        # piece i のブロックは [offsets[i], offsets[i + 1])
+        self.offsets = array('q', [0])
+        for piece_size in piece_sizes:
+            self.offsets.append(self.offsets[-1] + max(1, -(-piece_size // chunk_size)))
+
+        self.num_of_blocks = self.offsets[-1]
+        self.shared = shared
+        if shared:
+            self.states = mmap.mmap(-1, max(1, self.num_of_blocks))
+        else:
+            self.states = bytearray(self.num_of_blocks)
+
+    def __len__(self):
+        return self.num_of_blocks
+
+    def piece(self, piece_index: int) -> 'PieceBlocks':
+        return PieceBlocks(self, piece_index)
+
+    def global_index(self, piece_index: int, block_index: int) -> int:
+        return self.offsets[piece_index] + block_index
+
+    def count(self, state: State, start: int = 0, end: int = None) -> int:
+        # mmapにはcount()が無いので範囲をコピーして数える
+        if end is None:
+            end = self.num_of_blocks
+        return self.states[start:end].count(state)
+
+    def find(self, state: State, start: int, end: int) -> int:
+        return self.states.find(bytes((state,)), start, end)
+
+    def block_size(self, piece_index: int, block_index: int) -> int:
+        piece_size = self.piece_sizes[piece_index]
+        return min(self.chunk_size, piece_size - block_index * self.chunk_size)
+
+
+class PieceBlocks:
+    """
+    BlockStates のうち1piece分の範囲を指すビュー
+    """
+    __slots__ = ('table', 'piece_index', 'start', 'end')
+
+    def __init__(self, table: BlockStates, piece_index: int):
+        self.table = table
+        self.piece_index = piece_index
+        self.start = table.offsets[piece_index]
+        self.end = table.offsets[piece_index + 1]
+
+    def __len__(self):
+        return self.end - self.start
+
+    def state(self, block_index: int) -> State:
+        return State(self.table.states[self.start + block_index])
+
+    def set_state(self, block_index: int, state: State):
+        self.table.states[self.start + block_index] = state
+
+    def block_size(self, block_index: int) -> int:
+        return self.table.block_size(self.piece_index, block_index)
+
+    def count(self, state: State) -> int:
+        return self.table.count(state, self.start, self.end)
+
+    def find(self, state: State) -> int:
+        """
+        :return: 最初に state であるブロックのindex / 無ければ-1
+        """
+        index = self.table.find(state, self.start, self.end)
+        return -1 if index < 0 else index - self.start
+
+    def all_full(self) -> bool:
+        return self.count(State.FULL) == len(self)
+
+    def fill(self, state: State):
+        self.table.states[self.start:self.end] = bytes((state,)) * len(self)
+
+    def reset(self):
+        self.table.states[self.start:self.end] = bytes(len(self))
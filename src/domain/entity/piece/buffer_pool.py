@@ -0,0 +1,32 @@
+from collections import defaultdict
+from typing import Dict, List
+
+
+class BufferPool:
+    """
+    piece組み立て用バッファのプール
+
+    受信中のpieceはサイズ分のbytearrayを1つだけ持ち、ブロックをそのoffsetに直接書き込む。
+    ディスクへの書き込みが終わったバッファはここに返却して次のpieceで使い回す。
+    """
+
+    def __init__(self, max_buffers: int = 64):
+        self.max_buffers = max_buffers
+        self._free: Dict[int, List[bytearray]] = defaultdict(list)
+        self.num_of_free = 0
+        self.num_of_allocated = 0
+
+    def acquire(self, size: int) -> bytearray:
+        free = self._free[size]
+        if free:
+            self.num_of_free -= 1
+            return free.pop()
+
+        self.num_of_allocated += 1
+        return bytearray(size)
+
+    def release(self, buf: bytearray):
+        if self.num_of_free >= self.max_buffers:
+            return
+        self._free[len(buf)].append(buf)
+        self.num_of_free += 1
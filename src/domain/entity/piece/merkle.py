@@ -0,0 +1,119 @@
+import hashlib
+from typing import Dict, List, Optional
+
+from src.domain.entity.layout import TorrentLayout
+from src.domain.entity.torrent import Torrent
+
+"""
+BitTorrent v2 (BEP 52) のmerkle tree
+
+ファイルを BLOCK_SIZE ごとにSHA-256した値を葉とする2分木。葉の数は2のべきに揃え、
+ファイルの末尾より後ろの葉は ZERO_HASH とする。piece layers にはpieceごとの部分木の根
+(piece_length / BLOCK_SIZE 個の葉の根) が並び、1piece以下のファイルは pieces root がそのpieceの根になる。
+"""
+
+BLOCK_SIZE = 16 * 1024
+HASH_SIZE = 32
+ZERO_HASH = bytes(HASH_SIZE)
+
+
+def leaf_hashes(data) -> List[bytes]:
+    data = memoryview(data)
+    return [hashlib.sha256(data[i:i + BLOCK_SIZE]).digest() for i in range(0, len(data), BLOCK_SIZE)]
+
+
+def merkle_root(hashes: List[bytes], width: int, pad: bytes = ZERO_HASH) -> bytes:
+    """
+    :param width: 葉の数 (2のべき) hashes より後ろは pad で埋める
+    """
+    layer = list(hashes) + [pad] * (width - len(hashes))
+    while len(layer) > 1:
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+    return layer[0]
+
+
+def _next_power_of_two(n: int) -> int:
+    return 1 << max(n - 1, 0).bit_length()
+
+
+class MerklePiece:
+    """
+    v2のpiece1つ分の検証に使う値
+
+    root   - pieceの部分木の根 (piece layers の値、1piece以下のファイルでは pieces root)
+    width  - root の下の葉の数 (2のべき)
+    length - piece のうちファイルのデータの長さ (残りはv1のpieceに揃えるための詰め物)
+    """
+    __slots__ = ('root', 'width', 'length')
+
+    def __init__(self, root: bytes, width: int, length: int):
+        self.root = root
+        self.width = width
+        self.length = length
+
+    @property
+    def number_of_leaves(self) -> int:
+        return -(-self.length // BLOCK_SIZE)
+
+    def leaf_range(self, leaf: int) -> range:
+        """
+        :return: 葉が覆うpiece内のバイト範囲
+        """
+        start = leaf * BLOCK_SIZE
+        return range(start, min(start + BLOCK_SIZE, self.length))
+
+    def verify_layer(self, payload) -> Optional[List[bytes]]:
+        """
+        プロデューサーから受け取った葉のハッシュの並びを root と照合する
+        :return: 葉のハッシュのリスト / 一致しなければNone
+        """
+        payload = bytes(payload)
+        if len(payload) != self.number_of_leaves * HASH_SIZE:
+            return None
+        hashes = [payload[i:i + HASH_SIZE] for i in range(0, len(payload), HASH_SIZE)]
+        if merkle_root(hashes, self.width) != self.root:
+            return None
+        return hashes
+
+    def verify(self, data) -> bool:
+        return merkle_root(leaf_hashes(memoryview(data)[:self.length]), self.width) == self.root
+
+
+def merkle_pieces(torrent: Torrent, layout: TorrentLayout) -> Optional[List[Optional[MerklePiece]]]:
+    """
+    v2 (ハイブリッドを含む) のtorrentの各pieceの MerklePiece
+    piece layers は info_hash に含まれないので、各ファイルの pieces root と照合してから使う。
+    :return: v1のみのtorrentならNone / 詰め物だけのpieceはNone
+    """
+    info = torrent.info
+    if info.meta_version < 2:
+        return None
+    piece_length = layout.piece_length
+    if piece_length < BLOCK_SIZE or piece_length & (piece_length - 1):
+        raise ValueError(f"v2 piece length must be a power of two >= {BLOCK_SIZE}: {piece_length}")
+    width = piece_length // BLOCK_SIZE
+    pad_root = merkle_root([], width)
+
+    roots: Dict[tuple, bytes] = {tuple(file.path): file.pieces_root for file in info.file_tree}
+    pieces: List[Optional[MerklePiece]] = [None] * layout.number_of_pieces
+    for file in layout.files:
+        root = roots.get(tuple(file.path))
+        if file.padding or file.length == 0 or root is None:
+            continue
+        if file.offset % piece_length != 0:
+            raise ValueError(f"file is not aligned to a piece boundary: {'/'.join(file.path)}")
+        first = file.offset // piece_length
+        if file.length <= piece_length:
+            pieces[first] = MerklePiece(root, _next_power_of_two(-(-file.length // BLOCK_SIZE)), file.length)
+            continue
+
+        layer = torrent.piece_layers.get(root)
+        count = -(-file.length // piece_length)
+        if layer is None or len(layer) != count * HASH_SIZE:
+            raise ValueError(f"piece layer is missing: {'/'.join(file.path)}")
+        hashes = [bytes(layer[i:i + HASH_SIZE]) for i in range(0, len(layer), HASH_SIZE)]
+        if merkle_root(hashes, _next_power_of_two(count), pad_root) != root:
+            raise ValueError(f"piece layer does not match pieces root: {'/'.join(file.path)}")
+        for k, piece_root in enumerate(hashes):
+            pieces[first + k] = MerklePiece(piece_root, width, min(piece_length, file.length - k * piece_length))
+    return pieces
@@ -1,10 +1,10 @@
-import math
-from typing import List
+from typing import List, Optional
 import hashlib
-import time
-import signal
-import src.global_value as gv
-from src.domain.entity.piece.block import Block, State
+from src.domain.entity.piece.block import State
+from src.domain.entity.piece.block_state import BlockStates, PieceBlocks
+from src.domain.entity.piece.buffer_pool import BufferPool
+from src.domain.entity.piece.merkle import MerklePiece, BLOCK_SIZE
+from src.infrastructure.storage import Storage
 
 import yaml
 import logging.config
@@ -15,68 +15,141 @@ logger = getLogger('develop')
 
 
 class Piece(object):
-    def __init__(self, piece_index: int, piece_size: int, piece_hash: str, file_path):
+    def __init__(self, piece_index: int, piece_size: int, piece_hash: Optional[bytes], storage: Storage,
+                 blocks: PieceBlocks = None, buffer_pool: BufferPool = None, merkle: MerklePiece = None):
+        """
+        :param merkle: v2のtorrentのpiece 指定した場合は piece_hash (SHA-1) ではなくmerkle treeで検証する
+        """
         self.exist = False
 
         self.piece_index = piece_index
         self.piece_size = piece_size
         self.piece_hash = piece_hash
 
-        self.is_full: bool = False
-        # pieceが保管されているディレクトリのパス
-        self.file_path = file_path + '/' + str(piece_index)
-        self.number_of_blocks: int = math.ceil(float(piece_size / gv.CHUNK_SIZE))
-
-        self.raw_data: bytes = b''
-        self.blocks: List[Block] = []
+        # v2: プロデューサーから受け取り merkle.root と照合済みの葉のハッシュ
+        # 揃っていれば葉(16KiB)ごとに受信中に検証し、失敗した葉のブロックだけを再要求する
+        self.merkle = merkle
+        self.leaf_hashes: Optional[List[bytes]] = None
+        self.verified_leaves = bytearray(merkle.number_of_leaves if merkle is not None else 0)
+        # 検証に失敗してFREEに戻したブロック / Noneならpiece全体
+        self.failed_blocks: Optional[List[int]] = None
+        # 検証は通ったが書き込めなかった場合のエラー (set_to_full でクリアする)
+        self.write_error: Optional[OSError] = None
 
-        self.state = 0  # 0 is stop. 1 is start.
+        self.is_full: bool = False
+        # 検証ワーカーに渡してから結果を受け取るまでTrue (同じpieceを2回渡さず、その間のブロックは受け付けない)
+        self.in_verification: bool = False
+        # 検証済みのpieceの保存先
+        self.storage = storage
+
+        # ブロックの状態はtorrent全体のBlockStatesに置き、ここではそのビューを持つ
+        if blocks is None:
+            blocks = BlockStates([piece_size]).piece(0)
+        self.blocks: PieceBlocks = blocks
+        self.number_of_blocks: int = len(blocks)
+        self.chunk_size: int = blocks.table.chunk_size
+
+        # 受信中に確保するpiece全体のバッファ 各ブロックはoffsetの位置に直接書き込む
+        self.buffer_pool = buffer_pool
+        self.buffer: Optional[bytearray] = None
+        self.raw_data: memoryview = memoryview(b'')
 
         self._init_blocks()
 
+    def set_exist(self):
+        """
+        ディスク上に検証済みのファイルがあるpieceを完了扱いにする
+        """
+        self.exist = True
+        self.is_full = True
+        self.blocks.fill(State.FULL)
+
     def set_block(self, offset, data):
-        index = int(offset / gv.CHUNK_SIZE)
+        index = offset // self.chunk_size
+
+        if len(data) != self.blocks.block_size(index):
+            return False
 
-        if not self.is_full and not self.blocks[index].state == State.FULL:
-            self.blocks[index].data = data
-            self.blocks[index].state = State.FULL
+        if not self.is_full and not self.in_verification and not self.blocks.state(index) == State.FULL:
+            if self.buffer is None:
+                self.buffer = self._acquire_buffer()
+            memoryview(self.buffer)[offset:offset + len(data)] = data
+            self.blocks.set_state(index, State.FULL)
             return True
         return False
 
     def get_block(self, block_offset, block_length):
         if self.exist:
-            for path_file in self.file_path:
-                with open(path_file, 'r+b') as file:
-                    data = file.read()
-                    return data[block_offset:block_length]
-        else:
-            # TODO: 例外処理の追加　file is not full block
-            pass
-
-        return self.raw_data[block_offset:block_length]
-
-    def get_empty_block(self):
-        if self.is_full:
-            return None
-
-        for block_index, block in enumerate(self.blocks):
-            if block.state == State.FREE:
-                self.blocks[block_index].state = State.PENDING
-                self.blocks[block_index].last_seen = time.time()
-                return self.piece_index, block_index * gv.CHUNK_SIZE, block.block_size
+            return self.storage.read(self.piece_index, block_offset, block_length)
 
-        return None
+        return bytes(self.raw_data[block_offset:block_offset + block_length])
 
     def are_all_blocks_full(self):
-        for block in self.blocks:
-            if block.state == State.FREE or block.state == State.PENDING:
-                return False
-
-        return True
+        return self.blocks.all_full()
+
+    def set_leaf_hashes(self, payload) -> Optional[List[int]]:
+        """
+        v2: 葉のハッシュの並びを受け取り、既に全ブロックの揃った葉を検証する
+        :return: 検証に失敗してFREEに戻したブロック / 葉のハッシュが root と一致しなければNone
+        """
+        hashes = self.merkle.verify_layer(payload)
+        if hashes is None:
+            logger.warning(f"Error Leaf Hashes: piece {self.piece_index}")
+            return None
+        self.leaf_hashes = hashes
+        if self.is_full or self.blocks.all_full():
+            # 検証ワーカーに渡した後はバッファと状態に触らない
+            return []
+        return self._check_leaves(range(len(hashes)))
+
+    def check_block(self, block_index: int) -> List[int]:
+        """
+        v2: 受信したブロックを含む葉のうち全ブロックが揃ったものを検証する
+        :return: 検証に失敗してFREEに戻したブロック
+        """
+        if self.leaf_hashes is None:
+            return []
+        start = block_index * self.chunk_size
+        end = min(start + self.blocks.block_size(block_index), self.merkle.length)
+        if start >= end:
+            # 詰め物だけのブロック
+            return []
+        return self._check_leaves(range(start // BLOCK_SIZE, (end - 1) // BLOCK_SIZE + 1))
+
+    def _check_leaves(self, leaves) -> List[int]:
+        data = memoryview(self.buffer) if self.buffer is not None else None
+        failed = []
+        for leaf in leaves:
+            if self.verified_leaves[leaf]:
+                continue
+            blocks = self._leaf_blocks(leaf)
+            if any(self.blocks.state(block_index) != State.FULL for block_index in blocks):
+                continue
+            leaf_range = self.merkle.leaf_range(leaf)
+            if hashlib.sha256(data[leaf_range.start:leaf_range.stop]).digest() == self.leaf_hashes[leaf]:
+                self.verified_leaves[leaf] = 1
+            else:
+                failed.extend(blocks)
+
+        if failed:
+            failed = sorted(set(failed))
+            logger.warning(f"Error Leaf Hash: piece {self.piece_index}, blocks {failed}")
+            self._reset_blocks(failed)
+        return failed
+
+    def _leaf_blocks(self, leaf: int) -> range:
+        leaf_range = self.merkle.leaf_range(leaf)
+        return range(leaf_range.start // self.chunk_size, (leaf_range.stop - 1) // self.chunk_size + 1)
 
     def set_to_full(self):
-        data = self._merge_blocks()
+        self.write_error = None
+        data = memoryview(self.buffer)
+        if self.merkle is not None:
+            return self._set_to_full_v2(data)
+
         if not self._valid_blocks(data):
+            # バッファはそのまま再受信に使う
+            self.failed_blocks = None
             self._init_blocks()
             return False
 
@@ -85,26 +158,68 @@ class Piece(object):
 
         return True
 
-    def _init_blocks(self):
-        self.blocks = []
-
-        if self.number_of_blocks > 1:
-            for i in range(self.number_of_blocks):
-                self.blocks.append(Block())
-
-            if (self.piece_size % gv.CHUNK_SIZE) > 0:
-                self.blocks[self.number_of_blocks - 1].block_size = self.piece_size % gv.CHUNK_SIZE
-
-        else:
-            self.blocks.append(Block(block_size=int(self.piece_size)))
+    def _set_to_full_v2(self, data: memoryview) -> bool:
+        if self.leaf_hashes is not None:
+            # 葉のハッシュは root と照合済みなので、全ての葉が一致すればpieceも一致する
+            failed = self._check_leaves(i for i, verified in enumerate(self.verified_leaves) if not verified)
+            if failed:
+                self.failed_blocks = failed
+                return False
+        elif not self.merkle.verify(data):
+            # 葉のハッシュが届いていなければどのブロックが壊れているか分からない
+            logger.warning("Error Piece Merkle Root")
+            self.failed_blocks = None
+            self._init_blocks()
+            return False
 
-    def _merge_blocks(self):
-        buf = b''
+        # 詰め物の部分はどのプロデューサーから受け取っても同じになるよう0にする
+        if self.merkle.length < self.piece_size:
+            data[self.merkle.length:] = bytes(self.piece_size - self.merkle.length)
+        self.is_full = True
+        self.raw_data = data
+        return True
 
-        for block in self.blocks:
-            buf += block.data
+    def reset(self):
+        """
+        検証後に書き込めなかったpieceを受信前の状態に戻す (piece全体を再受信する)
+        """
+        self.is_full = False
+        self.raw_data = memoryview(b'')
+        self.failed_blocks = None
+        self._init_blocks()
 
-        return buf
+    def _init_blocks(self):
+        self.blocks.reset()
+        self.verified_leaves[:] = bytes(len(self.verified_leaves))
+
+    def _reset_blocks(self, block_indexes: List[int]):
+        for block_index in block_indexes:
+            self.blocks.set_state(block_index, State.FREE)
+
+    def _acquire_buffer(self) -> bytearray:
+        if self.buffer_pool is None:
+            return bytearray(self.piece_size)
+        return self.buffer_pool.acquire(self.piece_size)
+
+    def release_buffer(self):
+        """
+        ディスクに書き込んだpieceのバッファをプールに返す
+        """
+        if self.buffer is None:
+            return
+        self.raw_data.release()
+        self.raw_data = memoryview(b'')
+        if self.buffer_pool is not None:
+            self.buffer_pool.release(self.buffer)
+        self.buffer = None
+
+    def is_valid(self, data) -> bool:
+        """
+        pieceのデータ全体の検証 (v1: SHA-1 / v2: merkle treeの根)
+        """
+        if self.merkle is not None:
+            return self.merkle.verify(data)
+        return hashlib.sha1(data).digest() == self.piece_hash
 
     def _valid_blocks(self, piece_raw_data):
         hashed_piece_raw_data = hashlib.sha1(piece_raw_data).digest()
@@ -117,5 +232,6 @@ class Piece(object):
         return False
 
     def write_on_disk(self):
-        with open(self.file_path, "wb") as file:
-            file.write(self.raw_data)
+        self.storage.write(self.piece_index, self.raw_data)
+        self.exist = True
+        self.release_buffer()
@@ -0,0 +1,140 @@
+import mmap
+from array import array
+from typing import Optional
+
+from src.domain.entity.piece.block_state import BlockStates
+
+RATE_ALPHA = 0.3  # 受信レートの指数移動平均の係数
+
+# カウンタの添字 書き込むプロセス(slot)ごとに1組持つ
+_BLOCKS = 0  # FULLのブロック数 (検証失敗で戻る)
+_RECEIVED_BYTES = 1  # 受け付けたブロックの累計 (減らない)
+_PIECES = 2  # 完了したpiece数
+_COMPLETED_BYTES = 3
+_NUMBER_OF_COUNTERS = 4
+# レート推定の値
+_RATE = 0
+_LAST_TIME = 1
+_LAST_BYTES = 2
+
+
+class DownloadProgress:
+    """
+    ダウンロードの進捗 (完了したpieceのビットマップとブロック・piece・バイト数のカウンタ)
+
+    状態が変わる時にだけ更新し、全pieceやBlockStatesを数え直さない。
+    shared=True の場合は無名mmap上に置き、fork後の listener / requester (parallel のワーカー) が同じ値を読む。
+    カウンタは書き込むプロセスごとの領域(slot)に分けて持ち、読む時に合計する。
+    ビットマップとpiece数は完了を記録する1つのプロセス(listener/親)だけが書く。
+    """
+
+    def __init__(self, block_states: BlockStates, writers: int = 1, shared: bool = False):
+        self.piece_sizes = block_states.piece_sizes
+        self.offsets = block_states.offsets
+        self.number_of_pieces = len(self.piece_sizes)
+        self.number_of_blocks = block_states.num_of_blocks
+        self.length = sum(self.piece_sizes)
+        self.writers = writers
+
+        size = writers * _NUMBER_OF_COUNTERS
+        if shared:
+            self._counters = memoryview(mmap.mmap(-1, size * 8)).cast('q')
+            self._rate = memoryview(mmap.mmap(-1, 3 * 8)).cast('d')
+            self._bitmap = mmap.mmap(-1, max(1, self.number_of_pieces))
+        else:
+            self._counters = array('q', bytes(size * 8))
+            self._rate = array('d', bytes(3 * 8))
+            self._bitmap = bytearray(self.number_of_pieces)
+        self._base = 0
+
+    def set_writer(self, slot: int):
+        self._base = slot * _NUMBER_OF_COUNTERS
+
+    def _sum(self, index: int) -> int:
+        counters = self._counters
+        return sum(counters[i] for i in range(index, len(counters), _NUMBER_OF_COUNTERS))
+
+    def add_block(self, size: int):
+        counters = self._counters
+        counters[self._base + _BLOCKS] += 1
+        counters[self._base + _RECEIVED_BYTES] += size
+
+    def remove_blocks(self, count: int):
+        """
+        検証に失敗したpieceのブロックがFREEに戻った
+        """
+        self._counters[self._base + _BLOCKS] -= count
+
+    def complete(self, piece_index: int) -> bool:
+        """
+        :return: 新たに完了した場合True (同じpieceは1回だけ数える)
+        """
+        if self._bitmap[piece_index]:
+            return False
+        self._bitmap[piece_index] = 1
+        self._counters[self._base + _PIECES] += 1
+        self._counters[self._base + _COMPLETED_BYTES] += self.piece_sizes[piece_index]
+        return True
+
+    def restore(self, piece_index: int):
+        """
+        前回までにディスクへ書き込んだpieceを完了扱いにする (受信量には含めない)
+        """
+        if self.complete(piece_index):
+            self._counters[self._base + _BLOCKS] += self.offsets[piece_index + 1] - self.offsets[piece_index]
+
+    def is_complete(self, piece_index: int = None) -> bool:
+        """
+        :param piece_index: Noneならtorrent全体
+        """
+        if piece_index is None:
+            return self.pieces >= self.number_of_pieces
+        return bool(self._bitmap[piece_index])
+
+    @property
+    def pieces(self) -> int:
+        return self._sum(_PIECES)
+
+    @property
+    def blocks(self) -> int:
+        return self._sum(_BLOCKS)
+
+    @property
+    def completed_bytes(self) -> int:
+        return self._sum(_COMPLETED_BYTES)
+
+    @property
+    def received_bytes(self) -> int:
+        return self._sum(_RECEIVED_BYTES)
+
+    @property
+    def remaining_bytes(self) -> int:
+        return self.length - self.completed_bytes
+
+    def update_rate(self, now: float) -> float:
+        """
+        前回の呼び出しからの受信量で受信レート[byte/s]の移動平均を更新する (表示側が定期的に呼ぶ)
+        """
+        rate = self._rate
+        received = self.received_bytes
+        if rate[_LAST_TIME] > 0 and now > rate[_LAST_TIME]:
+            sample = (received - rate[_LAST_BYTES]) / (now - rate[_LAST_TIME])
+            rate[_RATE] = sample if rate[_RATE] == 0 else (1 - RATE_ALPHA) * rate[_RATE] + RATE_ALPHA * sample
+        rate[_LAST_TIME] = now
+        rate[_LAST_BYTES] = received
+        return rate[_RATE]
+
+    @property
+    def rate(self) -> float:
+        return self._rate[_RATE]
+
+    @property
+    def eta(self) -> Optional[float]:
+        """
+        残りの秒数の見積もり (まだレートが分からなければNone)
+        """
+        if self.is_complete():
+            return 0.0
+        if self.rate <= 0:
+            return None
+        return self.remaining_bytes / self.rate
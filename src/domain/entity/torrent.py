@@ -1,9 +1,11 @@
 import enum
 import hashlib
-from typing import List
-from bcoding import bdecode, bencode
+import struct
+from typing import Dict, Iterator, List, Optional, Tuple
 import logging
 
+from src.infrastructure.bencode import decode_metainfo
+
 """
 ファイル構造
 announce - トラッカーのURL
@@ -18,6 +20,14 @@ info - 各ファイルが対応するDict
     piece length - 1ピースのバイト数　一般的に 2^8KB = 256KB = 262,144B
     pieces - ハッシュリスト 各pieceのSHA-1ハッシュを連結したもの
             SHA1は160ビットのハッシュを返すため、pieceは20バイトの倍数の文字列
+
+v2 (BEP 52) で追加されたキー (v1のキーも持つものはハイブリッド)
+info
+    meta version - 2
+    file tree - パスの各要素を入れ子にした辞書 ファイルは {'': {length, pieces root}}
+        pieces root - ファイルを16KiBごとにSHA-256した葉のmerkle treeの根
+    v1のfilesでは、pieceの境界をファイルの先頭に揃えるための詰め物のファイルに attr 'p' が付く
+piece layers - pieces root -> 1piece分の部分木の根を連結したもの (1piece以下のファイルには無い)
 """
 
 
@@ -29,6 +39,38 @@ class FileMode(enum.Enum):
 class Files:
     length: int
     path: str
+    padding: bool = False  # pieceの境界を揃えるための詰め物 (中身は全て0でディスクには置かない)
+    pieces_root: Optional[bytes] = None  # v2のみ
+
+
+class PieceHashes:
+    """
+    pieces (各pieceのSHA-1を連結したもの) をコピーせずに piece_index で引く表
+
+    全pieceを順に取り出す場合は __iter__ (struct.iter_unpack でまとめて切り出す) を使う。
+    """
+    HASH_LENGTH = 20
+    _FORMAT = struct.Struct(f'{HASH_LENGTH}s')
+
+    def __init__(self, pieces):
+        self._pieces = memoryview(pieces)
+
+    def __len__(self):
+        return len(self._pieces) // self.HASH_LENGTH
+
+    def __getitem__(self, piece_index: int) -> bytes:
+        n = len(self)
+        if piece_index < 0:
+            piece_index += n
+        if not 0 <= piece_index < n:
+            raise IndexError(f"piece index out of range: {piece_index}")
+        start = piece_index * self.HASH_LENGTH
+        return self._pieces[start:start + self.HASH_LENGTH].tobytes()
+
+    def __iter__(self) -> Iterator[bytes]:
+        end = len(self) * self.HASH_LENGTH
+        for piece_hash, in self._FORMAT.iter_unpack(self._pieces[:end]):
+            yield piece_hash
 
 
 class Info:
@@ -36,7 +78,10 @@ class Info:
     length: int
     name: str
     piece_length: int
-    pieces: str
+    pieces: memoryview  # torrentファイルの該当範囲をそのまま指す
+    piece_hashes: PieceHashes  # v2のみのtorrentには無い
+    meta_version: int = 1
+    file_tree: List[Files]  # v2のみ file tree の全ファイル (詰め物を含まない)
 
 
 class Torrent(object):
@@ -47,13 +92,14 @@ class Torrent(object):
     nodes: list
 
     info: Info
-    info_hash: bytes
+    info_hash: bytes  # v1・ハイブリッドはSHA-1 / v2のみのtorrentはSHA-256
     info_hash_hex: str
     file_mode: FileMode
+    piece_layers: Dict[bytes, memoryview]
 
     def __init__(self, path: str):
         self.path: str = path  # torrentファイルが保存されているパス
-        torrent: dict = self.load_from_path(self.path)
+        torrent, raw = self.load_from_path(self.path)
 
         if 'announce' in torrent.keys():
             self.announce = torrent['announce']
@@ -61,10 +107,15 @@ class Torrent(object):
             self.announce_list = torrent['announce-list']
         if 'nodes' in torrent.keys():
             self.nodes = torrent['nodes']
+        self.piece_layers = torrent.get('piece layers', {})
 
         if 'info' in torrent.keys():
             new_info: Info = Info()
-            self.info_hash = hashlib.sha1(bencode(torrent['info'])).digest()
+            # 再エンコードせず、ファイル上の info の範囲をそのままハッシュする
+            if 'pieces' in torrent['info'].keys():
+                self.info_hash = hashlib.sha1(raw['info']).digest()
+            else:
+                self.info_hash = hashlib.sha256(raw['info']).digest()
             self.info_hash_hex = str(self.info_hash.hex())
             if 'files' in torrent['info'].keys():
                 self.file_mode = FileMode.multiple_file
@@ -74,7 +125,10 @@ class Torrent(object):
                     new_file: Files = Files()
                     new_file.length = file_dict['length']
                     new_file.path = file_dict['path']
+                    new_file.padding = 'p' in file_dict.get('attr', '')
                     new_info.files.append(new_file)
+                # マルチファイルの場合は全ファイルの合計
+                new_info.length = sum(file.length for file in new_info.files)
             elif 'length' in torrent['info'].keys():
                 self.file_mode = FileMode.single_file
                 new_info.length = torrent['info']['length']
@@ -84,14 +138,60 @@ class Torrent(object):
                 new_info.piece_length = torrent['info']['piece length']
             if 'pieces' in torrent['info'].keys():
                 new_info.pieces = torrent['info']['pieces']
+                new_info.piece_hashes = PieceHashes(new_info.pieces)
+            if 'file tree' in torrent['info'].keys():
+                new_info.meta_version = torrent['info'].get('meta version', 2)
+                new_info.file_tree = list(self._walk_file_tree(torrent['info']['file tree'], []))
+                if not hasattr(new_info, 'length'):
+                    self._set_v2_files(new_info)
             self.info = new_info
 
     @staticmethod
-    def load_from_path(path):
+    def _walk_file_tree(tree: dict, path: List[str]) -> Iterator[Files]:
+        # 辞書はキー順に並んでいるので、v1のfilesと同じ順になる
+        for name, node in tree.items():
+            if '' in node:
+                new_file: Files = Files()
+                new_file.path = path + [name]
+                new_file.length = node['']['length']
+                if 'pieces root' in node['']:
+                    new_file.pieces_root = bytes(node['']['pieces root'])
+                yield new_file
+            else:
+                yield from Torrent._walk_file_tree(node, path + [name])
+
+    def _set_v2_files(self, info: Info):
+        """
+        v1のキーの無いtorrentのファイル構成を file tree から作る
+        v2では各ファイルがpieceの先頭から始まるので、ハイブリッドのtorrentと同じく間に詰め物を入れる
+        """
+        tree = info.file_tree
+        if len(tree) == 1 and tree[0].path == [info.name]:
+            self.file_mode = FileMode.single_file
+            info.length = tree[0].length
+            return
+
+        self.file_mode = FileMode.multiple_file
+        info.files = []
+        for i, file in enumerate(tree):
+            info.files.append(file)
+            pad = -file.length % info.piece_length
+            if pad > 0 and i + 1 < len(tree):
+                padding: Files = Files()
+                padding.path = ['.pad', str(pad)]
+                padding.length = pad
+                padding.padding = True
+                info.files.append(padding)
+        info.length = sum(file.length for file in info.files)
+
+    @staticmethod
+    def load_from_path(path) -> Tuple[dict, dict]:
+        """
+        :return: (デコードした辞書, 最上位の各キーの値の元のバイト列)
+        """
         logging.debug('start load_from_path')
         with open(path, 'rb') as file:
-            torrent = bdecode(file)
-            return torrent
+            return decode_metainfo(file.read())
 
     def __str__(self):
         try:
@@ -118,7 +218,7 @@ class Torrent(object):
                 print(f'  length: {self.info.length}')
             print(f'  name: {self.info.name}')
             print(f'  piece_length: {self.info.piece_length}')
-            print(f'  pieces: {self.info.pieces[:10]} ... '
+            print(f'  pieces: {bytes(self.info.pieces[:10])} ... '
                   f'size is {len(self.info.pieces)}')
         except AttributeError:
             pass
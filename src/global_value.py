@@ -7,4 +7,6 @@ CACHE_PATH = "/client/proxy_cache/"
 CHUNK_SIZE = 1024 * 4
 MAX_PEER_CONNECT = 4
 
+CONGESTION_CONTROL = 'cubic'  # cubic / aimd / vegas
+
 EVALUATION = True
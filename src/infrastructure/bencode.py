@@ -0,0 +1,157 @@
+import re
+from typing import Dict, Tuple
+
+"""
+bencodeのデコーダ
+
+ファイル全体を1つのバッファ(bytes / mmap)として先頭から1回だけ読み、値をコピーせずに位置だけで辿る。
+辞書の値の元のバイト範囲を記録できるので、info_hash は再エンコードせずに info の範囲をそのままハッシュする。
+"""
+
+# 辞書の種類 生のまま返すキーは辞書の種類ごとに決まっていて、他の場所の同じ名前のキーは普通にデコードする
+# (file tree の中の "pieces" という名前のファイルなど)
+_PLAIN = 0
+_METAINFO = 1  # .torrent の最上位
+_INFO = 2
+_FILE_TREE = 3  # v2 の file tree のディレクトリ
+_FILE = 4  # file tree の葉 (キー b'' の値)
+
+# デコードせずに元のバッファの memoryview で返す文字列 (大きなバイナリ)
+RAW_KEYS = {_INFO: b'pieces', _FILE: b'pieces root'}
+# 値が全てバイナリの辞書 (キーもバイナリのまま bytes で返し、値は memoryview で返す)
+RAW_DICT_KEYS = {_METAINFO: b'piece layers'}
+# 値の辞書の種類
+_CHILDREN = {(_METAINFO, b'info'): _INFO, (_INFO, b'file tree'): _FILE_TREE, (_FILE_TREE, b''): _FILE}
+
+_INT = ord('i')
+_LIST = ord('l')
+_DICT = ord('d')
+_END = ord('e')
+_DIGITS = range(ord('0'), ord('9') + 1)
+# int() が受け付ける空白・符号・'_' や、先頭の0・-0 は不正なbencodeとして弾く
+_LENGTH = re.compile(rb'[0-9]+')
+_INTEGER = re.compile(rb'-?[1-9][0-9]*|0')
+
+
+class BencodeError(ValueError):
+    pass
+
+
+class _Decoder:
+    def __init__(self, data):
+        """
+        :param data: find() とスライスのできるバッファ (bytes / mmap)
+        """
+        self.data = data
+        self.view = memoryview(data)
+        self.length = len(data)
+
+    def decode(self, i: int, kind: int = _PLAIN):
+        """
+        :param kind: 値が辞書だった場合の種類
+        :return: (値, 値の次の位置)
+        """
+        if i >= self.length:
+            raise BencodeError(f"unexpected end of data at {i}")
+        c = self.data[i]
+        if c in _DIGITS:
+            start, end = self._string(i)
+            raw = bytes(self.view[start:end])
+            try:
+                return raw.decode(), end
+            except UnicodeDecodeError:
+                return raw, end
+        if c == _INT:
+            end = self._find(b'e', i + 1)
+            if _INTEGER.fullmatch(self.data, i + 1, end) is None:
+                raise BencodeError(f"invalid integer at {i}")
+            return int(self.data[i + 1:end]), end + 1
+        if c == _LIST:
+            items = []
+            i += 1
+            while self._peek(i) != _END:
+                item, i = self.decode(i)
+                items.append(item)
+            return items, i + 1
+        if c == _DICT:
+            return self.decode_dict(i, kind=kind)
+        raise BencodeError(f"invalid type {chr(c)!r} at {i}")
+
+    def decode_dict(self, i: int, spans: Dict[str, Tuple[int, int]] = None, kind: int = _PLAIN):
+        """
+        :param spans: 渡された場合は各キーの値の (開始, 終了) 位置を書き込む
+        :param kind: 辞書の種類 (生のまま返すキーを決める)
+        """
+        if self._peek(i) != _DICT:
+            raise BencodeError(f"dictionary expected at {i}")
+        result = {}
+        i += 1
+        while self._peek(i) != _END:
+            start, end = self._string(i)
+            key = bytes(self.view[start:end])
+            value_start = end
+            if RAW_KEYS.get(kind) == key and self._peek(end) in _DIGITS:
+                value_start, i = self._string(end)
+                value = self.view[value_start:i]
+            elif RAW_DICT_KEYS.get(kind) == key and self._peek(end) == _DICT:
+                value, i = self._raw_dict(end)
+            else:
+                child = _CHILDREN.get((kind, key), _FILE_TREE if kind == _FILE_TREE else _PLAIN)
+                value, i = self.decode(end, child)
+            try:
+                name = key.decode()
+            except UnicodeDecodeError:
+                name = key
+            result[name] = value
+            if spans is not None:
+                spans[name] = (value_start, i)
+        return result, i + 1
+
+    def _raw_dict(self, i: int) -> Tuple[Dict[bytes, memoryview], int]:
+        if self._peek(i) != _DICT:
+            raise BencodeError(f"dictionary expected at {i}")
+        result = {}
+        i += 1
+        while self._peek(i) != _END:
+            start, end = self._string(i)
+            value_start, i = self._string(end)
+            result[bytes(self.view[start:end])] = self.view[value_start:i]
+        return result, i + 1
+
+    def _string(self, i: int) -> Tuple[int, int]:
+        colon = self._find(b':', i)
+        if _LENGTH.fullmatch(self.data, i, colon) is None:
+            raise BencodeError(f"invalid string length at {i}")
+        n = int(self.data[i:colon])
+        end = colon + 1 + n
+        if end > self.length:
+            raise BencodeError(f"string at {i} runs past the end of data")
+        return colon + 1, end
+
+    def _find(self, sub: bytes, i: int) -> int:
+        end = self.data.find(sub, i)
+        if end < 0:
+            raise BencodeError(f"unexpected end of data after {i}")
+        return end
+
+    def _peek(self, i: int) -> int:
+        if i >= self.length:
+            raise BencodeError(f"unexpected end of data at {i}")
+        return self.data[i]
+
+
+def decode(data):
+    value, end = _Decoder(data).decode(0)
+    return value
+
+
+def decode_metainfo(data) -> Tuple[dict, Dict[str, memoryview]]:
+    """
+    .torrent の最上位の辞書をデコードする
+    :return: (辞書, 最上位の各キーの値の元のバイト列) info_hash は raw['info'] のSHA-1
+    """
+    decoder = _Decoder(data)
+    spans = {}
+    metainfo, _ = decoder.decode_dict(0, spans, _METAINFO)
+    raw = {key: decoder.view[start:end] for key, (start, end) in spans.items()}
+    return metainfo, raw
@@ -0,0 +1,320 @@
+import heapq
+import os
+import random
+import select
+import struct
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+
+class SimulatedInfo:
+    """
+    cefpyco の受信結果(CcnPacketInfo)と同じ属性を持つパケット
+    """
+    __slots__ = ('name', 'chunk_num', 'payload', 'is_data', 'is_interest', 'is_succeeded')
+
+    def __init__(self, name: str = '', chunk_num: int = 0, payload: bytes = b'',
+                 is_data: bool = False, is_interest: bool = False, is_succeeded: bool = False):
+        self.name = name
+        self.chunk_num = chunk_num
+        self.payload = payload
+        self.is_data = is_data
+        self.is_interest = is_interest
+        self.is_succeeded = is_succeeded
+
+    @property
+    def is_failed(self):
+        return not self.is_succeeded
+
+    @property
+    def payload_len(self):
+        return len(self.payload)
+
+
+TIMEOUT_INFO = SimulatedInfo()
+
+# プロデューサーから模擬リンクへのDataの枠 (名前の長さ, chunk_num, ペイロードの長さ)
+_DATA_HEADER = struct.Struct('>HiI')
+
+
+class SimulatedLink:
+    """
+    cefnetd の代わりにプロセス内でDataを返す模擬リンク
+
+    source(name, chunk_num) が返すペイロードを、帯域・遅延・ジッタ・ロス・並べ替えを
+    与えて返す。Interestはパイプ経由で受け取るので、fork後の子プロセスからの送信も届く。
+    リンクのスレッドは begin() を呼んだプロセスで動く。
+    source が None の場合は producer_handle() のプロデューサーへInterestを転送し、
+    そこから send_data() されたDataに同じ帯域・遅延などを与えて返す。
+    """
+
+    def __init__(self, source: Optional[Callable[[str, int], Optional[bytes]]] = None,
+                 bandwidth: float = 100 * 1024 ** 2, latency: float = 0.01, jitter: float = 0.0,
+                 loss: float = 0.0, reorder: float = 0.0, seed: int = 0,
+                 mtu: Optional[int] = None, overhead: int = 0, corrupt: float = 0.0):
+        """
+        :param bandwidth: ボトルネック帯域 [byte/s]
+        :param latency: 往復の伝搬遅延 [s]
+        :param jitter: 遅延に加える一様乱数の幅 [s]
+        :param loss: Dataを落とす確率 (mtu を指定した場合は断片ごとの確率)
+        :param reorder: Dataを追い越させる確率(latency の半分だけ余計に遅らせる)
+        :param mtu: 指定した場合、ヘッダを含めてこれを超えるDataは断片化し、1つでも落ちればData全体を失う
+        :param overhead: パケット(断片)ごとのヘッダの大きさ [byte] 帯域を消費する
+        :param corrupt: 届けるDataのペイロードの1バイトを書き換える確率 (ハッシュ検証で弾かれる)
+        """
+        self.source = source
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+        self.mtu = mtu
+        self.overhead = overhead
+        self.corrupt = corrupt
+        self.random = random.Random(seed)
+
+        self.num_of_interests = 0
+        self.num_of_data = 0
+        self.num_of_lost = 0
+        self.num_of_corrupted = 0
+
+        self._interest_r, self._interest_w = os.pipe()
+        self._data_r, self._data_w = os.pipe()
+        os.set_blocking(self._data_r, False)
+        # プロデューサー側 (リンク -> プロデューサーのInterest / プロデューサー -> リンクのData)
+        self._producer_r, self._producer_w = os.pipe()
+        self._response_r, self._response_w = os.pipe()
+        os.set_blocking(self._producer_w, False)
+        self._to_producer = bytearray()
+
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._received = deque()
+        self._signaled = False
+        self._in_flight = []  # (到着時刻, seq, info)
+        self._last_departure = 0.0
+        self._seq = 0
+        self._thread = None
+        self._stopped = False
+
+    def handle(self) -> 'SimulatedHandle':
+        return SimulatedHandle(self)
+
+    def producer_handle(self) -> 'SimulatedProducerHandle':
+        return SimulatedProducerHandle(self._producer_r, self._response_w)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        os.write(self._interest_w, b'\n')
+
+    def send_interest(self, name: str, chunk_num: int):
+        os.write(self._interest_w, f'{name}\t{chunk_num}\n'.encode())
+
+    def send_interests(self, name: str, chunk_nums):
+        os.write(self._interest_w, ''.join(f'{name}\t{chunk_num}\n' for chunk_num in chunk_nums).encode())
+
+    def receive(self, timeout_ms: int) -> SimulatedInfo:
+        with self._ready:
+            if not self._received and timeout_ms > 0:
+                self._ready.wait_for(lambda: self._received, timeout_ms / 1000)
+            if not self._received:
+                return TIMEOUT_INFO
+
+            info = self._received.popleft()
+            if not self._received and self._signaled:
+                try:
+                    os.read(self._data_r, 4096)
+                except BlockingIOError:
+                    pass
+                self._signaled = False
+            return info
+
+    def fileno(self) -> int:
+        return self._data_r
+
+    def _run(self):
+        buf = b''
+        response = bytearray()
+        while not self._stopped:
+            timeout = None
+            if self._in_flight:
+                timeout = max(self._in_flight[0][0] - time.time(), 0)
+
+            writable = [self._producer_w] if self._to_producer else []
+            readable, writable, _ = select.select([self._interest_r, self._response_r], writable, [], timeout)
+            if self._interest_r in readable:
+                buf += os.read(self._interest_r, 65536)
+                *lines, buf = buf.split(b'\n')
+                for line in lines:
+                    if line:
+                        name, chunk_num = line.decode().split('\t')
+                        self._on_interest(name, int(chunk_num))
+            if self._response_r in readable:
+                response += os.read(self._response_r, 1 << 20)
+                response = self._on_response(response)
+            if writable:
+                self._flush_to_producer()
+
+            self._deliver(time.time())
+
+    def _on_interest(self, name: str, chunk_num: int):
+        self.num_of_interests += 1
+        if self.source is None:
+            self._to_producer += f'{name}\t{chunk_num}\n'.encode()
+            return
+        payload = self.source(name, chunk_num)
+        if payload is None:
+            return
+        self._send(name, chunk_num, payload)
+
+    def _flush_to_producer(self):
+        try:
+            written = os.write(self._producer_w, self._to_producer)
+        except BlockingIOError:
+            return
+        del self._to_producer[:written]
+
+    def _on_response(self, buf: bytearray) -> bytearray:
+        """
+        届いた分の完全なDataを送り出す
+        :return: 続きを待つ残り
+        """
+        position = 0
+        while len(buf) - position >= _DATA_HEADER.size:
+            name_length, chunk_num, payload_length = _DATA_HEADER.unpack_from(buf, position)
+            start = position + _DATA_HEADER.size
+            end = start + name_length + payload_length
+            if len(buf) < end:
+                break
+            name = bytes(buf[start:start + name_length]).decode()
+            self._send(name, chunk_num, bytes(buf[start + name_length:end]))
+            position = end
+        return buf[position:]
+
+    def _send(self, name: str, chunk_num: int, payload: bytes):
+        fragments = 1
+        if self.mtu is not None:
+            fragments = max(1, -(-len(payload) // (self.mtu - self.overhead)))
+
+        now = time.time()
+        departure = max(now, self._last_departure) + (len(payload) + fragments * self.overhead) / self.bandwidth
+        self._last_departure = departure
+        if any(self.random.random() < self.loss for _ in range(fragments)):
+            self.num_of_lost += 1
+            return
+
+        arrival = departure + self.latency
+        if self.jitter > 0:
+            arrival += self.random.uniform(0, self.jitter)
+        if self.reorder > 0 and self.random.random() < self.reorder:
+            arrival += self.latency / 2
+        if self.corrupt > 0 and payload and self.random.random() < self.corrupt:
+            payload = bytearray(payload)
+            payload[self.random.randrange(len(payload))] ^= 0xff
+            payload = bytes(payload)
+            self.num_of_corrupted += 1
+
+        info = SimulatedInfo(name, chunk_num, payload, is_data=True, is_succeeded=True)
+        heapq.heappush(self._in_flight, (arrival, self._seq, info))
+        self._seq += 1
+
+    def _deliver(self, now: float):
+        if not self._in_flight or self._in_flight[0][0] > now:
+            return
+
+        with self._ready:
+            while self._in_flight and self._in_flight[0][0] <= now:
+                _, _, info = heapq.heappop(self._in_flight)
+                self._received.append(info)
+                self.num_of_data += 1
+            if not self._signaled:
+                os.write(self._data_w, b'x')
+                self._signaled = True
+            self._ready.notify_all()
+
+
+class SimulatedHandle:
+    """
+    cefpyco.CefpycoHandle と同じ send_interest / receive を持つハンドル
+    """
+
+    def __init__(self, link: SimulatedLink):
+        self.link = link
+
+    def begin(self):
+        self.link.start()
+
+    def end(self):
+        self.link.stop()
+
+    def send_interest(self, name: str, chunk_num: int = 0, **kwargs):
+        self.link.send_interest(name, chunk_num)
+
+    def send_interests(self, name: str, chunk_nums, **kwargs):
+        """
+        同じ名前の複数のchunkへのInterestを1回の書き込みで送る
+        """
+        self.link.send_interests(name, chunk_nums)
+
+    def receive(self, error_on_timeout: bool = False, timeout_ms: int = 4000) -> SimulatedInfo:
+        return self.link.receive(timeout_ms)
+
+    def fileno(self) -> int:
+        return self.link.fileno()
+
+
+class SimulatedProducerHandle:
+    """
+    cefpyco.CefpycoHandle と同じ register / receive / send_data を持つプロデューサー側のハンドル
+
+    パイプだけを使うので、fork後の子プロセスからも使える (リンクのスレッドは消費者側で begin() する)。
+    """
+
+    def __init__(self, interest_fd: int, data_fd: int):
+        self.interest_fd = interest_fd
+        self.data_fd = data_fd
+        self.prefixes = []
+        self._buf = b''
+        self._interests = deque()
+
+    def begin(self):
+        pass
+
+    def end(self):
+        pass
+
+    def register(self, name: str):
+        self.prefixes.append(name)
+
+    def receive(self, error_on_timeout: bool = False, timeout_ms: int = 4000) -> SimulatedInfo:
+        if not self._interests:
+            readable, _, _ = select.select([self.interest_fd], [], [], max(timeout_ms, 0) / 1000)
+            if readable:
+                self._buf += os.read(self.interest_fd, 65536)
+                *lines, self._buf = self._buf.split(b'\n')
+                for line in lines:
+                    name, chunk_num = line.decode().split('\t')
+                    # 登録したプレフィックスのInterestだけが届く
+                    if any(name.startswith(prefix) for prefix in self.prefixes):
+                        self._interests.append(SimulatedInfo(name, int(chunk_num), is_interest=True,
+                                                             is_succeeded=True))
+        if not self._interests:
+            return TIMEOUT_INFO
+        return self._interests.popleft()
+
+    def send_data(self, name: str, payload, chunk_num: int = -1, **kwargs):
+        encoded = name.encode()
+        data = memoryview(b''.join((_DATA_HEADER.pack(len(encoded), chunk_num, len(payload)), encoded, payload)))
+        while len(data) > 0:
+            data = data[os.write(self.data_fd, data):]
+
+    def fileno(self) -> int:
+        return self.interest_fd
@@ -0,0 +1,280 @@
+import copy
+import ctypes
+import mmap
+import os
+from typing import Dict, List, Optional, Tuple
+
+from src.domain.entity.layout import TorrentLayout
+
+from logger import logger
+
+FSYNC_NEVER = 'never'  # OSに任せる
+FSYNC_PIECE = 'piece'  # pieceを書き込むたび
+FSYNC_CLOSE = 'close'  # 終了時にまとめて
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+try:
+    _fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError):
+    _fallocate = None
+
+
+class Storage:
+    """
+    検証済みpieceの保存先
+
+    stat_changes_on_write - 他のpieceの書き込みで stat() の結果が変わるかどうか
+    """
+    stat_changes_on_write = False
+
+    def __init__(self, piece_length: int, fsync: str = FSYNC_NEVER):
+        self.piece_length = piece_length
+        self.fsync = fsync
+
+    def write(self, piece_index: int, data):
+        raise NotImplementedError
+
+    def read(self, piece_index: int, offset: int, length: int) -> bytes:
+        raise NotImplementedError
+
+    def view(self, piece_index: int, piece_size: int):
+        """
+        piece全体を読み出す (mmapできる場合はコピーせずにページキャッシュを参照する memoryview)
+        """
+        return self.read(piece_index, 0, piece_size)
+
+    def discard(self, piece_index: int, piece_size: int) -> bool:
+        """
+        pieceの領域を解放する (キャッシュからの追い出し)
+        :return: 解放できた場合True
+        """
+        raise NotImplementedError
+
+    def stat(self, piece_index: int, piece_size: int, cache: Dict = None) -> Optional[Tuple[int, int]]:
+        """
+        :return: (サイズ, mtime_ns) / pieceを保持できる状態でなければNone
+        """
+        raise NotImplementedError
+
+    def file_mtimes(self, piece_index: int, cache: Dict = None) -> Dict[object, int]:
+        """
+        :return: pieceを保存しているファイルごとの mtime_ns (キーはファイルを区別できれば何でもよい)
+        """
+        raise NotImplementedError
+
+    def reader(self) -> 'Storage':
+        """
+        close() と関係なく読み出しに使えるStorage (読み終わったら close する)
+        """
+        reader = copy.copy(self)
+        reader.fsync = FSYNC_NEVER
+        return reader
+
+    def close(self):
+        pass
+
+
+class PieceFileStorage(Storage):
+    """
+    pieceごとに <directory>/<piece_index> へ保存する
+    """
+
+    def __init__(self, directory: str, piece_length: int, fsync: str = FSYNC_NEVER):
+        super().__init__(piece_length, fsync)
+        self.directory = directory
+
+    def path(self, piece_index: int) -> str:
+        return self.directory + '/' + str(piece_index)
+
+    def write(self, piece_index: int, data):
+        with open(self.path(piece_index), "wb") as file:
+            file.write(data)
+            if self.fsync == FSYNC_PIECE:
+                file.flush()
+                os.fsync(file.fileno())
+
+    def read(self, piece_index: int, offset: int, length: int) -> bytes:
+        with open(self.path(piece_index), 'rb') as file:
+            file.seek(offset)
+            return file.read(length)
+
+    def view(self, piece_index: int, piece_size: int):
+        with open(self.path(piece_index), 'rb') as file:
+            # 閉じた後もmmapは有効 (参照が無くなった時点でunmapされる)
+            return memoryview(mmap.mmap(file.fileno(), piece_size, access=mmap.ACCESS_READ))
+
+    def discard(self, piece_index: int, piece_size: int) -> bool:
+        try:
+            os.remove(self.path(piece_index))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def stat(self, piece_index: int, piece_size: int, cache: Dict = None) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path(piece_index))
+        except OSError:
+            return None
+        if stat.st_size != piece_size:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def file_mtimes(self, piece_index: int, cache: Dict = None) -> Dict[object, int]:
+        try:
+            return {piece_index: os.stat(self.path(piece_index)).st_mtime_ns}
+        except OSError:
+            return {}
+
+    def close(self):
+        if self.fsync == FSYNC_CLOSE:
+            os.sync()
+
+
+class SingleFileStorage(Storage):
+    """
+    torrentの本来のファイル(マルチファイルの場合は全ファイル)を事前に確保し、
+    pieceをそのオフセットへ os.pwrite で書き込む
+    ファイルを跨ぐpieceは TorrentLayout で事前に計算した範囲ごとに書き込む。
+    詰め物のファイル (padding) は作らず、書き込みは捨て、読み出しは0を返す。
+
+    preallocate - 'sparse': ftruncateでサイズだけ確保 / 'full': posix_fallocateでブロックも確保
+    """
+    stat_changes_on_write = True
+
+    def __init__(self, directory: str, layout: TorrentLayout,
+                 fsync: str = FSYNC_NEVER, preallocate: str = 'sparse'):
+        super().__init__(layout.piece_length, fsync)
+        self.layout = layout
+        self.paths: List[str] = [os.path.join(directory, *file.path) for file in layout.files]
+        self.fds: List[int] = []
+        # 読み出し用にファイルごとに1回だけ作るmmap (file_index -> memoryview)
+        self.maps: Dict[int, memoryview] = {}
+
+        for path, file in zip(self.paths, layout.files):
+            if file.padding:
+                self.fds.append(-1)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._preallocate(fd, file.length, preallocate)
+            self.fds.append(fd)
+
+    @staticmethod
+    def _preallocate(fd: int, length: int, preallocate: str):
+        if os.fstat(fd).st_size >= length:
+            return
+        if preallocate == 'full' and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, length)
+                return
+            except OSError as e:
+                logger.warning(f"posix_fallocate failed, fall back to sparse file: {e}")
+        os.ftruncate(fd, length)
+
+    def write(self, piece_index: int, data):
+        data = memoryview(data)
+        position = 0
+        for file_index, file_offset, n in self.layout.spans(piece_index):
+            fd = self.fds[file_index]
+            if fd < 0:
+                position += n
+                continue
+            chunk = data[position:position + n]
+            while len(chunk) > 0:
+                written = os.pwrite(fd, chunk, file_offset)
+                chunk = chunk[written:]
+                file_offset += written
+            if self.fsync == FSYNC_PIECE:
+                os.fdatasync(fd)
+            position += n
+
+    def read(self, piece_index: int, offset: int, length: int) -> bytes:
+        spans = self.layout.spans(piece_index, offset, length)
+        if len(spans) == 1:
+            file_index, file_offset, n = spans[0]
+            return self._pread(file_index, n, file_offset)
+
+        buf = bytearray()
+        for file_index, file_offset, n in spans:
+            buf += self._pread(file_index, n, file_offset)
+        return bytes(buf)
+
+    def _pread(self, file_index: int, n: int, file_offset: int) -> bytes:
+        fd = self.fds[file_index]
+        if fd < 0:
+            return bytes(n)
+        return os.pread(fd, n, file_offset)
+
+    def view(self, piece_index: int, piece_size: int):
+        spans = self.layout.spans(piece_index)
+        if len(spans) > 1 or self.fds[spans[0][0]] < 0:
+            # ファイルを跨ぐpieceだけはコピーして繋げる
+            return self.read(piece_index, 0, piece_size)
+        file_index, file_offset, n = spans[0]
+        file_map = self.maps.get(file_index)
+        if file_map is None:
+            file_map = memoryview(mmap.mmap(self.fds[file_index], self.layout.files[file_index].length,
+                                            access=mmap.ACCESS_READ))
+            self.maps[file_index] = file_map
+        return file_map[file_offset:file_offset + n]
+
+    def discard(self, piece_index: int, piece_size: int) -> bool:
+        # ファイルの大きさは変えずにpieceの範囲だけ穴にする (他のpieceのオフセットは変わらない)
+        if _fallocate is None:
+            logger.warning("fallocate is not available, piece is not discarded")
+            return False
+        for file_index, file_offset, n in self.layout.spans(piece_index):
+            if self.fds[file_index] < 0:
+                continue
+            if _fallocate(self.fds[file_index], FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, file_offset, n) != 0:
+                logger.warning(f"failed to punch a hole for piece {piece_index}: "
+                               f"{os.strerror(ctypes.get_errno())}")
+                return False
+        return True
+
+    def stat(self, piece_index: int, piece_size: int, cache: Dict = None) -> Optional[Tuple[int, int]]:
+        if cache is None:
+            cache = {}
+        mtime = 0
+        for file_index, _, _ in self.layout.spans(piece_index):
+            if self.fds[file_index] < 0:
+                continue
+            if file_index not in cache:
+                cache[file_index] = os.fstat(self.fds[file_index])
+            stat = cache[file_index]
+            if stat.st_size < self.layout.files[file_index].length:
+                return None
+            mtime = max(mtime, stat.st_mtime_ns)
+        return piece_size, mtime
+
+    def file_mtimes(self, piece_index: int, cache: Dict = None) -> Dict[object, int]:
+        if cache is None:
+            cache = {}
+        mtimes = {}
+        for file_index, _, _ in self.layout.spans(piece_index):
+            if self.fds[file_index] < 0:
+                continue
+            if file_index not in cache:
+                cache[file_index] = os.fstat(self.fds[file_index])
+            mtimes[file_index] = cache[file_index].st_mtime_ns
+        return mtimes
+
+    def reader(self) -> 'SingleFileStorage':
+        reader = super().reader()
+        reader.fds = [-1 if file.padding else os.open(path, os.O_RDONLY)
+                      for path, file in zip(self.paths, self.layout.files)]
+        reader.maps = {}
+        return reader
+
+    def close(self):
+        # 貸し出したmemoryviewが残っていても、参照が無くなった時点でunmapされる
+        self.maps = {}
+        for fd in self.fds:
+            if fd < 0:
+                continue
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(fd)
+            os.close(fd)
+        self.fds = []
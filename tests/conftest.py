@@ -0,0 +1,4 @@
+import os
+
+# logger.py は作業ディレクトリの config.yaml を読むので、どこから実行してもリポジトリの直下で動かす
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,82 @@
+import mmap
+
+import pytest
+
+from src.infrastructure.bencode import BencodeError, decode, decode_metainfo
+
+
+@pytest.mark.parametrize('data, value', [
+    (b'i0e', 0),
+    (b'i42e', 42),
+    (b'i-42e', -42),
+    (b'0:', ''),
+    (b'4:spam', 'spam'),
+    (b'04:spam', 'spam'),
+    (b'2:\xff\xfe', b'\xff\xfe'),
+    (b'le', []),
+    (b'li1e4:spame', [1, 'spam']),
+    (b'd1:ai1e1:bli2eee', {'a': 1, 'b': [2]}),
+])
+def test_decode(data, value):
+    assert decode(data) == value
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'i-0e',
+    b'i03e',
+    b'i+1e',
+    b'i 1e',
+    b'i1_2e',
+    b'ie',
+    b'i-e',
+    b'i1',
+    b' 4:spam',
+    b'+4:spam',
+    b'1_2:spamspamspam',
+    b'-1:a',
+    b'5:spam',
+    b'4spam',
+    b'l',
+    b'li1e',
+    b'd1:ai1e',
+    b'di1ei1ee',
+    b'x',
+])
+def test_decode_rejects_invalid_data(data):
+    with pytest.raises(BencodeError):
+        decode(data)
+
+
+def test_decode_from_mmap(tmp_path):
+    path = tmp_path / 'data'
+    path.write_bytes(b'd4:listli1ei-2ee3:str3:abce')
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        assert decode(data) == {'list': [1, -2], 'str': 'abc'}
+
+
+def test_metainfo_keeps_raw_info_span_and_binary_values():
+    info = b'd6:lengthi8e4:name1:x12:piece lengthi4e6:pieces40:' + bytes(range(40)) + b'e'
+    data = b'd8:announce4:http4:info' + info + b'e'
+    metainfo, raw = decode_metainfo(data)
+    assert bytes(raw['info']) == info
+    assert metainfo['info']['name'] == 'x'
+    # pieces はデコードせずに元のバッファのまま返す
+    assert isinstance(metainfo['info']['pieces'], memoryview)
+    assert bytes(metainfo['info']['pieces']) == bytes(range(40))
+
+
+def test_raw_keys_depend_on_dictionary_kind():
+    # file tree の中の "pieces" という名前のファイルは普通の辞書としてデコードする
+    info = (b'd9:file treed6:piecesd0:d6:lengthi1e11:pieces root32:' + bytes(32) + b'eeee'
+            b'4:name1:xe')
+    metainfo, _ = decode_metainfo(b'd4:info' + info + b'e')
+    leaf = metainfo['info']['file tree']['pieces']['']
+    assert leaf['length'] == 1
+    assert bytes(leaf['pieces root']) == bytes(32)
+
+
+def test_piece_layers_keep_binary_keys():
+    layers = b'd32:' + bytes(32) + b'64:' + bytes(range(64)) + b'e'
+    metainfo, _ = decode_metainfo(b'd4:infod4:name1:xe12:piece layers' + layers + b'e')
+    assert bytes(metainfo['piece layers'][bytes(32)]) == bytes(range(64))
@@ -0,0 +1,143 @@
+from src.application.block_scheduler import BlockScheduler
+from src.application.piece_picker import SequentialPicker
+from src.domain.entity.piece.block import State
+from src.domain.entity.piece.block_state import BlockStates
+
+CHUNK_SIZE = 4
+TIME_OUT = 1.0
+
+
+def make_scheduler(piece_sizes=(16, 16, 16)):
+    block_states = BlockStates(list(piece_sizes), CHUNK_SIZE)
+    return block_states, BlockScheduler(block_states, TIME_OUT)
+
+
+def send_all(scheduler, now):
+    return [(piece_index, block_index) for piece_index, block_indexes in scheduler.next_blocks(now, 1000)
+            for block_index in block_indexes]
+
+
+def test_blocks_are_sent_in_piece_order():
+    _, scheduler = make_scheduler()
+    assert scheduler.next_blocks(0.0, 6) == [(0, [0, 1, 2, 3]), (1, [0, 1])]
+    assert scheduler.num_of_pending == 6
+
+
+def test_rtt_sample_of_first_transmission():
+    block_states, scheduler = make_scheduler()
+    scheduler.next_blocks(0.0, 1)
+    acked, rtt = scheduler.set_full(0, 0, 0.25)
+    assert acked and rtt == 0.25
+    # 2回目の受信は応答待ちではない
+    assert scheduler.set_full(0, 0, 0.5) == (False, None)
+
+
+def test_karn_rule_skips_samples_of_retransmitted_blocks():
+    block_states, scheduler = make_scheduler((4,))
+    scheduler.next_blocks(0.0, 1)
+    assert scheduler.expire(TIME_OUT) == [(0, 0)]
+    assert scheduler.next_blocks(2.0, 1) == [(0, [0])]
+    # 最初の送信への応答か再送への応答か区別できない
+    assert scheduler.received([0], [2.1]) == [None]
+
+    # 次の送信からはまたサンプルになる
+    block_states.states[0] = State.FREE
+    scheduler.reset_piece(0, 3.0)
+    scheduler.next_blocks(3.0, 1)
+    assert scheduler.received([0], [3.5]) == [0.5]
+
+
+def test_expire_ignores_received_and_resent_entries():
+    _, scheduler = make_scheduler((8,))
+    scheduler.next_blocks(0.0, 2)
+    scheduler.set_full(0, 0, 0.1)
+    assert scheduler.expire(TIME_OUT) == [(0, 1)]
+    scheduler.next_blocks(1.5, 1)
+    # 再送前のエントリはもう無く、再送のdeadlineまではタイムアウトしない
+    assert scheduler.expire(2.0) == []
+    assert scheduler.expire(1.5 + TIME_OUT) == [(0, 1)]
+
+
+def test_timed_out_piece_is_retried_before_new_pieces():
+    _, scheduler = make_scheduler()
+    scheduler.next_blocks(0.0, 4)
+    scheduler.next_blocks(0.5, 2)
+    assert scheduler.expire(TIME_OUT) == [(0, 0), (0, 1), (0, 2), (0, 3)]
+    assert scheduler.next_blocks(1.1, 5) == [(0, [0, 1, 2, 3]), (1, [2])]
+
+
+def test_timed_out_blocks_are_retried_in_send_order():
+    _, scheduler = make_scheduler()
+    scheduler.next_blocks(0.0, 8)
+    scheduler.set_full(0, 1, 0.1)
+    scheduler.set_full(1, 0, 0.1)
+    assert scheduler.expire(TIME_OUT) == [(0, 0), (0, 2), (0, 3), (1, 1), (1, 2), (1, 3)]
+    assert scheduler.next_blocks(1.1, 10) == [(0, [0, 2, 3]), (1, [1, 2, 3]), (2, [0, 1, 2, 3])]
+
+
+def test_failed_leaf_blocks_are_requested_first_in_order():
+    block_states, scheduler = make_scheduler()
+    send_all(scheduler, 0.0)
+    for g in range(len(block_states)):
+        block_states.states[g] = State.FULL
+    scheduler.received(range(len(block_states)), [0.1] * len(block_states))
+
+    for block_index in (1, 3):
+        block_states.states[block_states.global_index(2, block_index)] = State.FREE
+    scheduler.reset_blocks(2, [1, 3], 0.2)
+    assert scheduler.next_blocks(0.2, 10) == [(2, [1, 3])]
+
+
+def test_scheduler_never_writes_block_states():
+    block_states, scheduler = make_scheduler()
+    send_all(scheduler, 0.0)
+    scheduler.expire(TIME_OUT)
+    scheduler.reset_piece(1, 1.5)
+    scheduler.reset_blocks(2, [0], 1.5)
+    send_all(scheduler, 2.0)
+    assert block_states.count(State.FREE) == len(block_states)
+
+
+def test_full_block_written_by_listener_is_not_timed_out_or_resent():
+    block_states, scheduler = make_scheduler((8,))
+    scheduler.next_blocks(0.0, 2)
+    # listener が FULL を書いたが、受信の通知はまだ届いていない
+    block_states.states[0] = State.FULL
+    assert scheduler.expire(TIME_OUT) == [(0, 1)]
+    assert scheduler.next_blocks(1.5, 2) == [(0, [1])]
+    assert block_states.states[0] == State.FULL
+
+
+def test_endgame_duplicates_each_send_once_oldest_first():
+    block_states, scheduler = make_scheduler((8, 8))
+    scheduler.next_blocks(0.0, 2)
+    scheduler.next_blocks(0.1, 2)
+    assert scheduler.next_blocks(0.2, 1) == []
+
+    # 送信から min_age 経ったものだけ
+    assert scheduler.duplicate_block(0.15, min_age=0.1) == (0, 0)
+    assert scheduler.duplicate_block(0.15, min_age=0.1) == (0, 1)
+    assert scheduler.duplicate_block(0.15, min_age=0.1) is None
+
+    scheduler.set_full(1, 0, 0.3)
+    assert scheduler.duplicate_block(0.3, min_age=0.1) == (1, 1)
+    assert scheduler.duplicate_block(0.3) is None
+    # 重複して要求したブロックの応答はRTTサンプルにしない
+    assert scheduler.set_full(0, 0, 0.4) == (True, None)
+
+
+def test_endgame_follows_new_sends():
+    _, scheduler = make_scheduler((4,))
+    scheduler.next_blocks(0.0, 1)
+    assert scheduler.duplicate_block(0.5) == (0, 0)
+    scheduler.expire(TIME_OUT)
+    scheduler.next_blocks(1.5, 1)
+    assert scheduler.duplicate_block(1.6, min_age=0.5) is None
+    assert scheduler.duplicate_block(2.0, min_age=0.5) == (0, 0)
+
+
+def test_pieces_limit_the_scheduled_range():
+    block_states = BlockStates([8, 8, 8], CHUNK_SIZE)
+    block_states.states[block_states.global_index(2, 0)] = State.FULL
+    scheduler = BlockScheduler(block_states, TIME_OUT, SequentialPicker(3), pieces=[0, 2])
+    assert send_all(scheduler, 0.0) == [(0, 0), (0, 1), (2, 1)]
@@ -0,0 +1,155 @@
+import hashlib
+import multiprocessing
+import os
+
+import pytest
+
+import src.application.cache_manager as cache_manager
+from src.application.cache_manager import CacheManager, _current_process
+from src.application.resume import ResumeData
+from src.domain.entity.layout import TorrentLayout
+from src.domain.entity.piece.piece import Piece
+from src.infrastructure.storage import PieceFileStorage
+
+PIECE_SIZE = 100
+
+
+def add_torrent(cache: CacheManager, name: str, number_of_pieces: int) -> str:
+    """
+    pieceごとのファイルで保存したtorrentを索引に載せる (最終アクセスは piece_index の順)
+    """
+    info_hash = hashlib.sha1(name.encode()).hexdigest()
+    directory = os.path.join(cache.directory, name)
+    os.makedirs(directory)
+    storage = PieceFileStorage(directory, PIECE_SIZE)
+    resume = ResumeData(directory, info_hash, storage)
+    for piece_index in range(number_of_pieces):
+        data = bytes([piece_index]) * PIECE_SIZE
+        storage.write(piece_index, data)
+        resume.add(Piece(piece_index, PIECE_SIZE, hashlib.sha1(data).digest(), storage))
+    resume.save()
+
+    cache.register(info_hash, name, 'piece', TorrentLayout([([name], number_of_pieces * PIECE_SIZE)], PIECE_SIZE))
+    for piece_index in range(number_of_pieces):
+        cache.add(info_hash, piece_index, PIECE_SIZE)
+    cache.flush()
+    return info_hash
+
+
+def on_disk(cache: CacheManager, name: str):
+    return sorted(int(file) for file in os.listdir(os.path.join(cache.directory, name)) if file.isdigit())
+
+
+def pin_and_exit(directory: str, info_hash: str):
+    CacheManager(directory).pin(info_hash)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return CacheManager(str(tmp_path))
+
+
+def test_index_is_shared_between_managers(cache):
+    info_hash = add_torrent(cache, 'a', 3)
+    other = CacheManager(cache.directory)
+    assert other.pieces(info_hash) == [0, 1, 2]
+    assert other.total_bytes == 3 * PIECE_SIZE
+
+
+def test_lru_evicts_least_recently_used_down_to_low_watermark(cache):
+    info_hash = add_torrent(cache, 'a', 10)
+    cache.touch(info_hash, 0)
+    cache.budget = 9 * PIECE_SIZE
+    cache.evict()
+    # 予算の LOW_WATERMARK (810 byte) まで減らす
+    assert cache.pieces(info_hash) == [3, 4, 5, 6, 7, 8, 9, 0]
+    assert cache.total_bytes == 8 * PIECE_SIZE
+    assert on_disk(cache, 'a') == [0, 3, 4, 5, 6, 7, 8, 9]
+
+
+def test_lfu_evicts_least_frequently_used(tmp_path):
+    cache = CacheManager(str(tmp_path), policy='lfu')
+    info_hash = add_torrent(cache, 'a', 4)
+    for piece_index in (0, 0, 1, 3):
+        cache.touch(info_hash, piece_index)
+    cache.budget = 3 * PIECE_SIZE
+    cache.evict()
+    # アクセス回数は 0:3, 1:2, 2:1, 3:2 なので 2 を消し、同じ回数の 1 と 3 は最終アクセスの古い 1 を消す
+    assert sorted(cache.pieces(info_hash)) == [0, 3]
+    assert on_disk(cache, 'a') == [0, 3]
+
+
+def test_evicted_pieces_are_removed_from_resume(cache):
+    info_hash = add_torrent(cache, 'a', 4)
+    cache.budget = 2 * PIECE_SIZE
+    cache.evict()
+    directory = os.path.join(cache.directory, 'a')
+    resume = ResumeData(directory, info_hash, PieceFileStorage(directory, PIECE_SIZE))
+    assert sorted(resume.pieces) == [3]
+
+
+def test_pinned_torrent_is_not_evicted(cache):
+    pinned = add_torrent(cache, 'a', 4)
+    other = add_torrent(cache, 'b', 4)
+    cache.pin(pinned)
+    cache.budget = 4 * PIECE_SIZE
+    cache.evict()
+    assert cache.pieces(pinned) == [0, 1, 2, 3]
+    assert cache.pieces(other) == []
+
+    # 追い出せるpieceが無くても予算は超えたまま
+    cache.budget = 2 * PIECE_SIZE
+    cache.evict()
+    assert cache.pieces(pinned) == [0, 1, 2, 3]
+
+    cache.unpin(pinned)
+    cache.evict()
+    assert cache.total_bytes <= 2 * PIECE_SIZE
+
+
+def test_pin_of_exited_process_is_ignored(cache):
+    info_hash = add_torrent(cache, 'a', 4)
+    process = multiprocessing.get_context('fork').Process(target=pin_and_exit, args=(cache.directory, info_hash))
+    process.start()
+    process.join()
+
+    cache.budget = 2 * PIECE_SIZE
+    cache.evict()
+    assert cache.pins[info_hash]
+    assert cache.total_bytes <= 2 * PIECE_SIZE
+
+
+def test_pin_of_reused_pid_is_ignored(cache):
+    info_hash = add_torrent(cache, 'a', 4)
+    pid, start_time = _current_process()
+    if start_time is None:
+        pytest.skip('process start time is not available')
+    # 同じPIDで起動時刻の違うプロセスが pin した記録
+    with cache._locked():
+        cache._append([[cache_manager._PIN, info_hash, pid, start_time - 1]])
+
+    cache.budget = 2 * PIECE_SIZE
+    cache.evict()
+    assert cache.total_bytes <= 2 * PIECE_SIZE
+
+
+def test_sync_aligns_index_with_resume(cache):
+    info_hash = add_torrent(cache, 'a', 3)
+    cache.sync(info_hash, [(1, PIECE_SIZE), (2, PIECE_SIZE), (5, PIECE_SIZE)])
+    assert sorted(cache.pieces(info_hash)) == [1, 2, 5]
+    assert cache.total_bytes == 3 * PIECE_SIZE
+
+
+def test_compaction_keeps_entries_and_live_pins(cache, monkeypatch):
+    monkeypatch.setattr(cache_manager, 'COMPACT_LINES', 8)
+    info_hash = add_torrent(cache, 'a', 4)
+    cache.pin(info_hash)
+    for _ in range(10):
+        cache.touch(info_hash, 1)
+    with open(cache.path) as file:
+        assert len(file.readlines()) < 10
+
+    other = CacheManager(cache.directory)
+    assert other.pieces(info_hash) == [0, 2, 3, 1]
+    assert other.entries[(info_hash, 1)][cache_manager._HITS] > 1
+    assert other.pins[info_hash] == {_current_process()}
@@ -0,0 +1,125 @@
+import pytest
+
+from src.application.congestion_control import INITIAL_WINDOW, MIN_WINDOW
+from src.application.cubic import Cubic
+from src.application.rtt_estimator import RttEstimator
+
+
+class Clock:
+    def __init__(self, now: float = 100.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_first_sample_sets_srtt_and_rttvar():
+    rtt = RttEstimator()
+    rtt.update(0.1)
+    assert rtt.srtt == pytest.approx(0.1)
+    assert rtt.rttvar == pytest.approx(0.05)
+    assert rtt.rto == pytest.approx(0.3)
+    assert rtt.min_rtt == pytest.approx(0.1)
+
+
+def test_samples_are_smoothed():
+    rtt = RttEstimator()
+    rtt.update(0.1)
+    rtt.update(0.3)
+    assert rtt.rttvar == pytest.approx(0.75 * 0.05 + 0.25 * 0.2)
+    assert rtt.srtt == pytest.approx(0.875 * 0.1 + 0.125 * 0.3)
+    assert rtt.min_rtt == pytest.approx(0.1)
+
+
+def test_rto_is_clamped():
+    rtt = RttEstimator(min_rto=0.2, max_rto=4.0)
+    rtt.update(0.001)
+    assert rtt.rto == 0.2
+    rtt.update(10.0)
+    assert rtt.rto == 4.0
+
+
+def test_negative_sample_is_ignored():
+    rtt = RttEstimator()
+    rtt.update(-1.0)
+    assert rtt.srtt is None
+    assert rtt.smoothed == rtt.rto
+
+
+def test_backoff_doubles_until_next_sample():
+    rtt = RttEstimator(max_rto=4.0)
+    rtt.update(0.1)
+    rtt.backoff()
+    assert rtt.rto == pytest.approx(0.6)
+    for _ in range(5):
+        rtt.backoff()
+    assert rtt.rto == 4.0
+    rtt.update(0.1)
+    assert rtt.rto < 1.0
+
+
+def test_slow_start_grows_by_one_per_data():
+    cubic = Cubic(clock=Clock())
+    for _ in range(10):
+        cubic.on_data(0.1)
+    assert cubic.cwind == INITIAL_WINDOW + 10
+
+
+def test_timeout_reduces_window_once_per_rtt():
+    clock = Clock()
+    cubic = Cubic(clock=clock)
+    for _ in range(96):
+        cubic.on_data(0.1)
+    assert cubic.cwind == 100
+
+    assert cubic.on_timeout()
+    assert cubic.cwind == pytest.approx(70)
+    assert cubic.ssthresh == pytest.approx(70)
+    assert cubic.w_max == 100
+
+    # 同じRTTの間の2回目は数えない (RTOは1回目で倍になっている)
+    clock.now += 0.05
+    assert not cubic.on_timeout()
+    assert cubic.cwind == pytest.approx(70)
+
+    clock.now += 1.0
+    assert cubic.on_timeout()
+    # fast convergence: w_max に届く前の減少では w_max も下げる
+    assert cubic.w_max == pytest.approx(70 * (2 - cubic.B) / 2)
+    assert cubic.cwind == pytest.approx(49)
+
+
+def test_window_does_not_drop_below_minimum():
+    clock = Clock()
+    cubic = Cubic(clock=clock)
+    for _ in range(20):
+        clock.now += 10
+        cubic.on_timeout()
+    assert cubic.cwind == MIN_WINDOW
+
+
+def test_window_recovers_towards_w_max_after_loss():
+    clock = Clock()
+    cubic = Cubic(clock=clock)
+    for _ in range(96):
+        cubic.on_data(0.1)
+    cubic.on_timeout()
+    assert cubic.k == 0
+
+    cubic.on_data(0.1)
+    # w_max より小さいところから始めるので K > 0 で凹型に w_max へ戻る
+    assert cubic.k == pytest.approx((30 / cubic.C) ** (1 / 3), rel=0.01)
+    previous = cubic.cwind
+    for _ in range(200):
+        clock.now += 0.01
+        cubic.on_data(0.1)
+        assert cubic.cwind >= previous
+        previous = cubic.cwind
+    # K (約4.2秒) より前は w_max を越えない
+    assert 70 < cubic.cwind < 100
+
+    # K を過ぎると w_max を越えて凸型に増える
+    for _ in range(1000):
+        clock.now += 0.01
+        cubic.on_data(0.1)
+    assert cubic.cwind > 100
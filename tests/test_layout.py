@@ -0,0 +1,46 @@
+import pytest
+
+from src.domain.entity.layout import TorrentLayout, check_path
+
+
+@pytest.mark.parametrize('path', [
+    ['a'],
+    ['dir', 'sub', 'file.bin'],
+    ['..a'],
+    ['a..'],
+    ['.hidden'],
+    ['名前'],
+])
+def test_check_path_accepts_relative_paths(path):
+    check_path(path)
+
+
+@pytest.mark.parametrize('path', [
+    [],
+    [''],
+    ['.'],
+    ['..'],
+    ['dir', '..', '..', 'etc'],
+    ['/etc'],
+    ['dir', '/etc'],
+    ['a/b'],
+    ['../a'],
+    ['a\0b'],
+    [b'a'],
+    [1],
+])
+def test_check_path_rejects_escaping_paths(path):
+    with pytest.raises(ValueError):
+        check_path(path)
+
+
+def test_layout_rejects_invalid_file_path():
+    with pytest.raises(ValueError):
+        TorrentLayout([(['ok'], 4), (['..', 'evil'], 4)], 4)
+
+
+def test_layout_keeps_padding_files():
+    layout = TorrentLayout([(['a'], 3), (['.pad', '1'], 1, True), (['b'], 4)], 4)
+    assert [file.padding for file in layout.files] == [False, True, False]
+    assert layout.spans(0) == [(0, 0, 3), (1, 0, 1)]
+    assert layout.spans(1) == [(2, 0, 4)]
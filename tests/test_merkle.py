@@ -0,0 +1,161 @@
+import hashlib
+
+import pytest
+
+from benchmark.dummy_torrent import DummyTorrent
+from src.domain.entity.layout import TorrentLayout
+from src.domain.entity.piece.block import State
+from src.domain.entity.piece.block_state import BlockStates
+from src.domain.entity.piece.merkle import (BLOCK_SIZE, HASH_SIZE, ZERO_HASH, MerklePiece, leaf_hashes,
+                                            merkle_pieces, merkle_root)
+from src.domain.entity.piece.piece import Piece
+from src.domain.entity.torrent import Torrent
+
+CHUNK_SIZE = 4096
+PIECE_LENGTH = 4 * BLOCK_SIZE
+
+
+def sha256(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+def piece_data(length: int) -> bytes:
+    return bytes(i * 7 % 251 for i in range(length))
+
+
+def merkle_piece(data: bytes, width: int = PIECE_LENGTH // BLOCK_SIZE) -> MerklePiece:
+    return MerklePiece(merkle_root(leaf_hashes(data), width), width, len(data))
+
+
+def test_merkle_root():
+    a, b, c = sha256(b'a'), sha256(b'b'), sha256(b'c')
+    assert merkle_root([a], 1) == a
+    assert merkle_root([a, b], 2) == sha256(a + b)
+    # 葉の数を2のべきに揃える部分は pad で埋める
+    assert merkle_root([a, b, c], 4) == sha256(sha256(a + b) + sha256(c + ZERO_HASH))
+    assert merkle_root([], 2, a) == sha256(a + a)
+
+
+def test_leaf_hashes_split_by_block_size():
+    data = piece_data(BLOCK_SIZE + 10)
+    assert leaf_hashes(data) == [sha256(data[:BLOCK_SIZE]), sha256(data[BLOCK_SIZE:])]
+
+
+def test_verify_piece():
+    data = piece_data(PIECE_LENGTH - 100)
+    merkle = merkle_piece(data)
+    assert merkle.number_of_leaves == 4
+    assert merkle.verify(data)
+    # length より後ろ(詰め物)は検証に含めない
+    assert merkle.verify(data + bytes(100))
+    broken = bytearray(data)
+    broken[BLOCK_SIZE] ^= 1
+    assert not merkle.verify(broken)
+
+
+def test_verify_layer():
+    data = piece_data(3 * BLOCK_SIZE)
+    merkle = merkle_piece(data)
+    payload = b''.join(leaf_hashes(data))
+    assert merkle.verify_layer(payload) == leaf_hashes(data)
+    assert merkle.verify_layer(payload[:-HASH_SIZE]) is None
+    assert merkle.verify_layer(payload + ZERO_HASH) is None
+    tampered = bytearray(payload)
+    tampered[0] ^= 1
+    assert merkle.verify_layer(tampered) is None
+
+
+def make_piece(data: bytes, piece_size: int = PIECE_LENGTH) -> Piece:
+    blocks = BlockStates([piece_size], CHUNK_SIZE).piece(0)
+    return Piece(0, piece_size, None, None, blocks, merkle=merkle_piece(data))
+
+
+def receive(piece: Piece, data: bytes, block_indexes):
+    failed = []
+    for block_index in block_indexes:
+        offset = block_index * CHUNK_SIZE
+        size = piece.blocks.block_size(block_index)
+        block = data[offset:offset + size]
+        assert piece.set_block(offset, block + bytes(size - len(block)))
+        failed += piece.check_block(block_index)
+    return failed
+
+
+def test_only_blocks_of_failing_leaf_are_reset():
+    data = piece_data(PIECE_LENGTH)
+    piece = make_piece(data)
+    assert piece.set_leaf_hashes(b''.join(leaf_hashes(data))) == []
+
+    broken = bytearray(data)
+    broken[BLOCK_SIZE + 5] ^= 1
+    # 2番目の葉 (ブロック4-7) が揃った時点でその葉のブロックだけFREEに戻す
+    assert receive(piece, bytes(broken), range(8)) == [4, 5, 6, 7]
+    assert [piece.blocks.state(i) for i in range(8)] == [State.FULL] * 4 + [State.FREE] * 4
+    assert piece.verified_leaves[:2] == b'\x01\x00'
+
+    assert receive(piece, data, range(4, 16)) == []
+    assert piece.set_to_full()
+    assert bytes(piece.raw_data) == data
+
+
+def test_leaf_hashes_arriving_after_blocks():
+    data = piece_data(PIECE_LENGTH)
+    piece = make_piece(data)
+    broken = bytearray(data)
+    broken[-1] ^= 1
+    # 葉のハッシュが無い間は検証しない
+    assert receive(piece, bytes(broken), range(12, 16)) == []
+    assert piece.set_leaf_hashes(b''.join(leaf_hashes(data))) == [12, 13, 14, 15]
+
+
+def test_wrong_leaf_hashes_are_rejected():
+    data = piece_data(PIECE_LENGTH)
+    piece = make_piece(data)
+    assert piece.set_leaf_hashes(b''.join(leaf_hashes(data[::-1]))) is None
+    assert piece.leaf_hashes is None
+
+
+def test_padding_after_file_end_is_zeroed():
+    data = piece_data(PIECE_LENGTH - 3 * CHUNK_SIZE - 10)
+    piece = make_piece(data)
+    assert piece.set_leaf_hashes(b''.join(leaf_hashes(data))) == []
+    padded = data + b'\xff' * (PIECE_LENGTH - len(data))
+    assert receive(piece, padded, range(16)) == []
+    assert piece.set_to_full()
+    assert bytes(piece.raw_data) == data + bytes(PIECE_LENGTH - len(data))
+
+
+def test_without_leaf_hashes_whole_piece_is_verified():
+    data = piece_data(PIECE_LENGTH)
+    piece = make_piece(data)
+    broken = bytearray(data)
+    broken[0] ^= 1
+    receive(piece, bytes(broken), range(16))
+    assert not piece.set_to_full()
+    assert piece.failed_blocks is None
+    assert piece.blocks.table.count(State.FREE) == 16
+
+
+@pytest.fixture
+def v2_torrent(tmp_path):
+    dummy = DummyTorrent(1, piece_length=PIECE_LENGTH, version=2)
+    return dummy, Torrent(dummy.write(str(tmp_path)))
+
+
+def test_merkle_pieces_from_piece_layers(v2_torrent):
+    dummy, torrent = v2_torrent
+    pieces = merkle_pieces(torrent, TorrentLayout.from_torrent(torrent))
+    assert len(pieces) == dummy.number_of_pieces
+    for piece_index, merkle in enumerate(pieces):
+        assert merkle.verify(dummy.piece_data(piece_index))
+    assert not pieces[0].verify(dummy.piece_data(1))
+
+
+def test_tampered_piece_layer_is_rejected(v2_torrent):
+    _, torrent = v2_torrent
+    root, layer = next(iter(torrent.piece_layers.items()))
+    tampered = bytearray(layer)
+    tampered[0] ^= 1
+    torrent.piece_layers[root] = memoryview(bytes(tampered))
+    with pytest.raises(ValueError):
+        merkle_pieces(torrent, TorrentLayout.from_torrent(torrent))
@@ -0,0 +1,77 @@
+from src.application.block_scheduler import BlockScheduler
+from src.application.piece_picker import (RAREST_SPREAD, RarestFirstPicker, SequentialPicker, StreamingPicker,
+                                          create_piece_picker)
+from src.domain.entity.piece.block_state import BlockStates
+
+NUMBER_OF_PIECES = 3 * RAREST_SPREAD
+
+
+def candidates(picker, number_of_pieces=NUMBER_OF_PIECES):
+    for piece_index in range(number_of_pieces):
+        picker.add(piece_index)
+    return picker
+
+
+def test_rarest_starts_in_piece_order():
+    picker = candidates(RarestFirstPicker(NUMBER_OF_PIECES))
+    assert picker.peek() == 0
+
+
+def test_cache_hit_moves_following_pieces_back():
+    picker = candidates(RarestFirstPicker(NUMBER_OF_PIECES))
+    picker.remove(0)
+    picker.on_response(0, 0.01)
+    # 0 から RAREST_SPREAD 個はキャッシュにあるとみなして後回し
+    assert picker.peek() == RAREST_SPREAD
+    assert picker.availability[RAREST_SPREAD - 1] == 1
+
+
+def test_slow_response_and_timeout_move_following_pieces_forward():
+    picker = candidates(RarestFirstPicker(NUMBER_OF_PIECES))
+    picker.on_response(0, 0.01)
+    picker.on_response(2 * RAREST_SPREAD, 0.1)
+    assert picker.peek() == 2 * RAREST_SPREAD
+
+    picker = candidates(RarestFirstPicker(NUMBER_OF_PIECES))
+    picker.on_timeout(RAREST_SPREAD)
+    assert picker.peek() == RAREST_SPREAD
+
+
+def test_only_first_response_of_piece_is_counted():
+    picker = RarestFirstPicker(NUMBER_OF_PIECES)
+    picker.on_response(0, 0.01)
+    picker.on_response(0, 0.01)
+    picker.on_timeout(0)
+    assert picker.availability[0] == 1
+
+
+def test_streaming_window_ignores_availability():
+    picker = candidates(StreamingPicker(NUMBER_OF_PIECES, window=4))
+    picker.on_response(0, 0.001)
+    picker.on_response(RAREST_SPREAD + 4, 0.1)
+    assert picker.peek() == 0
+    for piece_index in range(4):
+        picker.remove(piece_index)
+    # window の先は rarest-first
+    assert picker.peek() == RAREST_SPREAD + 4
+
+
+def test_scheduler_feeds_picker_except_retransmissions():
+    block_states = BlockStates([8] * NUMBER_OF_PIECES, 4)
+    picker = create_piece_picker('rarest', NUMBER_OF_PIECES)
+    scheduler = BlockScheduler(block_states, 1.0, picker)
+    scheduler.next_blocks(0.0, 4)
+    scheduler.received([block_states.global_index(0, 0)], [0.01])
+    assert picker.min_rtt == 0.01
+    assert picker.availability[0] == 1
+
+    assert scheduler.expire(1.0) == [(0, 1), (1, 0), (1, 1)]
+    assert picker.availability[1] == 0
+    scheduler.next_blocks(1.5, 3)
+    scheduler.received([block_states.global_index(1, 0)], [1.51])
+    # 再送したブロックの応答は渡さない
+    assert picker.min_rtt == 0.01
+
+
+def test_sequential_picker_does_not_observe():
+    assert not SequentialPicker.observes
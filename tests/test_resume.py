@@ -0,0 +1,127 @@
+import hashlib
+import os
+
+import pytest
+
+from src.application.resume import ResumeData, JOURNAL_FILE
+from src.domain.entity.layout import TorrentLayout
+from src.domain.entity.piece.piece import Piece
+from src.infrastructure.storage import SingleFileStorage
+
+INFO_HASH = '00' * 20
+PIECE_LENGTH = 4
+# a: piece 0, 1 / b: piece 2, 3
+FILES = [(['a'], 8), (['b'], 8)]
+DATA = [b'aaaa', b'bbbb', b'cccc', b'dddd']
+
+
+class Download:
+    def __init__(self, directory):
+        self.directory = str(directory)
+        self.storage = SingleFileStorage(self.directory, TorrentLayout(FILES, PIECE_LENGTH))
+        self.pieces = [Piece(i, PIECE_LENGTH, hashlib.sha1(data).digest(), self.storage)
+                       for i, data in enumerate(DATA)]
+        self.mtime = 1_000_000_000_000_000_000
+
+    def write(self, piece_index: int, data: bytes = None):
+        self.storage.write(piece_index, DATA[piece_index] if data is None else data)
+        # mtime の粒度に左右されないよう書き込みごとに進める
+        self.mtime += 1_000_000_000
+        path = self.storage.paths[self.storage.layout.spans(piece_index)[0][0]]
+        os.utime(path, ns=(self.mtime, self.mtime))
+
+    def resume(self) -> ResumeData:
+        return ResumeData(self.directory, INFO_HASH, self.storage)
+
+
+@pytest.fixture
+def download(tmp_path):
+    download = Download(tmp_path)
+    yield download
+    download.storage.close()
+
+
+def fast_check(resume, pieces, monkeypatch, rehash=False):
+    hashed = []
+    original = ResumeData._hash_piece
+
+    def hash_piece(self, piece):
+        hashed.append(piece.piece_index)
+        return original(self, piece)
+
+    monkeypatch.setattr(ResumeData, '_hash_piece', hash_piece)
+    trusted = resume.fast_check(pieces, rehash)
+    return sorted(piece.piece_index for piece in trusted), sorted(hashed)
+
+
+def save_all(download):
+    resume = download.resume()
+    for piece in download.pieces:
+        download.write(piece.piece_index)
+        resume.add(piece)
+    resume.save()
+    return resume
+
+
+def test_saved_pieces_are_trusted_without_hashing(download, monkeypatch):
+    save_all(download)
+    assert not os.path.exists(os.path.join(download.directory, JOURNAL_FILE))
+    assert fast_check(download.resume(), download.pieces, monkeypatch) == ([0, 1, 2, 3], [])
+
+
+def test_journal_explains_mtime_change_of_recorded_pieces(download, monkeypatch):
+    resume = download.resume()
+    for piece_index in (0, 2, 3):
+        download.write(piece_index)
+        resume.add(download.pieces[piece_index])
+    resume.save()
+
+    # 保存の後に piece 1 を書き込んで中断 (a の mtime が変わる)
+    download.write(1)
+    resume.add(download.pieces[1])
+
+    # ジャーナルの piece 1 だけを再ハッシュし、同じファイルの piece 0 はそのまま信用する
+    resume = download.resume()
+    assert resume.journal == {1}
+    assert fast_check(resume, download.pieces, monkeypatch) == ([0, 1, 2, 3], [1])
+
+    # 次の保存で今の mtime を記録してジャーナルを消す
+    resume.save()
+    assert not os.path.exists(os.path.join(download.directory, JOURNAL_FILE))
+    assert fast_check(download.resume(), download.pieces, monkeypatch) == ([0, 1, 2, 3], [])
+
+
+def test_unexplained_change_is_rehashed(download, monkeypatch):
+    save_all(download)
+    download.write(1)
+    download.resume().add(download.pieces[1])
+
+    # ジャーナルに無い b への書き込み
+    download.write(3, b'XXXX')
+    trusted, hashed = fast_check(download.resume(), download.pieces, monkeypatch)
+    assert hashed == [1, 2, 3]
+    assert trusted == [0, 1, 2]
+
+
+def test_journal_without_snapshot(download, monkeypatch):
+    # 最初の保存より前に中断した場合もジャーナルのpieceは再ハッシュで確認する
+    resume = download.resume()
+    download.write(0)
+    resume.add(download.pieces[0])
+    download.write(1, b'XXXX')
+    resume.add(download.pieces[1])
+    assert fast_check(download.resume(), download.pieces, monkeypatch) == ([0], [0, 1])
+
+
+def test_broken_last_journal_line_is_ignored(download):
+    save_all(download)
+    with open(os.path.join(download.directory, JOURNAL_FILE), 'a') as file:
+        file.write('1\n2')
+    assert download.resume().journal == {1}
+
+
+def test_rehash_checks_unrecorded_pieces(download, monkeypatch):
+    for piece in download.pieces:
+        download.write(piece.piece_index)
+    assert fast_check(download.resume(), download.pieces, monkeypatch) == ([], [])
+    assert fast_check(download.resume(), download.pieces, monkeypatch, rehash=True) == ([0, 1, 2, 3], [0, 1, 2, 3])